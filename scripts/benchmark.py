@@ -0,0 +1,331 @@
+"""Benchmark the pipeline stage by stage on synthetic inputs, see synthetic_data.py."""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from importlib.metadata import version
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+
+from shrub_prepro.images import background_samples, plan_windows
+from shrub_prepro.mask import build_valid_mask
+from shrub_prepro.processing import process_data
+from shrub_prepro.runs import load_run
+from shrub_prepro.split import test_train_split
+from synthetic_data import make_inputs
+
+MIB = 1024 * 1024
+
+
+class Timer:
+    """Context manager measuring the wall time of its block in `seconds`"""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+
+
+def bench_valid_mask(raster: str, polygons: str, work_dir: str, options: dict) -> dict:
+    """
+    Coarse valid-data mask of the whole raster, in pixels and in raster bytes per second;
+    the mask of a nodata raster is derived from every band
+    """
+    with rasterio.open(raster) as image, Timer() as timer:
+        build_valid_mask(image)
+    pixels = image.width * image.height
+    size = pixels * image.count * np.dtype(image.dtypes[0]).itemsize
+    return dict(seconds=timer.seconds, items=pixels, unit="pixels", bytes=size)
+
+
+def bench_plan_windows(
+    raster: str, polygons: str, work_dir: str, options: dict
+) -> dict:
+    """Planning one window per shrub, in windows per second"""
+    shrubs = gpd.read_file(polygons)
+    with rasterio.open(raster) as image, Timer() as timer:
+        plan = plan_windows(shrubs, image, options["window_size"])
+    return dict(seconds=timer.seconds, items=len(plan), unit="windows")
+
+
+def bench_background_samples(
+    raster: str, polygons: str, work_dir: str, options: dict
+) -> dict:
+    """Sampling twice as many background windows as shrubs, in windows per second"""
+    shrubs = gpd.read_file(polygons)
+    with rasterio.open(raster) as image:
+        valid_mask = build_valid_mask(image)
+        with Timer() as timer:
+            windows = background_samples(
+                image,
+                shrubs,
+                window_size=options["window_size"],
+                within_df=True,
+                seed=options["seed"],
+                valid_mask=valid_mask,
+            )
+    return dict(seconds=timer.seconds, items=len(windows), unit="windows")
+
+
+def bench_process_data(
+    raster: str, polygons: str, work_dir: str, options: dict
+) -> dict:
+    """
+    A full run from scratch, in patches and in patch bytes (image and label pixels)
+    written per second
+    """
+    output_dir = os.path.join(work_dir, "process_data")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    with Timer() as timer:
+        process_data(
+            raster,
+            polygons,
+            output_dir,
+            "bench",
+            options["window_size"],
+            seed=options["seed"],
+            workers=options["workers"],
+            resume=False,
+        )
+    patches = len(load_run(output_dir).plan)
+    with rasterio.open(raster) as image:
+        bands = image.count
+    pixels = patches * options["window_size"] ** 2
+    return dict(
+        seconds=timer.seconds,
+        items=patches,
+        unit="patches",
+        bytes=pixels * (bands + 1),
+    )
+
+
+def bench_test_train_split(
+    raster: str, polygons: str, work_dir: str, options: dict
+) -> dict:
+    """
+    Splitting a flat images/ and labels/ folder into train/ and test/, in patch pairs
+    and file bytes moved per second. Uses the patches of the process_data stage, when it
+    ran before, else writes them first.
+    """
+    source = os.path.join(work_dir, "process_data")
+    if not os.path.isdir(source):
+        bench_process_data(raster, polygons, work_dir, options)
+    flat = os.path.join(work_dir, "test_train_split")
+    shutil.rmtree(flat, ignore_errors=True)
+    for folder in ("images", "labels"):
+        os.makedirs(os.path.join(flat, folder))
+        for split in ("train", "test"):
+            split_dir = os.path.join(source, split, folder)
+            for name in os.listdir(split_dir):
+                os.replace(
+                    os.path.join(split_dir, name), os.path.join(flat, folder, name)
+                )
+    shutil.rmtree(source)
+    files = [
+        os.path.join(flat, folder, name)
+        for folder in ("images", "labels")
+        for name in os.listdir(os.path.join(flat, folder))
+    ]
+    size = sum(os.path.getsize(f) for f in files)
+    with Timer() as timer:
+        test_train_split(flat, label="bench")
+    return dict(
+        seconds=timer.seconds, items=len(files) // 2, unit="patches", bytes=size
+    )
+
+
+# Stages in the order they run
+STAGES = {
+    "valid_mask": bench_valid_mask,
+    "plan_windows": bench_plan_windows,
+    "background_samples": bench_background_samples,
+    "process_data": bench_process_data,
+    "test_train_split": bench_test_train_split,
+}
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident memory of this process in MiB"""
+    try:
+        # The high-water mark of this process image alone; getrusage also counts the
+        # memory of the parent before it started this process
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / MIB if sys.platform == "darwin" else peak / 1024
+
+
+def _children_peak_rss_mb() -> float:
+    """Peak resident memory of the largest finished child process in MiB, an upper bound"""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / MIB if sys.platform == "darwin" else peak / 1024
+
+
+def _run_stage(name: str, raster: str, polygons: str, work_dir: str, options: dict):
+    """Run one stage in this (fresh) process and add throughput and memory to its result"""
+    logging.basicConfig(level=logging.INFO)
+    rss_before = _peak_rss_mb()
+    result = STAGES[name](raster, polygons, work_dir, options)
+    seconds = result["seconds"]
+    result[f"{result['unit']}_per_s"] = result["items"] / seconds if seconds else None
+    if "bytes" in result:
+        result["mb_per_s"] = result["bytes"] / MIB / seconds if seconds else None
+    result["rss_before_mb"] = rss_before
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["children_peak_rss_mb"] = _children_peak_rss_mb()
+    return result
+
+
+def run_benchmarks(
+    raster: str, polygons: str, work_dir: str, stages: list, options: dict
+) -> dict:
+    """
+    Run each stage in a fresh process, so its peak memory is its own.
+
+    Peak memory covers the whole stage process, setup such as reading the polygons
+    included, and separately its worker processes; rss_before_mb is the share of the
+    imports. Wall times only cover the stage.
+
+    Returns:
+        dict: The results of every stage by name.
+    """
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in stages:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(
+                _run_stage, name, raster, polygons, work_dir, options
+            ).result()
+        unit = result["unit"]
+        logging.info(
+            f"{name}: {result['items']} {unit} in {result['seconds']:.2f} s, "
+            f"{result[f'{unit}_per_s'] or 0:.1f} {unit}/s, "
+            f"peak {result['peak_rss_mb']:.0f} MiB"
+        )
+        results[name] = result
+    return results
+
+
+def _commit() -> str:
+    """The git commit of the working tree, if it is a checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict) -> None:
+    """Print the change in throughput and peak memory of every stage both results have"""
+    print(f"{'stage':<20} {'throughput':>12} {'peak memory':>12}")
+    for name, result in current["stages"].items():
+        old = baseline["stages"].get(name)
+        if old is None:
+            continue
+        rate = f"{result['unit']}_per_s"
+        speed = result[rate] / old[rate] if old.get(rate) else float("nan")
+        memory = result["peak_rss_mb"] / old["peak_rss_mb"]
+        print(f"{name:<20} {speed:>11.2f}x {memory:>11.2f}x")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic inputs"
+    )
+    parser.add_argument("--size", type=int, default=20000, help="Raster size in pixels")
+    parser.add_argument("--polygons", type=int, default=10000, help="Number of shrubs")
+    parser.add_argument("--clusters", type=int, default=50, help="Number of clusters")
+    parser.add_argument("--window-size", type=int, default=512, help="Patch size")
+    parser.add_argument("--workers", type=int, default=1, help="process_data workers")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of inputs and runs")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run (default: all)",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default="benchmark-data",
+        help="Directory of the synthetic inputs, reused while the parameters are the same",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Results JSON (default: benchmark-results/<version>-<time>.json)",
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="Earlier results JSON to compare against"
+    )
+    args = parser.parse_args()
+
+    raster, polygons = make_inputs(
+        args.data_dir, args.size, args.polygons, args.clusters, seed=args.seed
+    )
+    options = dict(window_size=args.window_size, workers=args.workers, seed=args.seed)
+    with tempfile.TemporaryDirectory() as work_dir:
+        stages = run_benchmarks(raster, polygons, work_dir, args.stages, options)
+
+    now = datetime.now(timezone.utc)
+    results = dict(
+        created=now.isoformat(timespec="seconds"),
+        version=version("shrub-prepro"),
+        commit=_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        params=dict(
+            size=args.size,
+            polygons=args.polygons,
+            clusters=args.clusters,
+            **options,
+        ),
+        inputs=dict(
+            raster=raster, polygons=polygons, raster_bytes=os.path.getsize(raster)
+        ),
+        stages=stages,
+    )
+    output = args.output or os.path.join(
+        "benchmark-results",
+        f"{results['version']}-{now.strftime('%Y%m%dT%H%M%S')}.json",
+    )
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,22 +4,27 @@ import argparse
 from pathlib import Path
 import rasterio
 import geopandas as gpd
-import s3fs
+from shapely.geometry import box
 
+from shrub_prepro.cache import InputCache
+from shrub_prepro.remote import configure_remote_access, get_s3_filesystem, open_cached
 
-def get_sample_bbox(raster_path: str, max_pixels: int = 1000) -> tuple:
+
+def get_sample_bbox(
+    raster_path: str, max_pixels: int = 1000, ranges_dir: str = None
+) -> tuple:
     """
     Generate a sample bbox from COG metadata that will result in a window < max_pixels.
 
     Args:
         raster_path: S3 path to COG
         max_pixels: Maximum size in pixels for either dimension
+        ranges_dir: Optional byte-range cache directory, see InputCache.ranges_dir
 
     Returns:
         tuple: (minx, miny, maxx, maxy)
     """
-    fs = s3fs.S3FileSystem(anon=False)
-    with rasterio.open(fs.open(raster_path)) as src:
+    with open_cached(raster_path, ranges_dir) as src:
         # Get full bounds
         bounds = src.bounds
         transform = src.transform
@@ -52,10 +57,14 @@ def create_test_samples(
     bbox: tuple = None,
     label: str = "test",
     max_pixels: int = 1000,
+    cache_dir: str = None,
 ):
     """
     Extract small samples from S3 data for testing.
 
+    Only the raster blocks under the bbox are fetched. With a cache_dir, fetched blocks and
+    the polygons are kept there and reused while the S3 objects are unchanged.
+
     Args:
         s3_raster: S3 path to raster (e.g. s3://bucket/rgb.tif)
         s3_polygons: S3 path to polygons (e.g. s3://bucket/shrubs.shp)
@@ -63,21 +72,22 @@ def create_test_samples(
         bbox: Optional tuple of (minx, miny, maxx, maxy). If None, auto-generated
         label: Label for output files
         max_pixels: Maximum size in pixels for auto-generated bbox
+        cache_dir: Optional input cache directory shared between runs
     """
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
+    input_cache = InputCache(cache_dir) if cache_dir else None
+    ranges_dir = input_cache.ranges_dir if input_cache else None
 
     # Auto-generate bbox if not provided
     if bbox is None:
         print("Generating sample bbox from COG metadata...")
-        bbox = get_sample_bbox(s3_raster, max_pixels)
+        bbox = get_sample_bbox(s3_raster, max_pixels, ranges_dir)
         print(f"Generated bbox: {bbox}")
 
-    fs = s3fs.S3FileSystem(anon=False)
-
     # Extract raster window
     print(f"Reading raster window from {s3_raster}")
-    with rasterio.open(fs.open(s3_raster)) as src:
+    with open_cached(s3_raster, ranges_dir) as src:
         window = rasterio.windows.from_bounds(*bbox, transform=src.transform)
         data = src.read(window=window)
         profile = src.profile.copy()
@@ -97,7 +107,11 @@ def create_test_samples(
 
     # Extract polygons within bbox
     print(f"Reading polygons from {s3_polygons}")
-    gdf = gpd.read_file(fs.open(s3_polygons), bbox=bbox)
+    if input_cache:
+        gdf = input_cache.read_polygons(s3_polygons)
+        gdf = gdf.iloc[sorted(gdf.sindex.query(box(*bbox), predicate="intersects"))]
+    else:
+        gdf = gpd.read_file(get_s3_filesystem().open(s3_polygons), bbox=bbox)
 
     # Save polygon sample
     poly_out = output_dir / f"{label}_polygons.shp"
@@ -124,7 +138,14 @@ def main():
         help="Maximum size in pixels for auto-generated bbox",
     )
 
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Input cache directory, reused while the S3 objects are unchanged",
+    )
+
     args = parser.parse_args()
+    configure_remote_access()
 
     create_test_samples(
         args.s3_raster,
@@ -133,6 +154,7 @@ def main():
         tuple(args.bbox) if args.bbox else None,
         args.label,
         args.max_pixels,
+        args.cache_dir,
     )
 
 
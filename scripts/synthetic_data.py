@@ -0,0 +1,238 @@
+"""Generate large synthetic rasters and shrub polygons for benchmarking."""
+
+import os
+import argparse
+import logging
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+import geopandas as gpd
+import shapely
+from shapely import affinity
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# A projected CRS in metres, so buffers and polygon sizes are in ground units
+CRS = "EPSG:32633"
+ORIGIN = (500000.0, 6000000.0)
+
+
+def footprint(size: int, collar: float, res: float) -> shapely.Polygon:
+    """
+    The valid area of a synthetic raster: a rectangle rotated by 7 degrees and inset by
+    `collar` of the raster size, like the footprint of a drone orthomosaic.
+    """
+    side = size * res
+    inset = side * (1 - 2 * collar)
+    cx, cy = ORIGIN[0] + side / 2, ORIGIN[1] - side / 2
+    rect = shapely.box(cx - inset / 2, cy - inset / 2, cx + inset / 2, cy + inset / 2)
+    return affinity.rotate(rect, 7, origin=(cx, cy))
+
+
+def make_raster(
+    path,
+    size: int = 20000,
+    bands: int = 3,
+    res: float = 0.05,
+    collar: float = 0.05,
+    block_size: int = 512,
+    seed: int = 0,
+) -> str:
+    """
+    Write a tiled, DEFLATE compressed COG with a nodata collar around a rotated footprint.
+
+    Pixels are smooth fields plus noise, so they compress about as well as imagery does.
+    The raster is written one strip of blocks at a time, then copied into a COG with
+    overviews, so memory stays bounded by one strip.
+
+    Args:
+        path (str): Output path.
+        size (int, optional): Width and height in pixels. Defaults to 20000.
+        bands (int, optional): Number of uint8 bands. Defaults to 3.
+        res (float, optional): Pixel size in metres. Defaults to 0.05.
+        collar (float, optional): Nodata margin as a fraction of the raster size, before
+            rotating the footprint. Defaults to 0.05.
+        block_size (int, optional): Block size of the COG. Defaults to 512.
+        seed (int, optional): Seed of the pixel noise. Defaults to 0.
+
+    Returns:
+        str: The output path.
+    """
+    rng = np.random.default_rng(seed)
+    transform = from_origin(*ORIGIN, res, res)
+    valid = footprint(size, collar, res)
+    profile = dict(
+        driver="GTiff",
+        width=size,
+        height=size,
+        count=bands,
+        dtype="uint8",
+        crs=CRS,
+        transform=transform,
+        nodata=0,
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    )
+    cols = np.arange(size)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp:
+        staging = os.path.join(tmp, "staging.tif")
+        with rasterio.open(staging, "w", **profile) as dst:
+            for row_off in range(0, size, block_size):
+                height = min(block_size, size - row_off)
+                rows = np.arange(row_off, row_off + height)[:, None]
+                field = (
+                    np.sin(cols / 700.0 + rows / 900.0) + np.cos(cols / 230.0) * 0.5
+                ) * 60
+                data = np.empty((bands, height, size), dtype=np.uint8)
+                for band in range(bands):
+                    noise = rng.integers(0, 24, size=(height, size))
+                    data[band] = np.clip(110 + field + 20 * band + noise, 1, 255)
+                xs, ys = transform * (cols[None, :] + 0.5, rows + 0.5)
+                inside = shapely.contains_xy(valid, xs, ys)
+                data[:, ~inside] = 0
+                dst.write(data, window=Window(0, row_off, size, height))
+        # Copied next to the output first, so an interrupted run leaves no partial file
+        cog = os.path.join(tmp, "cog.tif")
+        rasterio.shutil.copy(
+            staging,
+            cog,
+            driver="COG",
+            compress="deflate",
+            blocksize=block_size,
+            BIGTIFF="IF_SAFER",
+        )
+        os.replace(cog, str(path))
+    logging.info(f"Wrote {size}x{size} synthetic raster to {path}")
+    return str(path)
+
+
+def make_polygons(
+    path,
+    size: int = 20000,
+    count: int = 10000,
+    clusters: int = 50,
+    res: float = 0.05,
+    collar: float = 0.05,
+    cluster_radius: Optional[float] = None,
+    shrub_radius: tuple = (0.3, 2.5),
+    seed: int = 0,
+) -> str:
+    """
+    Write shrub polygons clustered around random centres inside the raster footprint.
+
+    Shrubs are irregular ellipses with radii drawn from `shrub_radius`, at normally
+    distributed offsets of `cluster_radius` from their cluster centre, and clipped to
+    the valid area of the raster made by make_raster with the same size, res and collar.
+
+    Args:
+        path (str): Output path of the polygon layer, in a format geopandas can write.
+        size (int, optional): Size of the raster in pixels. Defaults to 20000.
+        count (int, optional): Number of shrubs. Defaults to 10000.
+        clusters (int, optional): Number of clusters. Defaults to 50.
+        res (float, optional): Pixel size of the raster in metres. Defaults to 0.05.
+        collar (float, optional): Nodata collar of the raster. Defaults to 0.05.
+        cluster_radius (float, optional): Spread of a cluster in metres. Defaults to a
+            fiftieth of the raster side.
+        shrub_radius (tuple, optional): Range of shrub radii in metres. Defaults to 0.3-2.5.
+        seed (int, optional): Seed of the layout. Defaults to 0.
+
+    Returns:
+        str: The output path.
+    """
+    rng = np.random.default_rng(seed)
+    valid = footprint(size, collar, res)
+    minx, miny, maxx, maxy = valid.bounds
+    if cluster_radius is None:
+        cluster_radius = size * res / 50
+
+    centres = np.empty((0, 2))
+    while len(centres) < clusters:
+        candidates = rng.uniform((minx, miny), (maxx, maxy), size=(clusters, 2))
+        inside = shapely.contains_xy(valid, candidates[:, 0], candidates[:, 1])
+        centres = np.concatenate([centres, candidates[inside]])[:clusters]
+
+    shrubs = []
+    while len(shrubs) < count:
+        n = count - len(shrubs)
+        # Clusters of uneven size, as shrubs come in dense patches and loose scatter
+        weights = rng.pareto(1.5, size=clusters) + 1
+        picks = rng.choice(clusters, size=n, p=weights / weights.sum())
+        points = centres[picks] + rng.normal(0, cluster_radius, size=(n, 2))
+        keep = shapely.contains_xy(valid, points[:, 0], points[:, 1])
+        for x, y in points[keep]:
+            radius = rng.uniform(*shrub_radius)
+            shape = shapely.Point(x, y).buffer(radius, quad_segs=4)
+            shape = affinity.scale(shape, rng.uniform(0.6, 1.0), 1.0)
+            shape = affinity.rotate(shape, rng.uniform(0, 180))
+            shrubs.append(shape.intersection(valid))
+
+    gdf = gpd.GeoDataFrame(geometry=shrubs[:count], crs=CRS)
+    partial = f"{path}.partial.gpkg"
+    gdf.to_file(partial)
+    os.replace(partial, str(path))
+    logging.info(f"Wrote {count} synthetic shrubs in {clusters} clusters to {path}")
+    return str(path)
+
+
+def make_inputs(
+    output_dir,
+    size: int,
+    count: int,
+    clusters: int,
+    res: float = 0.05,
+    collar: float = 0.05,
+    seed: int = 0,
+) -> tuple:
+    """
+    Write a synthetic raster and polygons to output_dir, reusing the files of an earlier
+    call with the same parameters. Returns the (raster, polygons) paths.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = f"synthetic-{size}px-{res}m-collar{collar}-seed{seed}"
+    raster = output_dir / f"{name}.tif"
+    polygons = output_dir / f"{name}-{count}shrubs-{clusters}clusters.gpkg"
+    if not raster.exists():
+        make_raster(raster, size, res=res, collar=collar, seed=seed)
+    if not polygons.exists():
+        make_polygons(
+            polygons, size, count, clusters, res=res, collar=collar, seed=seed
+        )
+    return str(raster), str(polygons)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Generate synthetic benchmark inputs")
+    parser.add_argument("--output-dir", required=True, help="Output directory")
+    parser.add_argument("--size", type=int, default=20000, help="Raster size in pixels")
+    parser.add_argument("--polygons", type=int, default=10000, help="Number of shrubs")
+    parser.add_argument("--clusters", type=int, default=50, help="Number of clusters")
+    parser.add_argument("--res", type=float, default=0.05, help="Pixel size in metres")
+    parser.add_argument(
+        "--collar", type=float, default=0.05, help="Nodata margin, fraction of size"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator")
+    args = parser.parse_args()
+    raster, polygons = make_inputs(
+        args.output_dir,
+        args.size,
+        args.polygons,
+        args.clusters,
+        res=args.res,
+        collar=args.collar,
+        seed=args.seed,
+    )
+    print(raster)
+    print(polygons)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from typing import Iterator
+
+import numpy as np
+from rasterio import Affine
+
+# Variants that can be derived from a patch: name -> (array view, pixel mapping). The
+# mapping takes pixel coordinates in the variant to pixel coordinates in the source patch
+# of the given width and height, so the variant's transform is transform * mapping.
+AUGMENTATIONS = {
+    "rot90": (
+        lambda a: np.rot90(a, 1, axes=(-2, -1)),
+        lambda w, h: Affine(0, -1, w, 1, 0, 0),
+    ),
+    "rot180": (
+        lambda a: np.rot90(a, 2, axes=(-2, -1)),
+        lambda w, h: Affine(-1, 0, w, 0, -1, h),
+    ),
+    "rot270": (
+        lambda a: np.rot90(a, 3, axes=(-2, -1)),
+        lambda w, h: Affine(0, 1, 0, -1, 0, h),
+    ),
+    "fliplr": (lambda a: a[..., ::-1], lambda w, h: Affine(-1, 0, w, 0, 1, 0)),
+    "flipud": (lambda a: a[..., ::-1, :], lambda w, h: Affine(1, 0, 0, 0, -1, h)),
+}
+
+
+def check_augmentations(augmentations) -> list:
+    """Return the augmentation names as a list, raising ValueError for unknown ones"""
+    unknown = [a for a in augmentations or [] if a not in AUGMENTATIONS]
+    if unknown:
+        raise ValueError(
+            f"Unknown augmentations {unknown}, expected some of {list(AUGMENTATIONS)}"
+        )
+    return list(augmentations or [])
+
+
+def variant_id(patch_id, name: str) -> str:
+    """Patch id of an augmented variant, e.g. "3.0-rot90" """
+    return f"{patch_id}-{name}"
+
+
+def source_id(patch_id: str) -> str:
+    """Patch id of the source of a variant id, or the id itself"""
+    base, _, name = str(patch_id).rpartition("-")
+    return base if base and name in AUGMENTATIONS else str(patch_id)
+
+
+def with_variants(patch_ids: list, augmentations: list) -> list:
+    """The patch ids followed by the ids of all their variants"""
+    return list(patch_ids) + [
+        variant_id(p, name) for name in augmentations for p in patch_ids
+    ]
+
+
+def augment_patch(
+    data: np.ndarray, label: np.ndarray, transform: Affine, augmentations: list
+) -> Iterator[tuple]:
+    """
+    Derive rotated and flipped variants of a patch from its arrays, without reading pixels.
+
+    The variants are views of `data` and `label`. Each gets the transform that keeps every
+    pixel at its place on the ground, so a rotated patch has a rotated transform.
+
+    Args:
+        data (np.ndarray): Pixels of the patch, (bands, rows, cols).
+        label (np.ndarray): Label of the patch, (rows, cols).
+        transform (Affine): Transform of the patch.
+        augmentations (list): Names from AUGMENTATIONS.
+
+    Yields:
+        tuple: (name, data view, label view, transform) of every variant.
+    """
+    height, width = label.shape
+    for name in augmentations:
+        view, mapping = AUGMENTATIONS[name]
+        yield name, view(data), view(label), transform * mapping(width, height)
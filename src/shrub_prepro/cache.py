@@ -0,0 +1,223 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import importlib.util
+from typing import Callable, Optional
+
+import geopandas as gpd
+
+from shrub_prepro.remote import get_s3_filesystem, is_remote
+
+# Files that belong to a shapefile and are fetched with it
+SHAPEFILE_SIDECARS = (".shx", ".dbf", ".prj", ".cpg")
+
+# Subdirectory of the cache holding the block cache of S3 rasters, see remote.RangeCache
+RANGES_DIR = "ranges"
+
+
+def _sidecars(path: str) -> list:
+    """Return the input path followed by the sidecar files that exist next to it"""
+    stem, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path]
+    exists = get_s3_filesystem().exists if is_remote(path) else os.path.exists
+    return [path] + [
+        f"{stem}{suffix}" for suffix in SHAPEFILE_SIDECARS if exists(f"{stem}{suffix}")
+    ]
+
+
+def fingerprint(path) -> str:
+    """
+    Identify the current version of an input and its sidecar files.
+
+    S3 objects are identified by ETag and size, local files by size and mtime.
+
+    Args:
+        path (str): Local path or s3:// URL.
+
+    Returns:
+        str: A string that changes whenever one of the files changes.
+    """
+    parts = []
+    for p in _sidecars(str(path)):
+        if is_remote(p):
+            info = get_s3_filesystem().info(p)
+            parts.append(f"{p}@{info.get('ETag', '')}:{info['size']}")
+        else:
+            stat = os.stat(p)
+            parts.append(f"{os.path.abspath(p)}@{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+
+class InputCache:
+    """
+    Persistent, content-addressed cache of input files and artifacts derived from them.
+
+    Entries are keyed by the input's fingerprint, so an unchanged input is served from the
+    cache and a changed one is fetched again. Remote inputs are downloaded once; derived
+    artifacts, such as the polygons as GeoParquet, are built once per input version. Once
+    the cache goes over `max_bytes`, the least recently used entries are removed, blocks
+    of the S3 range cache in `ranges_dir` included. Several processes can share one cache
+    directory. Counters are in `stats`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 20 * 1024 * 1024 * 1024):
+        """
+        Args:
+            cache_dir (str): Directory holding the cache.
+            max_bytes (int, optional): Size cap of the cache. Defaults to 20 GiB.
+        """
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.ranges_dir = os.path.join(self.cache_dir, RANGES_DIR)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "downloads": 0, "builds": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry(self, key: str, build: Callable[[str], None]) -> str:
+        """Return the directory of an entry, building it with build(directory) on a miss"""
+        entry = os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest())
+        if os.path.isdir(entry):
+            os.utime(entry)  # Mark as recently used
+            with self.lock:
+                self.stats["hits"] += 1
+            return entry
+
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        try:
+            build(tmp)
+            os.rename(tmp, entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+            # Another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=entry)
+        return entry
+
+    def fetch(self, path) -> str:
+        """
+        Return a local path for an input, downloading remote inputs on first use.
+
+        Shapefiles are fetched together with their sidecar files. Local inputs are
+        returned as they are.
+
+        Args:
+            path (str): Local path or s3:// URL.
+
+        Returns:
+            str: Path of an unchanged local copy of the input.
+        """
+        path = str(path)
+        if not is_remote(path):
+            return path
+
+        def download(directory):
+            fs = get_s3_filesystem()
+            for p in _sidecars(path):
+                fs.get_file(p, os.path.join(directory, os.path.basename(p)))
+            with self.lock:
+                self.stats["downloads"] += 1
+
+        entry = self._entry(f"fetch:{fingerprint(path)}", download)
+        return os.path.join(entry, os.path.basename(path))
+
+    def derived(self, path, name: str, build: Callable[[str], None]) -> str:
+        """
+        Return the path of an artifact derived from an input, building it on first use.
+
+        Args:
+            path (str): Local path or s3:// URL of the input.
+            name (str): File name of the artifact, unique per kind of artifact and its options.
+            build (Callable): build(out_path) writes the artifact to out_path.
+
+        Returns:
+            str: Path of the cached artifact.
+        """
+
+        def store(directory):
+            build(os.path.join(directory, name))
+            with self.lock:
+                self.stats["builds"] += 1
+
+        entry = self._entry(f"derived:{name}:{fingerprint(path)}", store)
+        return os.path.join(entry, name)
+
+    def read_polygons(self, path) -> gpd.GeoDataFrame:
+        """
+        Read a polygon file through the cache, stored as GeoParquet after the first read.
+
+        Without pyarrow the cached copy of the original file is read instead.
+
+        Args:
+            path (str): Local path or s3:// URL of any format geopandas reads.
+
+        Returns:
+            gpd.GeoDataFrame: The polygons.
+        """
+        if importlib.util.find_spec("pyarrow") is None:
+            return gpd.read_file(self.fetch(path))
+        parquet = self.derived(
+            path,
+            "polygons.parquet",
+            lambda out: gpd.read_file(self.fetch(path)).to_parquet(out),
+        )
+        return gpd.read_parquet(parquet)
+
+    def _range_blocks(self) -> list:
+        """(mtime, size, path) of every block of the S3 range cache in the cache directory"""
+        blocks = []
+        if not os.path.isdir(self.ranges_dir):
+            return blocks
+        for block in os.scandir(self.ranges_dir):
+            if block.name.endswith(".tmp"):
+                continue
+            try:
+                stat = block.stat()
+                blocks.append((stat.st_mtime, stat.st_size, block.path))
+            except FileNotFoundError:
+                pass  # Evicted by another process
+        return blocks
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Remove the least recently used entries and range blocks until the cache is within
+        its cap
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            # Entry directories are named by their key hash
+            if not entry.is_dir() or len(entry.name) != 64:
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except FileNotFoundError:
+                pass  # Evicted by another process
+        entries += self._range_blocks()
+        total = sum(size for _, size, _ in entries)
+        blocks = 0
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            if os.path.dirname(entry) == self.ranges_dir:
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+                blocks += 1
+            else:
+                shutil.rmtree(entry, ignore_errors=True)
+                logging.info(f"Evicted {entry} from the input cache")
+            total -= size
+        if blocks:
+            logging.info(f"Evicted {blocks} S3 range blocks from the input cache")
@@ -1,6 +1,7 @@
-from shrub_prepro.run_pipeline import main
 from dotenv import load_dotenv
 
+from shrub_prepro.run_pipeline import main, merge_main
+
 load_dotenv()
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import heapq
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+
+from shrub_prepro.images import window_bounds_array
+
+COVERAGE_METHODS = ("greedy", "grid")
+
+
+def _greedy_cover(windows: np.ndarray, shrubs: np.ndarray) -> np.ndarray:
+    """
+    Pick a small set of windows that covers every shrub, by greedy set cover.
+
+    Window i always counts as covering shrub i, its own shrub, so every shrub is covered.
+
+    Args:
+        windows (np.ndarray): Window boxes, one per shrub.
+        shrubs (np.ndarray): Bounding boxes of the shrubs, in the same order.
+
+    Returns:
+        np.ndarray: Sorted positions of the chosen windows.
+    """
+    n = len(windows)
+    pairs = shapely.STRtree(shrubs).query(windows, predicate="covers")
+    pairs = np.unique(
+        np.concatenate([pairs, np.stack([np.arange(n), np.arange(n)])], axis=1), axis=1
+    )
+    # Members of every window, as slices of the sorted pairs
+    starts = np.searchsorted(pairs[0], np.arange(n + 1))
+    members = pairs[1]
+
+    covered = np.zeros(n, dtype=bool)
+    chosen = []
+    # Lazy greedy: a window's count only goes down, so a popped count that is still
+    # current is the best one left. Ties go to the earlier window.
+    heap = [(-(starts[i + 1] - starts[i]), i) for i in range(n)]
+    heapq.heapify(heap)
+    while heap:
+        count, i = heapq.heappop(heap)
+        gain = np.count_nonzero(~covered[members[starts[i] : starts[i + 1]]])
+        if not gain:
+            continue
+        if gain < -count:
+            heapq.heappush(heap, (-gain, i))
+            continue
+        chosen.append(i)
+        covered[members[starts[i] : starts[i + 1]]] = True
+    return np.sort(np.array(chosen, dtype=np.int64))
+
+
+def _grid_cover(
+    candidates: pd.DataFrame, shrubs: np.ndarray, transform: rasterio.Affine
+) -> pd.DataFrame:
+    """
+    Snap the shrub windows to a grid of half-window cells, falling back to the own window.
+
+    Every occupied cell gets one window centred on it, which covers the shrubs whose bounds
+    fit inside. The other shrubs of the cell keep their own centred window.
+
+    Args:
+        candidates (pd.DataFrame): One centred plan row per shrub.
+        shrubs (np.ndarray): Bounding boxes of the shrubs, in the same order.
+        transform (rasterio.Affine): Transform of the raster the plan indexes into.
+
+    Returns:
+        pd.DataFrame: The plan rows of the cell windows and the remaining own windows.
+    """
+    size = candidates["size"].to_numpy()
+    cell = np.maximum(size // 2, 1)
+    # Centroid pixel of each shrub, the centre of its own window
+    centre_col = candidates.col_off.to_numpy() + size // 2
+    centre_row = candidates.row_off.to_numpy() + size // 2
+    cell_col = np.floor(centre_col / cell) * cell
+    cell_row = np.floor(centre_row / cell) * cell
+    # The window of the cell, with a quarter window of margin on every side
+    col_off = cell_col + cell / 2 - size // 2
+    row_off = cell_row + cell / 2 - size // 2
+    cell_windows = shapely.box(*window_bounds_array(col_off, row_off, size, transform))
+    fits = shapely.covers(cell_windows, shrubs)
+
+    # Each covered cell is named after its first shrub that fits
+    grouped = pd.DataFrame(
+        {"col": cell_col, "row": cell_row, "size": size, "fits": fits},
+        index=candidates.index,
+    )
+    first = grouped[fits].groupby(["col", "row", "size"], sort=False).head(1).index
+    snapped = candidates.loc[first].copy()
+    snapped["col_off"] = col_off[candidates.index.get_indexer(first)]
+    snapped["row_off"] = row_off[candidates.index.get_indexer(first)]
+    return pd.concat([snapped, candidates[~fits]]).sort_index()
+
+
+def plan_coverage(
+    plan: pd.DataFrame,
+    shrubs: gpd.GeoDataFrame,
+    image: rasterio.DatasetReader,
+    method: str = "greedy",
+) -> pd.DataFrame:
+    """
+    Drop near-duplicate shrub patches, keeping a set of windows that covers every shrub.
+
+    A shrub counts as covered by a window that holds its whole bounding box. Shrubs bigger
+    than a window keep their overlapping windows from plan_windows; they are labelled in any
+    window they reach but are not used to cover anything.
+
+    "greedy" picks from the centred windows of plan_windows by greedy set cover, so kept
+    patches keep their window and patch id. "grid" snaps shrubs to a grid of half-window
+    cells and writes one window per cell, centred on it, named after a shrub it covers;
+    shrubs that don't fit their cell window keep their own. The reduction in patches and
+    in uncompressed bytes is logged.
+
+    Args:
+        plan (pd.DataFrame): Shrub windows from plan_windows.
+        shrubs (gpd.GeoDataFrame): The shrub polygons the plan was made from.
+        image (rasterio.DatasetReader): The raster the windows index into.
+        method (str, optional): "greedy" or "grid". Defaults to "greedy".
+
+    Returns:
+        pd.DataFrame: The rows of `plan` that are kept, with moved windows for "grid".
+    """
+    if method not in COVERAGE_METHODS:
+        raise ValueError(
+            f"Unknown coverage method {method!r}, expected one of {COVERAGE_METHODS}"
+        )
+    if not len(plan):
+        return plan
+    # Shrubs with more than one window are bigger than a patch
+    single = (plan.groupby("shrub_id").shrub_id.transform("size") == 1).to_numpy()
+    candidates = plan[single]
+    bounds = shrubs.geometry.bounds.loc[candidates.shrub_id].to_numpy()
+    boxes = shapely.box(*bounds.T)
+
+    if method == "greedy":
+        windows = shapely.box(
+            *window_bounds_array(
+                candidates.col_off.to_numpy(),
+                candidates.row_off.to_numpy(),
+                candidates["size"].to_numpy(),
+                image.transform,
+            )
+        )
+        kept = candidates.iloc[_greedy_cover(windows, boxes)]
+    else:
+        kept = _grid_cover(candidates, boxes, image.transform)
+    reduced = pd.concat([plan[~single], kept]).sort_index().reset_index(drop=True)
+
+    # Uncompressed size of a patch: its image bands and a one-byte label
+    band_bytes = sum(np.dtype(d).itemsize for d in image.dtypes) + 1
+    saved = (plan["size"] ** 2).sum() - (reduced["size"] ** 2).sum()
+    logging.info(
+        f"Coverage planning ({method}) kept {len(reduced)} of {len(plan)} shrub patches, "
+        f"{len(plan) - len(reduced)} fewer, saving "
+        f"{saved * band_bytes / 1024**2:.1f} MiB before compression"
+    )
+    return reduced
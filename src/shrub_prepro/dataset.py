@@ -0,0 +1,157 @@
+import logging
+import sys
+from typing import Iterator, Optional
+
+import geopandas as gpd
+import pandas as pd
+import rasterio
+
+from shrub_prepro.coverage import plan_coverage
+from shrub_prepro.images import (
+    DEFAULT_BACKGROUND_BUFFER,
+    background_label,
+    background_samples,
+    label_patch_with_window,
+    plan_background,
+    plan_to_windows,
+    plan_windows,
+    shrub_labels_in_window,
+)
+from shrub_prepro.processing import select_shard, spatial_chunks
+from shrub_prepro.reads import DEFAULT_MAX_READ_BYTES, BlockCache
+from shrub_prepro.remote import configure_remote_access
+from shrub_prepro.stack import any_remote, input_paths, open_input
+
+
+def worker_info() -> tuple:
+    """
+    Return (index, count) of the data loader worker this runs in, (0, 1) outside of one.
+
+    PyTorch workers are recognised when torch has already been imported by the caller;
+    this module never imports it.
+    """
+    data = sys.modules.get("torch.utils.data")
+    info = data.get_worker_info() if data is not None else None
+    if info is None:
+        return 0, 1
+    return info.id, info.num_workers
+
+
+class ShrubPatchDataset:
+    """
+    Shrub and background patches generated in memory, for feeding a training loop directly.
+
+    The windows are planned once, as process_data plans them, and iterating yields
+    (image, label, transform) tuples: the (bands, size, size) pixels, the (size, size)
+    label with 255 over shrubs, and the window's affine transform. Patches come in
+    spatial order, read in batches through an LRU cache of raster tiles (see
+    reads.BlockCache), with windows past the raster edges padded with nodata.
+
+    Each iteration opens its own raster handle, so the dataset can be pickled into data
+    loader worker processes. Inside a worker, iteration only yields the worker's spatially
+    coherent share of the patches (see worker_info), so workers never repeat each other.
+
+    Args:
+        raster (str): Local or S3 path of the raster, or a list of rasters to stack, see
+            stack.open_input.
+        polygons: Shrub polygons, as a GeoDataFrame or a path geopandas can read.
+        window_size (int, optional): Size of the patches in pixels. Defaults to 512.
+        seed (int, optional): Seed for background sampling. Defaults to None.
+        background (bool, optional): Include background patches, twice as many as shrubs.
+            Defaults to True.
+        background_buffer (float, optional): Minimum distance between background patches
+            and shrubs, see images.background_samples. Defaults to 5.
+        coverage (str, optional): Thin the shrub patches, see coverage.plan_coverage.
+            Defaults to None.
+        shard (tuple, optional): (index, count) to serve only one spatial shard, before
+            splitting between workers. Defaults to None, all patches.
+        batch_size (int, optional): Windows read together. Defaults to 64.
+        cache_bytes (int, optional): Size cap of the tile cache. Defaults to 256 MiB.
+        remote_cache_dir (str, optional): On-disk block cache for an S3 raster, see
+            remote.open_cached. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        raster,
+        polygons,
+        window_size: int = 512,
+        seed: Optional[int] = None,
+        background: bool = True,
+        background_buffer: float = DEFAULT_BACKGROUND_BUFFER,
+        coverage: Optional[str] = None,
+        shard: Optional[tuple] = None,
+        batch_size: int = 64,
+        cache_bytes: int = DEFAULT_MAX_READ_BYTES,
+        remote_cache_dir: Optional[str] = None,
+    ):
+        self.raster = input_paths(raster)
+        self.shrubs = (
+            polygons
+            if isinstance(polygons, gpd.GeoDataFrame)
+            else gpd.read_file(polygons)
+        )
+        self.window_size = window_size
+        self.batch_size = batch_size
+        self.cache_bytes = cache_bytes
+        self.remote_cache_dir = remote_cache_dir
+        if any_remote(self.raster):
+            configure_remote_access()
+
+        with open_input(self.raster, remote_cache_dir) as image:
+            plan = plan_windows(self.shrubs, image, window_size)
+            if coverage:
+                plan = plan_coverage(plan, self.shrubs, image, method=coverage)
+            if background:
+                windows = background_samples(
+                    image,
+                    self.shrubs,
+                    window_size=window_size,
+                    within_df=True,
+                    seed=seed,
+                    buffer=background_buffer,
+                )
+                plan = pd.concat(
+                    [plan, plan_background(windows, start=len(self.shrubs))],
+                    ignore_index=True,
+                )
+        if shard is not None:
+            plan = select_shard(plan, *shard, strip=window_size)
+        self.plan = plan.reset_index(drop=True)
+        logging.info(
+            f"Planned {int(self.plan.positive.sum())} shrub and "
+            f"{int((~self.plan.positive).sum())} background patches"
+        )
+
+    def __len__(self) -> int:
+        return len(self.plan)
+
+    def __iter__(self) -> Iterator[tuple]:
+        plan = self.plan
+        index, count = worker_info()
+        if count > 1:
+            plan = select_shard(plan, index, count, strip=self.window_size)
+        if not len(plan):
+            return
+        plan = spatial_chunks(plan, 1, self.window_size)[0]
+        windows = plan_to_windows(plan)
+        positive = plan.positive.to_numpy()
+
+        with open_input(self.raster, self.remote_cache_dir) as image:
+            cache = BlockCache(image, self.cache_bytes)
+            for start in range(0, len(windows), self.batch_size):
+                batch = windows[start : start + self.batch_size]
+                for i, data in enumerate(cache.read(batch), start):
+                    window = windows[i]
+                    if positive[i]:
+                        labels = shrub_labels_in_window(self.shrubs, window, image)
+                        label = label_patch_with_window(labels, window, image)
+                    else:
+                        label = background_label(int(window.height))
+                    yield data, label, rasterio.windows.transform(
+                        window, image.transform
+                    )
+        logging.info(
+            f"Tile cache: {cache.hits} hits, {cache.misses} misses "
+            f"for {len(windows)} patches"
+        )
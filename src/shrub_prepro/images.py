@@ -3,13 +3,20 @@ import geopandas as gpd
 from rasterio.windows import Window, from_bounds
 from shapely.geometry import box
 from rasterio.features import rasterize
+from rasterio.transform import rowcol
 from rasterio.coords import BoundingBox
-import random
-from typing import Optional
+import shapely
+from typing import Optional, Union
 import numpy as np
 import pandas as pd
 import logging
 
+from shrub_prepro.mask import ValidMask
+from shrub_prepro.report import count
+
+# Default minimum distance between background windows and shrubs, in CRS units (metres)
+DEFAULT_BACKGROUND_BUFFER = 5
+
 
 def patch_window(
     geom: gpd.geoseries.GeoSeries, image: rasterio.DatasetReader, patch_size: int = 512
@@ -75,6 +82,109 @@ def shrub_overlaps(
     return windows
 
 
+def plan_windows(
+    shrubs: gpd.GeoDataFrame, image: rasterio.DatasetReader, window_size: int = 512
+) -> pd.DataFrame:
+    """
+    Plan every shrub patch window in bulk, before any pixels are read.
+
+    Gives the same windows as patch_window, or shrub_overlaps for shrubs bigger than the
+    patch (see is_shrub_huge), computed for all shrubs at once with NumPy.
+
+    Args:
+        shrubs (gpd.GeoDataFrame): The shrub polygons.
+        image (rasterio.DatasetReader): The raster image to index into.
+        window_size (int, optional): The size of the patches (in pixels). Defaults to 512.
+
+    Returns:
+        pd.DataFrame: One row per patch with columns patch_id ("{shrub_id}.{sub_index}"),
+            shrub_id, sub_index, col_off, row_off, size and positive (True).
+    """
+    n = len(shrubs)
+    if not n:
+        return plan_background([])
+    centroids = shrubs.geometry.centroid
+    rows, cols = rowcol(image.transform, centroids.x.to_numpy(), centroids.y.to_numpy())
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+
+    # Pixel extent of the shrub bounds, as in shrub_window
+    minx, miny, maxx, maxy = shrubs.geometry.bounds.to_numpy().T
+    corner_rows, corner_cols = rowcol(
+        image.transform,
+        np.concatenate([minx, maxx, maxx, minx]),
+        np.concatenate([maxy, maxy, miny, miny]),
+        op=float,
+    )
+    corner_rows = np.asarray(corner_rows, dtype=np.float64).reshape(4, n)
+    corner_cols = np.asarray(corner_cols, dtype=np.float64).reshape(4, n)
+    huge = (np.ptp(corner_rows, axis=0) > window_size) | (
+        np.ptp(corner_cols, axis=0) > window_size
+    )
+
+    # One centred window per shrub, or four overlapping ones for huge shrubs
+    half_patch = window_size // 2
+    shift = window_size * 0.75
+    counts = np.where(huge, 4, 1)
+    source = np.repeat(np.arange(n), counts)
+    sub_index = np.arange(len(source)) - np.repeat(np.cumsum(counts) - counts, counts)
+    col_off = np.where(
+        huge[source],
+        cols[source] - np.where(sub_index % 2 == 0, shift, 0),
+        cols[source] - half_patch,
+    )
+    row_off = np.where(
+        huge[source],
+        rows[source] - np.where(sub_index < 2, shift, 0),
+        rows[source] - half_patch,
+    )
+
+    shrub_id = shrubs.index.to_numpy()[source]
+    return pd.DataFrame(
+        {
+            "patch_id": [f"{s}.{i}" for s, i in zip(shrub_id, sub_index)],
+            "shrub_id": shrub_id,
+            "sub_index": sub_index,
+            "col_off": col_off.astype(np.float64),
+            "row_off": row_off.astype(np.float64),
+            "size": np.full(len(source), window_size, dtype=np.int64),
+            "positive": np.ones(len(source), dtype=bool),
+        }
+    )
+
+
+def plan_background(windows: list, start: int = 0) -> pd.DataFrame:
+    """
+    Plan rows for background windows, in the same layout as plan_windows.
+
+    Args:
+        windows (list): Square rasterio.windows.Window objects from background_samples.
+        start (int, optional): Index of the first background patch. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: One row per window, with patch_id "{start + i}", shrub_id and
+            sub_index -1 and positive False.
+    """
+    return pd.DataFrame(
+        {
+            "patch_id": [str(start + i) for i in range(len(windows))],
+            "shrub_id": np.full(len(windows), -1, dtype=np.int64),
+            "sub_index": np.full(len(windows), -1, dtype=np.int64),
+            "col_off": np.array([w.col_off for w in windows], dtype=np.float64),
+            "row_off": np.array([w.row_off for w in windows], dtype=np.float64),
+            "size": np.array([w.width for w in windows], dtype=np.int64),
+            "positive": np.zeros(len(windows), dtype=bool),
+        }
+    )
+
+
+def plan_to_windows(plan: pd.DataFrame) -> list:
+    """Return the rasterio.windows.Window of every row of a window plan"""
+    return [
+        Window(col, row, size, size)
+        for col, row, size in zip(plan.col_off, plan.row_off, plan["size"])
+    ]
+
+
 def shrub_labels_in_window(
     geometries: gpd.GeoSeries,
     window: rasterio.windows.Window,
@@ -83,6 +193,10 @@ def shrub_labels_in_window(
     """
     Compute the intersection between all shrub geometries and a given window within the image.
 
+    Only geometries returned by the spatial index of `geometries` are clipped. geopandas
+    builds that index on first use and caches it on the object, so passing the same
+    GeoSeries/GeoDataFrame for every window builds it once per run.
+
     Args:
         geometries (gpd.GeoSeries): Series of shrub geometries.
         window (rasterio.windows.Window): The window within the image to check for intersections.
@@ -93,7 +207,9 @@ def shrub_labels_in_window(
     """
     bounds = rasterio.windows.bounds(window, image.transform)
     bbox = box(*bounds)
-    s = geometries.intersection(bbox)
+    # Candidate positions, sorted to keep the original row order
+    candidates = np.sort(geometries.sindex.query(bbox, predicate="intersects"))
+    s = geometries.iloc[candidates].intersection(bbox)
     out_series = s[~(s.is_empty)]
     return out_series
 
@@ -123,20 +239,143 @@ def label_patch_with_window(
     return arr
 
 
+def _is_integer_window(window: rasterio.windows.Window) -> bool:
+    return not (
+        window.col_off % 1
+        or window.row_off % 1
+        or window.width % 1
+        or window.height % 1
+    )
+
+
+class LabelMosaic:
+    """
+    Shrub labels burnt once over a region covering many patch windows.
+
+    Per-patch labels are views into one rasterized array, with the same 255/0 values
+    label_patch_with_window gives for each window on its own.
+    """
+
+    def __init__(
+        self,
+        geometries: gpd.GeoSeries,
+        windows: list,
+        image: rasterio.DatasetReader,
+    ):
+        """
+        Args:
+            geometries (gpd.GeoSeries): Series of shrub geometries (or a GeoDataFrame).
+            windows (list): The patch windows the mosaic should serve.
+            image (rasterio.DatasetReader): The raster image (for georeferencing).
+        """
+        self.image = image
+        integer = [w for w in windows if _is_integer_window(w)]
+        self.window = None
+        if not integer:
+            return
+        col0 = int(min(w.col_off for w in integer))
+        row0 = int(min(w.row_off for w in integer))
+        col1 = int(max(w.col_off + w.width for w in integer))
+        row1 = int(max(w.row_off + w.height for w in integer))
+        self.window = Window(col0, row0, col1 - col0, row1 - row0)
+        bbox = box(*rasterio.windows.bounds(self.window, image.transform))
+        candidates = np.sort(geometries.sindex.query(bbox, predicate="intersects"))
+        self.array = label_patch_with_window(
+            geometries.iloc[candidates].geometry, self.window, image
+        )
+
+    def label(
+        self, labels: gpd.GeoSeries, window: rasterio.windows.Window
+    ) -> np.ndarray:
+        """
+        Return the label patch for one window.
+
+        Args:
+            labels (gpd.GeoSeries): The clipped labels from shrub_labels_in_window. When there
+                are none, or any of them isn't polygonal (a shrub only touching the window
+                edge), the window is rasterized on its own: lines burn differently to
+                polygons, and an empty rasterize gives a different dtype.
+            window (rasterio.windows.Window): A window this mosaic was built for.
+
+        Returns:
+            np.ndarray: The label patch as a 2D numpy array.
+        """
+        polygonal = labels.geom_type.isin(["Polygon", "MultiPolygon"]).all()
+        if (
+            self.window is None
+            or labels.empty
+            or not polygonal
+            or not _is_integer_window(window)
+        ):
+            return label_patch_with_window(labels, window, self.image)
+        row = int(window.row_off - self.window.row_off)
+        col = int(window.col_off - self.window.col_off)
+        return self.array[row : row + int(window.height), col : col + int(window.width)]
+
+
+def window_bounds_array(
+    col_off: np.ndarray,
+    row_off: np.ndarray,
+    size: int,
+    transform: rasterio.Affine,
+) -> tuple:
+    """
+    Vectorized equivalent of rasterio.windows.bounds for many square windows.
+
+    Args:
+        col_off (np.ndarray): Column offsets of the windows.
+        row_off (np.ndarray): Row offsets of the windows.
+        size (int): Height and width of the windows in pixels.
+        transform (rasterio.Affine): Transform of the source raster.
+
+    Returns:
+        tuple: Arrays of (left, bottom, right, top) in the raster CRS.
+    """
+    x0, y0 = transform * (col_off, row_off)
+    x1, y1 = transform * (col_off + size, row_off + size)
+    return (
+        np.minimum(x0, x1),
+        np.minimum(y0, y1),
+        np.maximum(x0, x1),
+        np.maximum(y0, y1),
+    )
+
+
 def background_samples(
     image: rasterio.io.DatasetReader,
     shrubs: gpd.GeoDataFrame,
     window_size: int = 512,
     within_df: Optional[list] = False,
+    seed: Optional[Union[int, np.random.SeedSequence]] = None,
+    batch_size: int = 4096,
+    valid_mask: Optional[ValidMask] = None,
+    bounds: Optional[tuple] = None,
+    num_samples: Optional[int] = None,
+    buffer: float = DEFAULT_BACKGROUND_BUFFER,
 ) -> list:
     """
     Generate negative samples (background patches) from the image that do not overlap with shrub polygons.
 
+    Candidates are drawn in batches as NumPy arrays. Out-of-bounds and overlapping windows
+    are rejected in bulk, and pixels are only read for the windows that survive those checks.
+    With a `valid_mask`, centres are only drawn from valid cells, windows must cover valid
+    cells only, and no pixels are read at all.
+
     Parameters:
         image (rasterio.io.DatasetReader): Opened rasterio dataset of the image.
         shrubs (gpd.GeoDataFrame): GeoDataFrame containing shrub polygons.
         window_size (int): Optional, defaults to 512
         within_df: (bool): Optional, default False - only sample the image within the bounds of the dataframe
+        seed (int or np.random.SeedSequence): Optional seed for the random generator, for
+            reproducible runs; a SeedSequence such as SeedSequence([seed, tile]) gives
+            independent streams to several calls
+        batch_size (int): Optional, number of candidate windows drawn per batch. Defaults to 4096.
+        valid_mask (ValidMask): Optional coarse valid-data mask of the image, see shrub_prepro.mask
+        bounds (tuple): Optional (left, bottom, right, top) to sample window centres from, instead
+            of the image or dataframe bounds
+        num_samples (int): Optional number of windows to draw. Defaults to twice the shrubs.
+        buffer (float): Optional minimum distance between a window and any shrub, in CRS units.
+            Defaults to 5, meant for metres; use a much smaller value for a CRS in degrees.
 
     Returns:
         list: List of rasterio.windows.Window objects representing negative samples.
@@ -148,91 +387,115 @@ def background_samples(
     # If we're limiting our view to the annotated area, replace the bounding box
     if within_df:
         img_bounds = BoundingBox(*shrubs.total_bounds.tolist())
-
-    # Buffer the shrub polygons slightly to ensure negative windows don't touch them
-    shrub_buffer = shrubs.copy()
-    # Adjust buffer distance based on your data's CRS units.
-    # If it's meters, a small buffer like 1-5 meters is reasonable.
-    # If it's degrees, you might need a smaller value or reproject.
-    # Assuming CRS is in meters based on the previous context, buffer by 5 meters.
-    try:
-        shrub_buffer["geometry"] = shrub_buffer.geometry.buffer(5)
-    except Exception as e:
-        logging.info(
-            f"Could not buffer polygons, likely due to CRS or geometry issues: {e}"
-        )
-        logging.info("Proceeding without buffering, this might lead to minor overlaps.")
-        shrub_buffer = shrubs  # Use original shrubs if buffering fails
-
-    shrub_union = shrub_buffer.unary_union
+    if bounds is not None:
+        img_bounds = BoundingBox(*bounds)
 
     # Determine the number of negative samples to generate
     num_positive_samples = len(shrubs)
     num_negative_samples = num_positive_samples * 2  # Adjust this ratio as needed
+    if num_samples is not None:
+        num_negative_samples = num_samples
 
     negative_windows = []  # Set up a list of empty patches
 
-    # Generate random points within the image bounds until we have enough negative windows
-    logging.info(f"Attempting to generate {num_negative_samples} negative windows...")
-    logging.info(f"Attempting to generate {num_negative_samples} negative windows...")
+    rng = np.random.default_rng(seed)
+    inverse = ~image.transform
+    half_patch = window_size // 2
     attempts = 0
     max_attempts = num_negative_samples * 10  # Limit attempts to avoid infinite loops
 
-    while len(negative_windows) < num_negative_samples and attempts < max_attempts:
-        # Generate a random point within the image bounds
-        rand_x = random.uniform(img_bounds.left, img_bounds.right)
-        rand_y = random.uniform(img_bounds.bottom, img_bounds.top)
-
-        # Convert random coordinates to pixel row and column
-        try:
-            row, col = image.index(rand_x, rand_y)
-        except rasterio.errors.CRSError:
-            # This can happen if the coordinates are slightly outside valid range due to float precision
-            attempts += 1
-            continue
-        except Exception as e:
-            logging.info(f"Error converting coordinates to index: {e}")
-            attempts += 1
-            continue
-
-        # Create a potential window centered at the random point
-        half_patch = window_size // 2
-        potential_window = Window(
-            col - half_patch, row - half_patch, window_size, window_size
+    # Pixel extent of the sampling bounds
+    corner_cols, corner_rows = inverse * (
+        np.array([img_bounds.left, img_bounds.right]),
+        np.array([img_bounds.top, img_bounds.bottom]),
+    )
+    col_lo, col_hi = corner_cols.min(), corner_cols.max()
+    row_lo, row_hi = corner_rows.min(), corner_rows.max()
+
+    if valid_mask is not None:
+        # Candidate centres come only from valid cells overlapping the sampling bounds
+        cell = valid_mask.cell_size
+        cell_rows, cell_cols = np.nonzero(valid_mask.cells)
+        overlap = (
+            (cell_cols * cell < col_hi)
+            & ((cell_cols + 1) * cell > col_lo)
+            & (cell_rows * cell < row_hi)
+            & ((cell_rows + 1) * cell > row_lo)
         )
+        cell_rows, cell_cols = cell_rows[overlap], cell_cols[overlap]
+        if not len(cell_rows):
+            logging.info("No valid cells to sample background windows from")
+            return negative_windows
 
-        # Calculate the geographic bounds of the potential window
-        window_bounds = rasterio.windows.bounds(potential_window, image.transform)
-        window_bbox = box(*window_bounds)
-
-        # Check if the potential window is entirely within the image bounds
-        if not box(*image.bounds).contains(window_bbox):
-            attempts += 1
-            continue
-
-        # Check if the potential window overlaps with any shrub polygon (or buffer)
-        # Convert the window bbox to a GeoDataFrame for intersection check
-        window_gdf = gpd.GeoDataFrame([1], geometry=[window_bbox], crs=image.crs)
-
-        # Perform the intersection check
-        if shrub_union is not None:
-            overlap = window_gdf.iloc[0].geometry.intersects(shrub_union)
+    while len(negative_windows) < num_negative_samples and attempts < max_attempts:
+        n = min(batch_size, max_attempts - attempts)
+        attempts += n
+        count("background_candidates", n)
+
+        # Random centre points within the sampling bounds, converted to pixel offsets
+        if valid_mask is None:
+            rand_x = rng.uniform(img_bounds.left, img_bounds.right, n)
+            rand_y = rng.uniform(img_bounds.bottom, img_bounds.top, n)
+            cols, rows = inverse * (rand_x, rand_y)
         else:
-            # No shrubs, no overlap to check
-            overlap = False
-
-        # If there is no overlap, add the window to our list
-        if overlap:
-            attempts += 1
+            pick = rng.integers(len(cell_rows), size=n)
+            cols = (cell_cols[pick] + rng.random(n)) * cell
+            rows = (cell_rows[pick] + rng.random(n)) * cell
+            within = (
+                (cols >= col_lo) & (cols < col_hi) & (rows >= row_lo) & (rows < row_hi)
+            )
+            cols, rows = cols[within], rows[within]
+        col_off = np.floor(cols).astype(np.int64) - half_patch
+        row_off = np.floor(rows).astype(np.int64) - half_patch
+
+        # Keep only windows entirely within the image
+        inside = (
+            (col_off >= 0)
+            & (row_off >= 0)
+            & (col_off + window_size <= image.width)
+            & (row_off + window_size <= image.height)
+        )
+        col_off, row_off = col_off[inside], row_off[inside]
+        if valid_mask is not None:
+            valid = valid_mask.windows_valid(col_off, row_off, window_size)
+            col_off, row_off = col_off[valid], row_off[valid]
+        count("background_outside", n - len(col_off))
+        if not len(col_off):
             continue
 
-        # Check for more than one distinct pixel value - a lot of our image is nodata
-        window_data = image.read(window=potential_window)
-
-        if len(np.unique(window_data)) > 1:
-            negative_windows.append(potential_window)
-
-        attempts += 1
+        # Reject every window within `buffer` of a shrub in one index distance query,
+        # without buffering the shrubs
+        candidates = shapely.box(
+            *window_bounds_array(col_off, row_off, window_size, image.transform)
+        )
+        if buffer > 0:
+            hits, _ = shrubs.sindex.query(
+                candidates, predicate="dwithin", distance=buffer
+            )
+        else:
+            hits, _ = shrubs.sindex.query(candidates, predicate="intersects")
+        clear = np.ones(len(candidates), dtype=bool)
+        clear[hits] = False
+        count("background_near_shrubs", int((~clear).sum()))
+
+        for col, row in zip(col_off[clear], row_off[clear]):
+            potential_window = Window(int(col), int(row), window_size, window_size)
+            # Check for more than one distinct pixel value - a lot of our image is nodata
+            # The valid-data mask already guarantees this without reading the window
+            if valid_mask is not None or (
+                len(np.unique(image.read(window=potential_window))) > 1
+            ):
+                negative_windows.append(potential_window)
+                count("background_accepted")
+                if len(negative_windows) == num_negative_samples:
+                    break
+            else:
+                count("background_nodata")
+
+    logging.info(
+        f"Generated {len(negative_windows)} of {num_negative_samples} negative windows "
+        f"from {attempts} candidates"
+    )
     return negative_windows
 
 
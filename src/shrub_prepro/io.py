@@ -1,13 +1,18 @@
 import os
-import s3fs
+import glob
+import shutil
+import importlib.util
 import rasterio
 import numpy as np
-from typing import Any
+import pandas as pd
+from typing import Any, Optional
+
+from shrub_prepro.remote import get_s3_filesystem
 
 
 def get_s3_file(s3_path):
     """
-    Open a file from S3 using s3fs.
+    Open a file from S3 using the shared s3fs filesystem.
 
     Args:
         s3_path (str): S3 path in format 's3://bucket/path/to/file'
@@ -15,8 +20,7 @@ def get_s3_file(s3_path):
     Returns:
         file-like object
     """
-    fs = s3fs.S3FileSystem(anon=False)
-    return fs.open(s3_path, "rb")
+    return get_s3_filesystem().open(s3_path, "rb")
 
 
 def save_label_patch(
@@ -26,6 +30,7 @@ def save_label_patch(
     index: Any,
     label: str = "shrubs",
     directory: str = "labels",
+    transform: Optional[rasterio.Affine] = None,
 ) -> None:
     """
     Save a single-channel label patch as a GeoTIFF file.
@@ -37,20 +42,19 @@ def save_label_patch(
         index (int): Index for naming the output file.
         label (str, optional): Prefix label for the output filename. Defaults to 'shrubs'.
         dir (str, optional): Directory to save the label patch. Defaults to 'labels'.
+        transform (rasterio.Affine, optional): Transform of the patch, e.g. of a rotated
+            variant. Defaults to the transform of the window.
 
     Returns:
         None
     """
-    transform = rasterio.windows.transform(window, image.transform)
     meta = image.meta.copy()
-    meta.update(
-        {
-            "height": window.height,
-            "width": window.width,
-            "transform": transform,
-            "count": 1,
-        }
-    )
+    if transform is None:
+        transform = rasterio.windows.transform(window, image.transform)
+        meta.update({"height": window.height, "width": window.width})
+    else:
+        meta.update({"height": data.shape[0], "width": data.shape[1]})
+    meta.update({"driver": "GTiff", "transform": transform, "count": 1})
 
     original_path = os.path.join(directory, f"{label}_{index}.tif")
     with rasterio.open(original_path, "w", **meta) as dst:
@@ -63,6 +67,8 @@ def save_image_patch(
     index: int,
     label: str = "shrubs",
     directory: str = "images",
+    data: Optional[np.ndarray] = None,
+    transform: Optional[rasterio.Affine] = None,
 ) -> rasterio.DatasetReader:
     """
     Save a multi-channel image patch as a GeoTIFF file.
@@ -73,23 +79,299 @@ def save_image_patch(
         index (int): Index for naming the output file.
         label (str, optional): Prefix label for the output filename. Defaults to 'shrubs'.
         dir (str, optional): Directory to save the image patch. Defaults to 'images'.
+        data (np.ndarray, optional): Pixels already read for this window, e.g. by
+            shrub_prepro.reads.grouped_reads. Read from the image when omitted.
+        transform (rasterio.Affine, optional): Transform of the patch, e.g. of a rotated
+            variant. Defaults to the transform of the window.
 
     Returns:
         None
     """
     # Extract the image data for the current patch
-    image_patch = image.read(window=window)
-    # Save the original window
-    transform = rasterio.windows.transform(window, image.transform)
+    image_patch = image.read(window=window) if data is None else data
     meta = image.meta.copy()
-    meta.update(
-        {
-            "height": window.height,
-            "width": window.width,
-            "transform": transform,
-        }
-    )
+    if transform is None:
+        # Save the original window
+        transform = rasterio.windows.transform(window, image.transform)
+        meta.update({"height": window.height, "width": window.width})
+    else:
+        meta.update({"height": image_patch.shape[1], "width": image_patch.shape[2]})
+    # Patches are GeoTIFFs whatever the driver of the source, e.g. a mosaic VRT
+    meta.update({"driver": "GTiff", "transform": transform})
 
     original_path = os.path.join(directory, f"{label}_{index}.tif")
     with rasterio.open(original_path, "w", **meta) as dst:
         dst.write(image_patch)
+
+
+def pad_to_window(
+    data: np.ndarray, window: rasterio.windows.Window, image: rasterio.DatasetReader
+) -> np.ndarray:
+    """Pad pixels cropped at the raster edge back to the full window with nodata (or 0)"""
+    height, width = int(window.height), int(window.width)
+    if data.shape[1:] == (height, width):
+        return data
+    full = np.full((data.shape[0], height, width), image.nodata or 0, dtype=data.dtype)
+    row = max(0, -int(window.row_off))
+    col = max(0, -int(window.col_off))
+    full[:, row : row + data.shape[1], col : col + data.shape[2]] = data
+    return full
+
+
+class GeoTiffWriter:
+    """
+    Output backend writing each patch as a pair of GeoTIFFs, {label}_{patch_id}.tif
+    in the images/ and labels/ folders of the output directory, or of its train/ or
+    test/ folder when the patch has a split. Each patch is recorded in the optional
+    `completion` log (see shrub_prepro.runs.CompletionLog) once both files are written.
+    """
+
+    # Every patch goes to its own files, so writes can run on several threads
+    thread_safe = True
+
+    def __init__(
+        self,
+        output_dir: str,
+        label: str = "shrubs",
+        part: str = "0",
+        completion: Optional[Any] = None,
+    ):
+        """
+        Args:
+            output_dir (str): Output directory.
+            label (str, optional): Prefix of the patch filenames. Defaults to 'shrubs'.
+            part (str, optional): Unused, as patch files are named by patch id alone.
+                Accepted so make_writer can create every backend alike. Defaults to '0'.
+            completion (CompletionLog, optional): Log of the written patches. Defaults to None.
+        """
+        self.output_dir = output_dir
+        self.label = label
+        self.completion = completion
+
+    def _directories(self, split: Optional[str]) -> tuple:
+        base = os.path.join(self.output_dir, split) if split else self.output_dir
+        images_dir = os.path.join(base, "images")
+        labels_dir = os.path.join(base, "labels")
+        os.makedirs(images_dir, exist_ok=True)
+        os.makedirs(labels_dir, exist_ok=True)
+        return images_dir, labels_dir
+
+    def write(
+        self,
+        patch_id: Any,
+        window: rasterio.windows.Window,
+        image: rasterio.DatasetReader,
+        data: np.ndarray,
+        label_patch: np.ndarray,
+        shrub_id: int = -1,
+        split: Optional[str] = None,
+        transform: Optional[rasterio.Affine] = None,
+    ) -> None:
+        """
+        Write the image and label of one patch.
+
+        Args:
+            patch_id: Index for naming the output files.
+            window (rasterio.windows.Window): The window in the source image.
+            image (rasterio.DatasetReader): The source rasterio image object (for metadata).
+            data (np.ndarray): The pixels read for the window.
+            label_patch (np.ndarray): The 2D label array.
+            shrub_id (int, optional): Source shrub of the patch, -1 for background. Unused here.
+            split (str, optional): "train" or "test" to write into that folder. Defaults to None.
+            transform (rasterio.Affine, optional): Transform of an augmented variant of the
+                window's patch. Defaults to the transform of the window.
+        """
+        images_dir, labels_dir = self._directories(split)
+        save_image_patch(
+            window, image, patch_id, self.label, images_dir, data, transform
+        )
+        save_label_patch(
+            label_patch, window, image, patch_id, self.label, labels_dir, transform
+        )
+        if self.completion is not None:
+            self.completion.record([patch_id])
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardWriter:
+    """
+    Output backend writing patches into NPY shards with a Parquet manifest.
+
+    Images go to shards/{label}_{part}_{n}_images.npy as (patches, bands, rows, cols) and
+    labels to the matching _labels.npy as (patches, rows, cols) uint8. Every shard gets
+    its manifest rows in manifest_parts/{shard}.parquet; merge_manifests combines the
+    parts into manifest.parquet once every writer is closed. The patches of a shard are
+    recorded in the optional `completion` log once the shard and its rows are written.
+
+    Patches cropped at the raster edge are padded back to the full window with the
+    raster nodata value (or 0), so every patch in a shard has the same shape.
+    """
+
+    thread_safe = False
+
+    def __init__(
+        self,
+        output_dir: str,
+        label: str = "shrubs",
+        part: str = "0",
+        completion: Optional[Any] = None,
+        shard_size: int = 256,
+    ):
+        """
+        Args:
+            output_dir (str): Output directory.
+            label (str, optional): Prefix of the shard filenames. Defaults to 'shrubs'.
+            part (str, optional): Name of this writer, unique among all writers to the
+                directory, including those of earlier runs. Defaults to '0'.
+            completion (CompletionLog, optional): Log of the written patches. Defaults to None.
+            shard_size (int, optional): Patches per shard. Defaults to 256.
+        """
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ImportError(
+                "The npy output format needs pyarrow for its Parquet manifest: "
+                "pip install 'shrub-prepro[shards]'"
+            )
+        self.output_dir = output_dir
+        self.label = label
+        self.part = part
+        self.shard_size = shard_size
+        self.completion = completion
+        self.shards_dir = os.path.join(output_dir, "shards")
+        os.makedirs(self.shards_dir, exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "manifest_parts"), exist_ok=True)
+        self.shard = 0
+        self.images = []
+        self.labels = []
+        self.rows = []
+
+    def _shard_name(self) -> str:
+        return f"{self.label}_{self.part}_{self.shard:05d}"
+
+    def write(
+        self,
+        patch_id: Any,
+        window: rasterio.windows.Window,
+        image: rasterio.DatasetReader,
+        data: np.ndarray,
+        label_patch: np.ndarray,
+        shrub_id: int = -1,
+        split: Optional[str] = None,
+        transform: Optional[rasterio.Affine] = None,
+    ) -> None:
+        """
+        Add one patch to the current shard, see GeoTiffWriter.write for the arguments.
+        The split is only recorded in the manifest.
+        """
+        data = pad_to_window(data, window, image)
+        if transform is None:
+            transform = rasterio.windows.transform(window, image.transform)
+        bounds = rasterio.windows.bounds(window, image.transform)
+        self.rows.append(
+            {
+                "patch_id": str(patch_id),
+                "shard": self._shard_name(),
+                "offset": len(self.images),
+                "shrub_id": shrub_id,
+                "split": split,
+                "transform": list(transform)[:6],
+                "crs": image.crs.to_wkt() if image.crs else None,
+                "minx": bounds[0],
+                "miny": bounds[1],
+                "maxx": bounds[2],
+                "maxy": bounds[3],
+            }
+        )
+        self.images.append(data)
+        self.labels.append(label_patch.astype(np.uint8, copy=False))
+        if len(self.images) == self.shard_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self.images:
+            return
+        name = self._shard_name()
+        np.save(
+            os.path.join(self.shards_dir, f"{name}_images.npy"), np.stack(self.images)
+        )
+        np.save(
+            os.path.join(self.shards_dir, f"{name}_labels.npy"), np.stack(self.labels)
+        )
+        pd.DataFrame(self.rows).to_parquet(
+            os.path.join(self.output_dir, "manifest_parts", f"{name}.parquet")
+        )
+        if self.completion is not None:
+            self.completion.record([row["patch_id"] for row in self.rows])
+        self.images, self.labels, self.rows = [], [], []
+        self.shard += 1
+
+    def close(self) -> None:
+        """Write the last partial shard"""
+        self._flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_manifests(output_dir: str, patch_ids: Optional[list] = None) -> pd.DataFrame:
+    """
+    Combine the manifest parts written by ShardWriter into output_dir/manifest.parquet.
+
+    Rows of an existing manifest.parquet are kept, so a resumed run adds to it. When a
+    patch was written more than once, its newest row wins.
+
+    Args:
+        output_dir (str): Output directory the writers wrote to.
+        patch_ids (list, optional): Only keep rows of these patches. Defaults to None, all.
+
+    Returns:
+        pd.DataFrame: The merged manifest, one row per patch.
+    """
+    parts_dir = os.path.join(output_dir, "manifest_parts")
+    parts = sorted(
+        glob.glob(os.path.join(parts_dir, "*.parquet")), key=os.path.getmtime
+    )
+    path = os.path.join(output_dir, "manifest.parquet")
+    if os.path.exists(path):
+        parts.insert(0, path)
+    manifest = pd.concat(
+        [pd.DataFrame()] + [pd.read_parquet(p) for p in parts], ignore_index=True
+    )
+    if len(manifest):
+        manifest = manifest.drop_duplicates("patch_id", keep="last")
+        if patch_ids is not None:
+            manifest = manifest[manifest.patch_id.isin(patch_ids)]
+        manifest = manifest.reset_index(drop=True)
+    manifest.to_parquet(path)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return manifest
+
+
+OUTPUT_FORMATS = {"geotiff": GeoTiffWriter, "npy": ShardWriter}
+
+
+def make_writer(
+    output_format: str,
+    output_dir: str,
+    label: str,
+    part: str = "0",
+    completion: Optional[Any] = None,
+):
+    """Return the output backend for `output_format`, one of OUTPUT_FORMATS"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, expected one of {list(OUTPUT_FORMATS)}"
+        )
+    return OUTPUT_FORMATS[output_format](
+        output_dir, label=label, part=part, completion=completion
+    )
@@ -0,0 +1,171 @@
+import os
+import logging
+from typing import NamedTuple, Optional
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+from rasterio.windows import Window
+
+
+class ValidMask(NamedTuple):
+    """
+    Coarse valid-data mask of a raster.
+
+    Attributes:
+        cells (np.ndarray): 2D boolean array, True where every pixel in the cell is valid.
+        cell_size (int): Height and width of one cell in raster pixels.
+    """
+
+    cells: np.ndarray
+    cell_size: int
+
+    def windows_valid(
+        self, col_off: np.ndarray, row_off: np.ndarray, size: int
+    ) -> np.ndarray:
+        """
+        Check whether square windows only cover valid cells.
+
+        Windows are expected to lie within the raster, as the background sampler guarantees.
+
+        Args:
+            col_off (np.ndarray): Column offsets of the windows, in pixels.
+            row_off (np.ndarray): Row offsets of the windows, in pixels.
+            size (int): Height and width of the windows in pixels.
+
+        Returns:
+            np.ndarray: Boolean array, True for windows made only of valid pixels.
+        """
+        # Summed-area table of invalid cells, so each window is a four-term lookup
+        invalid = np.pad((~self.cells).astype(np.int64), ((1, 0), (1, 0)))
+        table = invalid.cumsum(axis=0).cumsum(axis=1)
+        c0 = np.asarray(col_off) // self.cell_size
+        r0 = np.asarray(row_off) // self.cell_size
+        c1 = (np.asarray(col_off) + size - 1) // self.cell_size + 1
+        r1 = (np.asarray(row_off) + size - 1) // self.cell_size + 1
+        count = table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+        return count == 0
+
+
+def has_nodata_mask(image: rasterio.DatasetReader) -> bool:
+    """Return True if the raster declares nodata, an internal mask or an alpha band"""
+    return any(MaskFlags.all_valid not in flags for flags in image.mask_flag_enums)
+
+
+def build_valid_mask(
+    image: rasterio.DatasetReader, cell_size: int = 64, use_overviews: bool = False
+) -> ValidMask:
+    """
+    Build a coarse valid-data mask from the dataset mask.
+
+    By default the full-resolution mask is read in strips aligned to the raster blocks, so
+    a cell is only marked valid when every pixel in it is valid. With `use_overviews`, the
+    mask is read once at a reduced resolution (GDAL picks an overview if there is one) and
+    eroded by one cell to stay conservative.
+
+    Args:
+        image (rasterio.DatasetReader): The raster to build the mask for.
+        cell_size (int, optional): Cell size in pixels. Defaults to 64.
+        use_overviews (bool, optional): Read a decimated mask instead of the full one. Defaults to False.
+
+    Returns:
+        ValidMask: The coarse mask.
+    """
+    n_rows = -(-image.height // cell_size)
+    n_cols = -(-image.width // cell_size)
+
+    if use_overviews:
+        factor = 4
+        mask = image.dataset_mask(out_shape=(n_rows * factor, n_cols * factor))
+        cells = mask.reshape(n_rows, factor, n_cols, factor).min(axis=(1, 3)) > 0
+        # Erode by one cell, treating the outside of the raster as valid
+        padded = np.pad(cells, 1, constant_values=True)
+        eroded = cells.copy()
+        for dr in (0, 1, 2):
+            for dc in (0, 1, 2):
+                eroded &= padded[dr : dr + n_rows, dc : dc + n_cols]
+        return ValidMask(eroded, cell_size)
+
+    # Read strips that span whole block rows, so each block is decoded once
+    block_height = image.block_shapes[0][0]
+    strip = cell_size * max(1, block_height // cell_size)
+    cells = np.zeros((n_rows, n_cols), dtype=bool)
+    for row_off in range(0, image.height, strip):
+        height = min(strip, image.height - row_off)
+        mask = image.dataset_mask(window=Window(0, row_off, image.width, height))
+        # Pixels past the raster edge count as valid; windows never reach them
+        rows = -(-height // cell_size)
+        padded = np.full((rows * cell_size, n_cols * cell_size), 255, dtype=np.uint8)
+        padded[:height, : image.width] = mask
+        first = row_off // cell_size
+        cells[first : first + rows] = (
+            padded.reshape(rows, cell_size, n_cols, cell_size).min(axis=(1, 3)) > 0
+        )
+    return ValidMask(cells, cell_size)
+
+
+def valid_mask_path(raster_path: str) -> str:
+    """Return the path of the cached valid-data mask that sits next to a raster"""
+    return f"{raster_path}.validmask.npz"
+
+
+def load_or_build_valid_mask(
+    image: rasterio.DatasetReader,
+    raster_path: Optional[str] = None,
+    cell_size: int = 64,
+    use_overviews: bool = False,
+    input_cache=None,
+) -> ValidMask:
+    """
+    Load the cached valid-data mask for a raster, or build and cache it.
+
+    Local rasters get the cache next to them. It is rebuilt when the raster size, mtime,
+    shape, transform or the cell size differ from the cached copy. Masks of remote rasters
+    are kept in `input_cache` when one is given.
+
+    Args:
+        image (rasterio.DatasetReader): The opened raster.
+        raster_path (str, optional): Path of the raster, used to locate the cache. Defaults to image.name.
+        cell_size (int, optional): Cell size in pixels. Defaults to 64.
+        use_overviews (bool, optional): Passed to build_valid_mask. Defaults to False.
+        input_cache (InputCache, optional): Cache for the masks of remote rasters. Defaults to None.
+
+    Returns:
+        ValidMask: The coarse mask.
+    """
+    raster_path = str(raster_path or image.name)
+    if not os.path.isfile(raster_path):
+        if input_cache is None:
+            return build_valid_mask(image, cell_size, use_overviews)
+        name = f"validmask-{cell_size}{'-overviews' if use_overviews else ''}.npz"
+        cache_path = input_cache.derived(
+            raster_path,
+            name,
+            lambda out: np.savez_compressed(
+                out, cells=build_valid_mask(image, cell_size, use_overviews).cells
+            ),
+        )
+        with np.load(cache_path) as cached:
+            return ValidMask(cached["cells"], cell_size)
+
+    stat = os.stat(raster_path)
+    key = np.array(
+        [stat.st_size, stat.st_mtime, image.width, image.height, cell_size]
+        + list(image.transform)[:6],
+        dtype=np.float64,
+    )
+    cache_path = valid_mask_path(raster_path)
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cached:
+                if np.array_equal(cached["key"], key):
+                    return ValidMask(cached["cells"], cell_size)
+        except (OSError, KeyError, ValueError) as e:
+            logging.info(f"Ignoring unreadable valid-data mask {cache_path}: {e}")
+
+    valid_mask = build_valid_mask(image, cell_size, use_overviews)
+    try:
+        np.savez_compressed(cache_path, cells=valid_mask.cells, key=key)
+    except OSError as e:
+        logging.info(f"Could not cache valid-data mask next to the raster: {e}")
+    return valid_mask
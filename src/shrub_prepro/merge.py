@@ -0,0 +1,170 @@
+import os
+import itertools
+import json
+import shutil
+import logging
+from typing import Optional
+
+import pandas as pd
+
+from shrub_prepro.augment import source_id, variant_id
+from shrub_prepro.runs import done_dir, load_run
+from shrub_prepro.split import assign_split, log_gap
+from shrub_prepro.stats import PatchStats, read_stats_lines
+
+
+def _move(source: str, destination: str) -> None:
+    """Move a file, tolerating a merge that is run again after moving it"""
+    if os.path.exists(source):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(source, destination)
+    elif not os.path.exists(destination):
+        raise FileNotFoundError(source)
+
+
+def merge_shards(
+    shard_dirs: list,
+    output_dir: str,
+    split_mode: Optional[str] = None,
+    split_block_size: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Combine the outputs of a sharded run and split them into train and test once.
+
+    Every shard of the run must be present and complete. The train/test split is assigned
+    over the union of the shard plans, exactly as an unsharded run would assign it, and the
+    outputs are moved into the train/ and test/ folders of output_dir (GeoTIFF) or into
+    output_dir/shards with one manifest.parquet (NPY). Patches in the gap of a block split
+    are not merged: their GeoTIFFs stay in the shard directories, their NPY rows are
+    dropped from the manifest. Shards written with band statistics get one
+    output_dir/stats.json, regrouped by the merged split.
+
+    Args:
+        shard_dirs (list): Output directories of the shards, written with process_data(shard=...).
+        output_dir (str): Directory for the merged outputs.
+        split_mode (str, optional): "random" or "block", see split.assign_split. Defaults to
+            the split mode the shards were run with; a different one raises a ValueError.
+        split_block_size (int, optional): Grid cell size in pixels for "block". Defaults to
+            the block size the shards were run with; a different one raises a ValueError.
+
+    Returns:
+        pd.DataFrame: The merged plan with the assigned split of every patch.
+    """
+    states = []
+    for directory in shard_dirs:
+        state = load_run(str(directory))
+        if state is None or state.key["params"].get("shard") is None:
+            raise ValueError(f"{directory} holds no sharded run")
+        missing = set(state.plan.patch_id) - state.completed
+        if missing:
+            raise ValueError(
+                f"Shard {directory} is incomplete: {len(missing)} of {len(state.plan)} "
+                "patches are not written yet, rerun it to resume"
+            )
+        states.append(state)
+    if not states:
+        raise ValueError("No shard directories to merge")
+
+    params = [dict(s.key["params"], shard=None) for s in states]
+    if any(p != params[0] for p in params) or any(
+        s.key["raster"] != states[0].key["raster"] for s in states
+    ):
+        raise ValueError("The shards were written from different inputs or parameters")
+    for name, value in [
+        ("split_mode", split_mode),
+        ("split_block_size", split_block_size),
+    ]:
+        recorded = params[0].get(name)
+        if value is not None and value != recorded:
+            raise ValueError(
+                f"The shards were run with {name}={recorded!r}, not {value!r}; "
+                "rerun them with the same split to merge them with it"
+            )
+    split_mode = params[0].get("split_mode", "random")
+    split_block_size = params[0].get("split_block_size")
+    count = states[0].key["params"]["shard"][1]
+    indices = sorted(s.key["params"]["shard"][0] for s in states)
+    if indices != list(range(count)):
+        raise ValueError(f"Expected shards 0 to {count - 1}, got {indices}")
+
+    plan = pd.concat(
+        [s.plan.assign(source=str(d)) for s, d in zip(states, shard_dirs)],
+        ignore_index=True,
+    )
+    if not plan.patch_id.is_unique:
+        raise ValueError("Patch ids collide across shards")
+    plan["split"] = assign_split(
+        plan, mode=split_mode, block_size=split_block_size
+    ).to_numpy()
+    log_gap(plan)
+
+    label = params[0]["label"]
+    augmentations = params[0].get("augmentations") or []
+    output_dir = str(output_dir)
+    if params[0]["output_format"] == "geotiff":
+        for patch_id, split, source in zip(plan.patch_id, plan.split, plan.source):
+            if split == "gap":
+                continue
+            for variant in [patch_id] + [
+                variant_id(patch_id, a) for a in augmentations
+            ]:
+                for folder in ("images", "labels"):
+                    name = f"{label}_{variant}.tif"
+                    _move(
+                        os.path.join(source, folder, name),
+                        os.path.join(output_dir, split, folder, name),
+                    )
+    else:
+        manifests = []
+        for directory in shard_dirs:
+            manifest = pd.read_parquet(os.path.join(directory, "manifest.parquet"))
+            for shard in manifest.shard.unique():
+                for kind in ("images", "labels"):
+                    name = f"{shard}_{kind}.npy"
+                    _move(
+                        os.path.join(directory, "shards", name),
+                        os.path.join(output_dir, "shards", name),
+                    )
+            manifests.append(manifest)
+        manifest = pd.concat(manifests, ignore_index=True)
+        manifest["split"] = (
+            plan.set_index("patch_id")
+            .split.loc[manifest.patch_id.map(source_id)]
+            .to_numpy()
+        )
+        manifest = manifest[manifest.split != "gap"].reset_index(drop=True)
+        manifest.to_parquet(os.path.join(output_dir, "manifest.parquet"))
+
+    _merge_stats(states, shard_dirs, plan, output_dir)
+
+    counts = plan.split.value_counts()
+    logging.info(
+        f"Merged {len(states)} shards: {counts.get('train', 0)} train, "
+        f"{counts.get('test', 0)} test and {counts.get('gap', 0)} gap patches"
+    )
+    return plan.drop(columns="source")
+
+
+def _merge_stats(
+    states: list, shard_dirs: list, plan: pd.DataFrame, output_dir: str
+) -> None:
+    """Group the logged band statistics of every shard by the merged split, streaming them"""
+    path = os.path.join(str(shard_dirs[0]), "stats.json")
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        meta = json.load(f)
+    lines = itertools.chain.from_iterable(
+        read_stats_lines(done_dir(str(directory), state.generation))
+        for state, directory in zip(states, shard_dirs)
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    merged = plan[plan.split != "gap"]
+    stats = PatchStats.from_logs(
+        merged, lines, meta["bands"], meta["dtype"], meta["nodata"]
+    )
+    stats.save(
+        os.path.join(output_dir, "stats.json"),
+        planned_patches=len(merged),
+        written_patches=len(merged),
+    )
@@ -0,0 +1,301 @@
+import os
+import glob
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from xml.sax.saxutils import escape
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio import Affine
+from rasterio.features import rasterize
+from rasterio.warp import transform_bounds
+
+from shrub_prepro.mask import ValidMask
+from shrub_prepro.remote import get_s3_filesystem, is_remote
+
+# File types picked up from a directory of tiles
+TILE_EXTENSIONS = (".tif", ".tiff")
+
+
+def is_mosaic(raster_path) -> bool:
+    """Return True for a directory, glob pattern or VRT of raster tiles"""
+    if isinstance(raster_path, (list, tuple)):
+        return False
+    path = str(raster_path)
+    return (
+        path.lower().endswith(".vrt")
+        or any(c in path for c in "*?[")
+        or path.endswith("/")
+        or (not is_remote(path) and os.path.isdir(path))
+    )
+
+
+def mosaic_tiles(raster_path) -> list:
+    """
+    List the tiles of a mosaic input.
+
+    Args:
+        raster_path (str): A local or S3 directory (S3 prefixes end in "/"), a glob pattern
+            such as "tiles/*.tif", or a VRT.
+
+    Returns:
+        list: The tile paths in sorted order, the sources of a VRT in its order.
+    """
+    path = str(raster_path)
+    if path.lower().endswith(".vrt"):
+        with rasterio.open(path) as vrt:
+            # The first file is the VRT itself
+            return list(vrt.files[1:])
+    if not any(c in path for c in "*?["):
+        path = path.rstrip("/") + "/*"
+    if is_remote(path):
+        paths = [f"s3://{p}" for p in get_s3_filesystem().glob(path)]
+    else:
+        paths = glob.glob(path)
+    tiles = sorted(p for p in paths if p.lower().endswith(TILE_EXTENSIONS))
+    if not tiles:
+        raise ValueError(f"No raster tiles found for {raster_path}")
+    return tiles
+
+
+def _tile_info(path: str) -> dict:
+    with rasterio.open(path) as src:
+        return dict(
+            path=path,
+            crs=src.crs,
+            bounds=tuple(src.bounds),
+            res=tuple(abs(r) for r in src.res),
+            width=src.width,
+            height=src.height,
+            count=src.count,
+            dtype=src.dtypes[0],
+            nodata=src.nodata,
+        )
+
+
+def index_tiles(tiles: list, threads: int = 16) -> gpd.GeoDataFrame:
+    """
+    Index the footprints of mosaic tiles, opening only their headers.
+
+    Args:
+        tiles (list): Tile paths, local or on S3.
+        threads (int, optional): Tiles opened concurrently. Defaults to 16.
+
+    Returns:
+        gpd.GeoDataFrame: One row per tile with its path, grid, band layout and footprint,
+            in the CRS of the first tile.
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        info = list(executor.map(_tile_info, tiles))
+    crs = info[0]["crs"]
+    footprints = [
+        shapely.box(
+            *(
+                i["bounds"]
+                if i["crs"] == crs
+                else transform_bounds(i["crs"], crs, *i["bounds"])
+            )
+        )
+        for i in info
+    ]
+    index = gpd.GeoDataFrame(
+        pd.DataFrame(info).drop(columns=["crs", "bounds"]),
+        geometry=footprints,
+        crs=crs,
+    )
+    index["same_crs"] = [i["crs"] == crs for i in info]
+    logging.info(f"Indexed {len(index)} mosaic tiles")
+    return index
+
+
+def _gdal_path(path: str) -> str:
+    return f"/vsis3/{path[len('s3://'):]}" if is_remote(path) else os.path.abspath(path)
+
+
+def mosaic_vrt(index: gpd.GeoDataFrame) -> str:
+    """
+    Return the XML of a VRT mosaicking the indexed tiles onto one grid.
+
+    Tiles must share their CRS, resolution, band count and dtype, as tiles cut from one
+    orthomosaic do. Each tile is placed at its offset on the grid of the union of their
+    footprints; pixels no tile covers read as the tiles' nodata value, or 0.
+
+    Args:
+        index (gpd.GeoDataFrame): The tiles, from index_tiles.
+
+    Returns:
+        str: The VRT document.
+    """
+    differing = [
+        name
+        for name, values in (
+            ("CRS", index.same_crs.map(str)),
+            ("resolution", index.res.map(str)),
+            ("band count", index["count"]),
+            ("dtype", index["dtype"]),
+        )
+        if values.nunique() > 1
+    ]
+    if differing:
+        raise ValueError(
+            "Mosaic tiles must share their CRS, resolution, band count and dtype, found "
+            f"differing {', '.join(differing)}; warp them onto one grid first, e.g. with gdalwarp"
+        )
+    xres, yres = index.res.iloc[0]
+    left, bottom, right, top = map(float, index.total_bounds)
+    width = int(round((right - left) / xres))
+    height = int(round((top - bottom) / yres))
+    nodata = index.nodata.iloc[0]
+    nodata = None if pd.isna(nodata) else float(nodata)
+    source = "ComplexSource" if nodata is not None else "SimpleSource"
+
+    bands = []
+    for band in range(1, int(index["count"].iloc[0]) + 1):
+        lines = [
+            f'  <VRTRasterBand dataType="{_gdal_type(index["dtype"].iloc[0])}" '
+            f'band="{band}">'
+        ]
+        if nodata is not None:
+            lines.append(f"    <NoDataValue>{nodata!r}</NoDataValue>")
+        for tile in index.itertuples():
+            x_off = int(round((tile.geometry.bounds[0] - left) / xres))
+            y_off = int(round((top - tile.geometry.bounds[3]) / yres))
+            lines += [
+                f"    <{source}>",
+                f'      <SourceFilename relativeToVRT="0">'
+                f"{escape(_gdal_path(tile.path))}</SourceFilename>",
+                f"      <SourceBand>{band}</SourceBand>",
+                f'      <SrcRect xOff="0" yOff="0" xSize="{tile.width}" '
+                f'ySize="{tile.height}" />',
+                f'      <DstRect xOff="{x_off}" yOff="{y_off}" xSize="{tile.width}" '
+                f'ySize="{tile.height}" />',
+            ]
+            if nodata is not None:
+                lines.append(f"      <NODATA>{nodata!r}</NODATA>")
+            lines.append(f"    </{source}>")
+        lines.append("  </VRTRasterBand>")
+        bands += lines
+
+    return "\n".join(
+        [
+            f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+            f"  <SRS>{escape(index.crs.to_wkt())}</SRS>",
+            f"  <GeoTransform>{left!r}, {xres!r}, 0.0, {top!r}, 0.0, {-yres!r}"
+            "</GeoTransform>",
+        ]
+        + bands
+        + ["</VRTDataset>", ""]
+    )
+
+
+def _gdal_type(dtype: str) -> str:
+    """GDAL data type name of a numpy dtype name"""
+    return rasterio.dtypes.typename_fwd[rasterio.dtypes.dtype_rev[dtype]]
+
+
+def write_mosaic_vrt(index: gpd.GeoDataFrame, vrt_path: str) -> str:
+    """
+    Write the mosaic VRT of the indexed tiles to vrt_path and return the path.
+
+    The file is only rewritten when its contents change, so its modification time, and
+    with it anything cached against it, stays put between runs over the same tiles.
+    """
+    document = mosaic_vrt(index)
+    try:
+        with open(vrt_path) as f:
+            if f.read() == document:
+                return vrt_path
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(os.path.abspath(vrt_path)), exist_ok=True)
+    with open(vrt_path, "w") as f:
+        f.write(document)
+    return vrt_path
+
+
+def footprint_mask(
+    index: gpd.GeoDataFrame,
+    image: rasterio.DatasetReader,
+    cell_size: Optional[int] = None,
+    valid_mask: Optional[ValidMask] = None,
+) -> ValidMask:
+    """
+    Coarse valid-data mask of the area the mosaic tiles cover.
+
+    A cell is valid when tiles cover it completely, so background windows are never drawn
+    over gaps between tiles, even for tiles without a nodata value.
+
+    Args:
+        index (gpd.GeoDataFrame): The tiles, from index_tiles.
+        image (rasterio.DatasetReader): The opened mosaic.
+        cell_size (int, optional): Cell size in pixels. Defaults to the cell size of
+            valid_mask, else 64 or the smallest tile side if less.
+        valid_mask (ValidMask, optional): A mask of the same cell size to combine with.
+
+    Returns:
+        ValidMask: The coarse mask.
+    """
+    if cell_size is None:
+        cell_size = (
+            valid_mask.cell_size
+            if valid_mask is not None
+            else int(min(64, index.width.min(), index.height.min()))
+        )
+    n_rows = -(-image.height // cell_size)
+    n_cols = -(-image.width // cell_size)
+    gaps = shapely.box(*image.bounds).difference(shapely.union_all(index.geometry))
+    cells = np.ones((n_rows, n_cols), dtype=bool)
+    if not gaps.is_empty:
+        transform = image.transform * Affine.scale(cell_size)
+        cells = ~rasterize(
+            [gaps],
+            out_shape=(n_rows, n_cols),
+            transform=transform,
+            all_touched=True,
+            dtype=np.uint8,
+        ).astype(bool)
+    if valid_mask is not None:
+        cells &= valid_mask.cells
+    return ValidMask(cells, cell_size)
+
+
+def assign_tiles(plan: pd.DataFrame, index: gpd.GeoDataFrame, transform) -> np.ndarray:
+    """
+    Assign every window of a plan to the mosaic tile under its centre.
+
+    Windows crossing a tile seam still belong to one tile, and are read across the seam
+    through the mosaic like any other window.
+
+    Args:
+        plan (pd.DataFrame): A window plan from plan_windows or plan_background.
+        index (gpd.GeoDataFrame): The tiles, from index_tiles.
+        transform (Affine): Transform of the mosaic.
+
+    Returns:
+        np.ndarray: Position of each window's tile in `index`, len(index) for windows
+            centred outside every tile.
+    """
+    col_off = plan.col_off.to_numpy()
+    row_off = plan.row_off.to_numpy()
+    size = plan["size"].to_numpy()
+    xs, ys = transform * (col_off + size / 2, row_off + size / 2)
+    windows, tiles = index.sindex.query(shapely.points(xs, ys), predicate="intersects")
+    tile_of = np.full(len(plan), len(index))
+    # A centre on a seam lies in several tiles; take the first
+    first = np.unique(windows, return_index=True)[1]
+    tile_of[windows[first]] = tiles[first]
+
+    left, top = transform * (col_off, row_off)
+    right, bottom = transform * (col_off + size, row_off + size)
+    boxes = shapely.box(left, bottom, right, top)
+    footprints = np.append(index.geometry.to_numpy(), shapely.Polygon())
+    crossing = ~shapely.contains(footprints[tile_of], boxes)
+    logging.info(
+        f"Assigned {len(plan)} windows to {len(np.unique(tile_of))} mosaic tiles, "
+        f"{int(crossing.sum())} of them crossing tile seams"
+    )
+    return tile_of
@@ -1,23 +1,554 @@
 import os
+import cProfile
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from typing import Iterator, Optional
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import rasterio
 from tqdm import tqdm
-from pathlib import Path
 
 
+from shrub_prepro.augment import (
+    augment_patch,
+    check_augmentations,
+    variant_id,
+    with_variants,
+)
+from shrub_prepro.coverage import plan_coverage
 from shrub_prepro.images import (
-    patch_window,
-    shrub_window,
-    shrub_overlaps,
     label_patch_with_window,
     shrub_labels_in_window,
+    DEFAULT_BACKGROUND_BUFFER,
     background_samples,
     background_label,
-    is_shrub_huge,
+    plan_windows,
+    plan_background,
+    plan_to_windows,
+    LabelMosaic,
+)
+from shrub_prepro.mask import (
+    build_valid_mask,
+    has_nodata_mask,
+    load_or_build_valid_mask,
+)
+from shrub_prepro.mosaic import (
+    assign_tiles,
+    footprint_mask,
+    index_tiles,
+    is_mosaic,
+    mosaic_tiles,
+    write_mosaic_vrt,
+)
+from shrub_prepro.io import make_writer, merge_manifests, pad_to_window
+from shrub_prepro.reads import (
+    DEFAULT_MAX_READ_BYTES,
+    ThreadLocalDatasets,
+    plan_read_groups,
+    read_group,
 )
-from shrub_prepro.io import save_image_patch, save_label_patch
-from shrub_prepro.split import test_train_split
+from shrub_prepro.report import RunReport, active, count, recording, timed
+from shrub_prepro.split import assign_split, log_gap
+from shrub_prepro.stack import any_remote, input_paths, open_input
+from shrub_prepro.stats import STATS_BATCH, PatchStats, PatchStatsLog, read_stats_lines
+from shrub_prepro.cache import InputCache
+from shrub_prepro.streaming import plan_streaming, tiled_plan
+from shrub_prepro.runs import (
+    CompletionLog,
+    RunState,
+    changed_areas,
+    done_dir,
+    load_run,
+    polygon_table,
+    remove_outputs,
+    renumber_shrubs,
+    run_key,
+    save_run,
+    stable_ids,
+    windows_touching,
+)
+from shrub_prepro.remote import (
+    configure_remote_access,
+    get_range_cache,
+    log_remote_stats,
+)
+
+
+def _ordered_map(executor: ThreadPoolExecutor, fn, items: list, depth: int) -> Iterator:
+    """Yield fn(item) in order, keeping at most `depth` calls queued or running ahead"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _write_patch(
+    writer, image: rasterio.DatasetReader, augmentations: list, *args
+) -> None:
+    """
+    Write a patch and its augmented variants, derived from the arrays in memory.
+    The variants are written first, so a patch logged as complete has all of them.
+    """
+    patch_id, window, data, arr, shrub_id, split = args
+    if augmentations:
+        transform = rasterio.windows.transform(window, image.transform)
+        variants = augment_patch(
+            pad_to_window(data, window, image), arr, transform, augmentations
+        )
+        for name, variant, variant_label, variant_transform in variants:
+            with timed("write"):
+                writer.write(
+                    variant_id(patch_id, name),
+                    window,
+                    image,
+                    variant,
+                    variant_label,
+                    shrub_id,
+                    split,
+                    variant_transform,
+                )
+        count("variants_written", len(augmentations))
+    with timed("write"):
+        writer.write(patch_id, window, image, data, arr, shrub_id, split)
+    count("patches_written")
+    copies = 1 + (len(augmentations) if augmentations else 0)
+    count("bytes_written", (data.nbytes + arr.nbytes) * copies)
+
+
+def _write_on_thread(
+    datasets: ThreadLocalDatasets, writer, augmentations: list, *args
+) -> None:
+    """Call _write_patch with the calling thread's own dataset handle"""
+    _write_patch(writer, datasets.get(), augmentations, *args)
+
+
+def write_patches(
+    plan: pd.DataFrame,
+    shrubs: Optional[gpd.GeoDataFrame],
+    image: rasterio.DatasetReader,
+    writer,
+    max_read_bytes: int = DEFAULT_MAX_READ_BYTES,
+    progress: Optional[tqdm] = None,
+    label_mosaic: bool = True,
+    queue_depth: int = 0,
+    io_threads: int = 2,
+    raster_path: Optional[str] = None,
+    remote_cache_dir: Optional[str] = None,
+    stats: Optional[PatchStatsLog] = None,
+    augmentations: Optional[list] = None,
+) -> None:
+    """
+    Write the image and label patches for the rows of a window plan.
+
+    Pixels come from block-aligned grouped reads, so overlapping windows are decoded once.
+    Labels are rasterized from `shrubs`, or are all zeros when `shrubs` is None (background).
+    With `label_mosaic`, the shrubs are burnt once per read group and each label is a
+    slice of that array. Patches go to `writer`, an output backend from shrub_prepro.io.
+
+    With `queue_depth` > 0 the work is pipelined: `io_threads` reader threads prefetch up
+    to `queue_depth` read groups ahead while this thread labels patches, and writer threads
+    encode up to `queue_depth` patches behind it (one writer thread unless the backend is
+    thread_safe). GDAL releases the GIL for reads and encoding, so the stages overlap.
+    Memory is bounded by `queue_depth` read groups plus `queue_depth` patches.
+    The threads open `raster_path` (default image.name) themselves, S3 rasters through
+    the range cache for `remote_cache_dir`. The band statistics of every patch are logged to
+    `stats`, if given, as they pass through. The `augmentations` of every patch, see
+    shrub_prepro.augment, are derived from its arrays and written after it is labelled,
+    without reading the raster again.
+    """
+    windows = plan_to_windows(plan)
+    patch_ids = plan.patch_id.to_list()
+    shrub_ids = plan.shrub_id.to_list()
+    splits = plan.split.to_list() if "split" in plan else [None] * len(plan)
+    positive = plan.positive.astype(bool).to_list()
+    groups = plan_read_groups(image, windows, max_read_bytes)
+
+    with ExitStack() as stack:
+        if queue_depth > 0:
+            datasets = ThreadLocalDatasets(
+                raster_path or image.name,
+                partial(open_input, cache_dir=remote_cache_dir),
+            )
+            stack.callback(datasets.close)
+            n_writers = io_threads if writer.thread_safe else 1
+            readers = stack.enter_context(ThreadPoolExecutor(io_threads))
+            writers = stack.enter_context(ThreadPoolExecutor(n_writers))
+            # Each pool closes its threads' handles before it shuts down
+            stack.callback(datasets.close_in, readers, io_threads)
+            stack.callback(datasets.close_in, writers, n_writers)
+            reads = _ordered_map(
+                readers,
+                lambda group: list(read_group(datasets.get(), windows, group)),
+                groups,
+                queue_depth,
+            )
+            written = deque()
+        else:
+            reads = (read_group(image, windows, group) for group in groups)
+
+        for group, items in zip(groups, reads):
+            mosaic = None
+            if shrubs is not None and label_mosaic and group.window is not None:
+                with timed("rasterize"):
+                    mosaic = LabelMosaic(
+                        shrubs, [windows[i] for i in group.members], image
+                    )
+            for i, data in items:
+                window = windows[i]
+                with timed("rasterize"):
+                    if shrubs is None:
+                        arr = background_label(int(window.height))
+                    else:
+                        labels = shrub_labels_in_window(shrubs, window, image)
+                        if mosaic is not None:
+                            arr = mosaic.label(labels, window)
+                        else:
+                            arr = label_patch_with_window(labels, window, image)
+                if stats is not None:
+                    with timed("band_stats"):
+                        stats.record(patch_ids[i], splits[i], positive[i], data)
+                args = (patch_ids[i], window, data, arr, shrub_ids[i], splits[i])
+                if queue_depth <= 0:
+                    _write_patch(writer, image, augmentations, *args)
+                    if progress is not None:
+                        progress.update(1)
+                    continue
+                written.append(
+                    writers.submit(
+                        _write_on_thread, datasets, writer, augmentations, *args
+                    )
+                )
+                while len(written) >= queue_depth:
+                    written.popleft().result()
+                    if progress is not None:
+                        progress.update(1)
+
+        if queue_depth > 0:
+            while written:
+                written.popleft().result()
+                if progress is not None:
+                    progress.update(1)
+
+
+def write_chunk(
+    plan: pd.DataFrame,
+    shrubs: Optional[gpd.GeoDataFrame],
+    image: rasterio.DatasetReader,
+    part: str,
+    output_format: str,
+    output_dir: str,
+    label: str,
+    max_read_bytes: int = DEFAULT_MAX_READ_BYTES,
+    label_mosaic: bool = True,
+    queue_depth: int = 0,
+    io_threads: int = 2,
+    raster_path: Optional[str] = None,
+    remote_cache_dir: Optional[str] = None,
+    done_dir: Optional[str] = None,
+    progress: Optional[tqdm] = None,
+    band_stats: bool = False,
+    stats_batch: int = STATS_BATCH,
+    augmentations: Optional[list] = None,
+) -> int:
+    """
+    Write a window plan through its own output backend named `part`, return the patch count.
+    With a done_dir, written patches are logged to {done_dir}/{part}.txt, and with
+    `band_stats` their band statistics to {done_dir}/{part}.stats.jsonl, `stats_batch`
+    patches per line. The
+    `augmentations` of every patch are written too.
+    """
+    with ExitStack() as stack:
+        completion = None
+        stats = None
+        if done_dir is not None:
+            completion = CompletionLog(os.path.join(done_dir, f"{part}.txt"))
+            stack.callback(completion.close)
+            if band_stats:
+                stats = PatchStatsLog(
+                    os.path.join(done_dir, f"{part}.stats.jsonl"),
+                    image.count,
+                    image.dtypes[0],
+                    image.nodata,
+                    stats_batch,
+                )
+                stack.callback(stats.close)
+        writer = stack.enter_context(
+            make_writer(output_format, output_dir, label, part, completion)
+        )
+        write_patches(
+            plan,
+            shrubs,
+            image,
+            writer,
+            max_read_bytes,
+            progress,
+            label_mosaic,
+            queue_depth,
+            io_threads,
+            raster_path,
+            remote_cache_dir,
+            stats,
+            augmentations,
+        )
+    return len(plan)
+
+
+def _log_band_stats(
+    plan: pd.DataFrame,
+    image: rasterio.DatasetReader,
+    part: str,
+    done_dir: str,
+    max_read_bytes: int = DEFAULT_MAX_READ_BYTES,
+    stats_batch: int = STATS_BATCH,
+) -> None:
+    """
+    Log the band statistics of already written patches to {done_dir}/{part}.stats.jsonl,
+    reading their pixels from the raster again instead of writing the patches.
+    """
+    windows = plan_to_windows(plan)
+    patch_ids = plan.patch_id.to_list()
+    splits = plan.split.to_list()
+    positive = plan.positive.astype(bool).to_list()
+    stats = PatchStatsLog(
+        os.path.join(done_dir, f"{part}.stats.jsonl"),
+        image.count,
+        image.dtypes[0],
+        image.nodata,
+        stats_batch,
+    )
+    try:
+        for group in plan_read_groups(image, windows, max_read_bytes):
+            for i, data in read_group(image, windows, group):
+                stats.record(patch_ids[i], splits[i], positive[i], data)
+    finally:
+        stats.close()
+
+
+def spatial_chunks(
+    plan: pd.DataFrame,
+    n_chunks: int,
+    strip: int,
+    groups: Optional[np.ndarray] = None,
+) -> list:
+    """
+    Partition a window plan into spatially coherent chunks of similar size.
+
+    Windows are ordered by horizontal strips of `strip` pixel rows, in serpentine order
+    within each strip, then cut into `n_chunks` contiguous runs. Neighbouring windows end
+    up in the same chunk, so each worker reads a compact part of the raster.
+
+    With `groups`, e.g. the mosaic tile of every window, chunks never mix groups: each
+    group is cut into as many runs as it needs to stay within about len(plan) / n_chunks
+    windows per chunk.
+
+    Args:
+        plan (pd.DataFrame): A window plan from plan_windows or plan_background.
+        n_chunks (int): The number of chunks to produce.
+        strip (int): Height of the ordering strips in pixels.
+        groups (np.ndarray, optional): A group label per window. Defaults to None.
+
+    Returns:
+        list: Non-empty slices of `plan`.
+    """
+    if not len(plan):
+        return []
+    order = _spatial_order(plan, strip)
+    if groups is None:
+        return [
+            plan.iloc[chunk] for chunk in np.array_split(order, n_chunks) if len(chunk)
+        ]
+    groups = np.asarray(groups)[order]
+    target = -(-len(plan) // n_chunks)
+    chunks = []
+    for group in np.unique(groups):
+        positions = order[groups == group]
+        pieces = np.array_split(positions, -(-len(positions) // target))
+        chunks += [plan.iloc[chunk] for chunk in pieces]
+    return chunks
+
+
+def _spatial_order(plan: pd.DataFrame, strip: int) -> np.ndarray:
+    """Positions of the windows by strips of `strip` pixel rows, serpentine within a strip"""
+    band = np.floor(plan.row_off.to_numpy() / strip)
+    col = plan.col_off.to_numpy()
+    # Serpentine ordering keeps the end of one strip next to the start of the next
+    return np.lexsort((np.where(band % 2, -col, col), band))
+
+
+def select_shard(
+    plan: pd.DataFrame, index: int, count: int, strip: int
+) -> pd.DataFrame:
+    """
+    Return shard `index` of `count` spatially coherent shards of a window plan.
+
+    Shards are contiguous runs of the spatial_chunks ordering, so every machine that plans
+    the same windows gets the same, non-overlapping portions.
+
+    Args:
+        plan (pd.DataFrame): The full window plan.
+        index (int): The shard to select, counting from 0.
+        count (int): The number of shards.
+        strip (int): Height of the ordering strips in pixels.
+
+    Returns:
+        pd.DataFrame: The rows of the shard, in plan order.
+    """
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {index} is out of range for {count} shards")
+    positions = np.array_split(_spatial_order(plan, strip), count)[index]
+    return plan.iloc[np.sort(positions)]
+
+
+@contextmanager
+def _profiling(path: Optional[str]) -> Iterator[None]:
+    """Profile the block with cProfile and save the statistics to `path`, if given"""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logging.info(f"Saved profile to {path}")
+
+
+# Per-process state for the worker pool, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(raster_path, shrubs, write_options, profile=None):
+    """
+    Open a dataset handle for this worker process and keep the shared inputs.
+    With a `profile` path, the worker's chunks are profiled into {profile}.{pid}.
+    """
+    _worker.update(
+        image=open_input(raster_path, write_options["remote_cache_dir"]),
+        shrubs=shrubs,
+        write_options=write_options,
+        profile=profile,
+        profiler=cProfile.Profile() if profile else None,
+    )
+
+
+def _write_chunk(
+    plan: pd.DataFrame, part: str, shrubs: Optional[gpd.GeoDataFrame] = None
+) -> tuple:
+    """
+    Write a chunk of a window plan with this worker's dataset handle. Return the patch
+    count and the chunk's RunReport.
+    """
+    if shrubs is None and plan.positive.all():
+        shrubs = _worker["shrubs"]
+    image = _worker["image"]
+    profiler = _worker["profiler"]
+    with recording(RunReport()) as report:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            written = write_chunk(plan, shrubs, image, part, **_worker["write_options"])
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(f"{_worker['profile']}.{os.getpid()}")
+    return written, report
+
+
+def _collect(result: tuple) -> int:
+    """Merge the report of a worker chunk into the active report, return its patch count"""
+    written, chunk_report = result
+    report = active()
+    if report is not None:
+        report.merge(chunk_report)
+    return written
+
+
+def _write_plan(
+    plan: pd.DataFrame,
+    shrubs: Optional[gpd.GeoDataFrame],
+    image: rasterio.DatasetReader,
+    pool: Optional[ProcessPoolExecutor],
+    n_chunks: int,
+    desc: str,
+    write_options: dict,
+    part: str,
+    mosaic: Optional[gpd.GeoDataFrame] = None,
+) -> None:
+    """
+    Write a window plan serially, or as spatial chunks over the pool with one progress bar.
+    Chunk i writes through an output backend named {part}{i:04d}. With the tile index of
+    a `mosaic`, chunks are cut per tile.
+    """
+    with tqdm(total=len(plan), desc=desc) as progress:
+        if pool is None:
+            write_chunk(
+                plan,
+                shrubs,
+                image,
+                f"{part}0000",
+                progress=progress,
+                **write_options,
+            )
+            return
+        strip = int(plan["size"].max()) if len(plan) else 1
+        groups = None
+        if mosaic is not None:
+            groups = assign_tiles(plan, mosaic, image.transform)
+        chunks = spatial_chunks(plan, n_chunks, strip, groups)
+        futures = [
+            pool.submit(_write_chunk, chunk, f"{part}{i:04d}")
+            for i, chunk in enumerate(chunks)
+        ]
+        for done in as_completed(futures):
+            progress.update(_collect(done.result()))
+
+
+def _write_tiles(
+    plan: pd.DataFrame,
+    polygons_path: str,
+    image: rasterio.DatasetReader,
+    pool: Optional[ProcessPoolExecutor],
+    max_pending: int,
+    desc: str,
+    write_options: dict,
+    part: str,
+    tile_size: int,
+) -> None:
+    """
+    Write a shrub window plan tile by tile, with only the polygons of one tile in memory.
+    Tile i writes through an output backend named {part}{i:05d}. With a pool, at most
+    `max_pending` tiles are queued, so their polygons don't pile up in memory either.
+    """
+    with tqdm(total=len(plan), desc=desc) as progress:
+        pending = deque()
+        for i, rows, shrubs in tiled_plan(plan, polygons_path, image, tile_size):
+            name = f"{part}{i:05d}"
+            if pool is None:
+                write_chunk(
+                    rows,
+                    shrubs,
+                    image,
+                    name,
+                    progress=progress,
+                    **write_options,
+                )
+                continue
+            pending.append(pool.submit(_write_chunk, rows, name, shrubs))
+            while len(pending) >= max_pending:
+                progress.update(_collect(pending.popleft().result()))
+        while pending:
+            progress.update(_collect(pending.popleft().result()))
 
 
 def process_data(
@@ -26,81 +557,415 @@ def process_data(
     output_dir,
     label,
     window_size=512,
+    seed=None,
+    workers=1,
+    max_read_bytes=DEFAULT_MAX_READ_BYTES,
+    label_mosaic=True,
+    output_format="geotiff",
+    split_mode="random",
+    split_block_size=None,
+    queue_depth=0,
+    io_threads=2,
+    remote_cache_dir=None,
+    input_cache_dir=None,
+    input_cache_bytes=20 * 1024 * 1024 * 1024,
+    resume=True,
+    shard=None,
+    stream_tile_size=None,
+    background_buffer=DEFAULT_BACKGROUND_BUFFER,
+    coverage=None,
+    band_stats=True,
+    augmentations=None,
+    report=None,
+    profile=None,
 ):
     """
     Process a generic raster to extract window-sized outputs around polygon centers.
 
     Parameters:
-        raster_path (str): Path to the input raster file.
+        raster_path (str): Path to the input raster file, or a list of paths to stack the bands
+            of several rasters (e.g. RGB and a DSM) into every patch, on the grid of the
+            first one; see shrub_prepro.stack. A directory, glob pattern or VRT of raster
+            tiles is read as one mosaic, through output_dir/mosaic.vrt for the first two, with
+            the work scheduled tile by tile; see shrub_prepro.mosaic.
         shapefile_path (str): Path to the shapefile containing polygons.
         output_dir (str): Directory to save individual window-sized outputs.
         label (str): Label of the outputs
         window_size (int): Size of the square window to extract (default: 512).
-        rotate_angles (list): List of angles (in degrees) to rotate the windows (default: [90, 180, 270]).
+        seed (int): Seed for background sampling, for reproducible runs (default: None).
+        workers (int): Number of worker processes writing patches (default: 1, serial).
+        max_read_bytes (int): Upper bound on one grouped read buffer, per process (default: 256 MiB).
+        label_mosaic (bool): Rasterize labels once per read group instead of per patch (default: True).
+        output_format (str): Output backend, "geotiff" for one file per patch or "npy" for
+            NPY shards with a Parquet manifest (default: "geotiff").
+        split_mode (str): "random" or spatially "block" train/test split, assigned before
+            writing; see split.assign_split (default: "random").
+        split_block_size (int): Grid cell size in pixels for the block split (default: 8 windows).
+        queue_depth (int): Overlap reads, labelling and writes with background threads, keeping
+            this many read groups and patches queued (default: 0, no pipelining).
+        io_threads (int): Reader and writer threads per process when pipelining (default: 2).
+        remote_cache_dir (str): Directory for the on-disk block cache of S3 rasters, shared
+            between processes and runs. S3 reads are cached in memory either way (default: None).
+        input_cache_dir (str): Directory for the persistent input cache. Polygons are served from
+            it as GeoParquet while unchanged, S3 raster byte ranges and valid-data masks are kept
+            in it too, unless remote_cache_dir is set (default: None, no cache).
+        input_cache_bytes (int): Size cap of the input cache, S3 byte ranges included. The
+            cache is brought back within it when entries are added and at the end of the
+            run (default: 20 GiB).
+        resume (bool): Reuse the patches an earlier run wrote to output_dir for the same raster
+            and parameters, and only write those that are missing or affected by changed
+            polygons, see shrub_prepro.runs. False rewrites every patch (default: True).
+        shard (tuple): (index, count) to write only shard `index` of `count` spatially coherent
+            shards of the planned patches, without a train/test split; combine the shard
+            outputs with shrub_prepro.merge.merge_shards. Needs a seed (default: None, all).
+        stream_tile_size (int): Read the polygons in tiles of this many pixels instead of all at
+            once, for layers larger than memory; see shrub_prepro.streaming. Shrub ids are then
+            the layer's feature ids (default: None, read the whole layer).
+        background_buffer (float): Minimum distance between background windows and any
+            polygon, in CRS units (default: 5).
+        coverage (str): "greedy" or "grid" to write a reduced set of shrub patches that still
+            holds every shrub whole, instead of one patch per shrub; see
+            shrub_prepro.coverage (default: None).
+        band_stats (bool): Accumulate per-band mean, std, range and histograms of the written
+            patches in one pass, by split and by shrub or background patch, and save them
+            to output_dir/stats.json; see shrub_prepro.stats (default: True).
+        augmentations (list): Variants to write next to every patch, derived from its arrays
+            in memory: any of "rot90", "rot180", "rot270", "fliplr" and "flipud". Variant files
+            are named after the patch, e.g. {label}_3.0-rot90.tif, with the transform of the
+            rotated or flipped pixels; see shrub_prepro.augment (default: None).
+        report (str): Path of a JSON run report with the wall time of every stage, the time
+            spent reading, rasterizing and writing summed over threads and workers, window,
+            patch and byte counters, and the throughput and background acceptance rates
+            derived from them; see shrub_prepro.report (default: None, stages are logged only).
+        profile (str): Path to save cProfile statistics of the patch writing to, for
+            pstats or snakeviz. Each worker process saves its own to {profile}.{pid}; the
+            main process profile only covers its main thread (default: None).
 
     Returns:
         None
     """
 
-    labels_dir = Path(output_dir) / "labels"
-    images_dir = Path(output_dir) / "images"
-    os.makedirs(labels_dir, exist_ok=True)
-    os.makedirs(images_dir, exist_ok=True)
+    run_report = RunReport()
+    augmentations = check_augmentations(augmentations)
+    raster_paths = input_paths(raster_path)
+    raster_path = raster_paths[0] if len(raster_paths) == 1 else raster_paths
+    if isinstance(raster_path, list) and any(map(is_mosaic, raster_path)):
+        raise ValueError("Mosaic inputs can't be stacked with other rasters")
 
-    # Source of our polygon labels
-    shrubs = gpd.read_file(shapefile_path)
-    total_shrubs = len(shrubs)
+    # Mosaics are read through one VRT, their tiles indexed once to schedule the work
+    mosaic = None
+    fingerprinted = raster_path
+    if is_mosaic(raster_path):
+        tiles = mosaic_tiles(raster_path)
+        if any_remote(tiles):
+            configure_remote_access()
+        mosaic = index_tiles(tiles)
+        if str(raster_path).lower().endswith(".vrt"):
+            fingerprinted = [raster_path] + tiles
+        else:
+            fingerprinted = tiles
+            raster_path = write_mosaic_vrt(
+                mosaic, os.path.join(str(output_dir), "mosaic.vrt")
+            )
+    input_cache = None
+    if input_cache_dir is not None:
+        input_cache = InputCache(input_cache_dir, input_cache_bytes)
+        if remote_cache_dir is None:
+            remote_cache_dir = input_cache.ranges_dir
+
+    # Source of our polygon labels, read tile by tile when streaming
+    shrubs = None
+    with run_report.stage("read_polygons"):
+        if stream_tile_size:
+            polygons_path = shapefile_path
+            if input_cache is not None:
+                polygons_path = input_cache.fetch(shapefile_path)
+        elif input_cache is not None:
+            shrubs = input_cache.read_polygons(shapefile_path)
+        else:
+            shrubs = gpd.read_file(shapefile_path)
+
+    if shard is not None and seed is None:
+        raise ValueError(
+            "Sharded runs need a seed, so every shard plans the same background windows"
+        )
+
+    # The run manifest tells which patches an earlier run of the same command wrote
+    key = run_key(
+        fingerprinted,
+        dict(
+            label=label,
+            window_size=window_size,
+            seed=seed,
+            output_format=output_format,
+            split_mode=split_mode,
+            split_block_size=split_block_size,
+            shard=None if shard is None else list(shard),
+            stream_tile_size=stream_tile_size,
+            background_buffer=background_buffer,
+            coverage=coverage,
+            augmentations=augmentations,
+        ),
+    )
+    previous = load_run(str(output_dir))
+    reusable = resume and previous is not None and previous.key == key
+    generation = 0 if previous is None else previous.generation + 1
+
+    write_options = dict(
+        output_format=output_format,
+        output_dir=str(output_dir),
+        label=label,
+        max_read_bytes=max_read_bytes,
+        label_mosaic=label_mosaic,
+        queue_depth=queue_depth,
+        io_threads=io_threads,
+        raster_path=raster_path,
+        remote_cache_dir=remote_cache_dir,
+        done_dir=done_dir(str(output_dir), generation),
+        band_stats=band_stats,
+        # The split of sharded runs is assigned by the merge, which regroups every patch
+        stats_batch=STATS_BATCH if shard is None else 1,
+        augmentations=augmentations,
+    )
+    if any_remote(fingerprinted):
+        configure_remote_access()
 
     # Open the raster once, and read small windows from it.
-    with rasterio.open(raster_path) as image:
-        for index, shrub in tqdm(
-            shrubs.iterrows(), total=len(shrubs), desc="Shrub images and labels"
-        ):
-            windows = []
-            # Window defined by the shrub bounds
-            shrub_px = shrub_window(shrub, image)
-            print(shrub_px.height, shrub_px.width)
-            if is_shrub_huge(shrub_px, window_size):
-                windows = shrub_overlaps(shrub, image, window_size)
+    with open_input(raster_path, remote_cache_dir) as image, ExitStack() as stack:
+        stack.enter_context(recording(run_report))
+        pool = None
+        if workers > 1:
+            pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=workers,
+                    # Spawned workers don't inherit this process's GDAL state
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(raster_path, shrubs, write_options, profile),
+                )
+            )
+        # A few chunks per worker keeps the pool busy when chunks are uneven
+        n_chunks = workers * 4
+
+        # Rasters with a nodata collar get a coarse valid-data mask, cached next to them
+        valid_mask = None
+        with run_report.stage("valid_mask"):
+            if not reusable and has_nodata_mask(image):
+                if isinstance(raster_path, list) or mosaic is not None:
+                    valid_mask = build_valid_mask(image)
+                else:
+                    valid_mask = load_or_build_valid_mask(
+                        image, raster_path, input_cache=input_cache
+                    )
+            if not reusable and mosaic is not None:
+                valid_mask = footprint_mask(mosaic, image, valid_mask=valid_mask)
+
+        # Every window is planned up front, before any pixels are read
+        with run_report.stage("plan"):
+            if stream_tile_size:
+                plan, background, polygons = plan_streaming(
+                    polygons_path,
+                    image,
+                    window_size,
+                    stream_tile_size,
+                    seed=seed,
+                    valid_mask=valid_mask,
+                    sample_background=not reusable,
+                    background_buffer=background_buffer,
+                    coverage=coverage,
+                )
             else:
-                windows = [patch_window(shrub.geometry, image, patch_size=window_size)]
-
-            for i, window in enumerate(windows):
-                # Naming scheme, track whether a shrub has multi windows
-                use_index = f"{index}.{i}"
-                labels = shrub_labels_in_window(shrubs, window, image)
-                arr = label_patch_with_window(labels, window, image)
-                save_image_patch(
-                    window, image, use_index, label=label, directory=images_dir
+                plan = plan_windows(shrubs, image, window_size)
+                if coverage:
+                    plan = plan_coverage(plan, shrubs, image, method=coverage)
+                polygons = polygon_table(shrubs)
+
+        changed = None
+        if reusable:
+            # Shrubs keep their ids, and so their patch ids, wherever they are in the layer
+            ids = stable_ids(previous.polygons, polygons)
+            plan = renumber_shrubs(plan, ids)
+            polygons = polygons.set_axis(ids.to_numpy())
+            # Keep the earlier background, minus windows that now come near a polygon
+            changed = changed_areas(previous.polygons, polygons)
+            background = previous.plan[~previous.plan.positive.astype(bool)]
+            background = background.drop(columns="split").reset_index(drop=True)
+            background = background[
+                ~windows_touching(
+                    background, changed, image.transform, buffer=background_buffer
                 )
-                save_label_patch(
-                    arr, window, image, use_index, label=label, directory=labels_dir
+            ]
+        elif not stream_tile_size:
+            with run_report.stage("background_samples"):
+                negative_windows = background_samples(
+                    image,
+                    shrubs,
+                    window_size=window_size,
+                    within_df=True,
+                    seed=seed,
+                    valid_mask=valid_mask,
+                    buffer=background_buffer,
                 )
+            # Use the same label string as filename; start index after shrubs end
+            background = plan_background(negative_windows, start=len(shrubs))
+
+        # Break this into a dedicated test set the model will never see, and leave
+        # the rest for training/validation. Patches are written straight to their set.
+        # Sharded runs leave the split to the merge, which sees every shard.
+        count("shrub_windows_planned", len(plan))
+        count("background_windows_planned", len(background))
+        full = pd.concat([plan, background], ignore_index=True)
+        with run_report.stage("split"):
+            if shard is None:
+                full["split"] = assign_split(
+                    full, mode=split_mode, block_size=split_block_size
+                ).to_numpy()
+            else:
+                full["split"] = None
 
-        print("Selecting background examples")
-        negative_windows = background_samples(
-            image, shrubs, window_size=window_size, within_df=True
+        completed = set()
+        stats_lines = None
+        unlogged = set()
+        if reusable:
+            old = previous.plan.set_index("patch_id")
+            same = np.array(full.patch_id.isin(old.index))
+            if split_mode == "random":
+                # Random splits reshuffle when patches are added; earlier patches keep theirs
+                full.loc[same, "split"] = old.split.loc[full.patch_id[same]].to_numpy()
+            matched = old.reindex(full.patch_id)
+            for column in ("col_off", "row_off", "size", "split"):
+                was, now = matched[column].to_numpy(), full[column].to_numpy()
+                same &= (was == now) | (pd.isna(was) & pd.isna(now))
+            same &= ~windows_touching(full, changed, image.transform)
+            completed = set(full.patch_id[same]) & previous.completed
+            if band_stats:
+                # Logged batches carry over while all of their patches are kept
+                previous_done = done_dir(str(output_dir), previous.generation)
+                logged = set()
+                for line in read_stats_lines(previous_done):
+                    if completed.issuperset(line["patch_ids"]):
+                        logged.update(line["patch_ids"])
+                unlogged = completed - logged
+                stats_lines = (
+                    line
+                    for line in read_stats_lines(previous_done)
+                    if completed.issuperset(line["patch_ids"])
+                )
+
+        # A block split leaves a gap of unwritten patches between the two sets
+        count("gap_windows_dropped", int((full.split == "gap").sum()))
+        log_gap(full)
+        full = full[full.split != "gap"]
+        if shard is not None:
+            full = select_shard(full, *shard, strip=window_size)
+        count("patches_planned", len(full))
+        count("patches_resumed", len(completed & set(full.patch_id)))
+        save_run(
+            str(output_dir),
+            RunState(key, generation, full, polygons, completed),
+            stats_lines,
         )
-        for index, neg_window in enumerate(
-            tqdm(
-                negative_windows,
-                total=len(negative_windows),
-                desc="Background images and labels",
+        if previous is not None:
+            # Outputs of earlier patches that are gone or about to be rewritten
+            stale = previous.plan[
+                previous.plan.patch_id.isin(previous.completed)
+                & ~previous.plan.patch_id.isin(completed)
+            ]
+            remove_outputs(str(output_dir), stale, previous.key["params"])
+        if completed:
+            logging.info(
+                f"Resuming: {len(completed)} of {len(full)} patches already written"
             )
-        ):
-            idx = total_shrubs + index
-            # Use the same label string as filename; start index after shrubs end
-            save_image_patch(neg_window, image, idx, label=label, directory=images_dir)
 
-            save_label_patch(
-                background_label(),
-                window,
+        todo = full[~full.patch_id.isin(completed)]
+        # Part names stay unique across runs and across shards merged into one directory
+        prefix = (
+            f"r{generation}-"
+            if shard is None
+            else f"{shard[0]}of{shard[1]}-r{generation}-"
+        )
+        if unlogged:
+            # Kept patches whose batch was cut short, or written without band statistics
+            logging.info(
+                f"Reading {len(unlogged)} written patches for their band statistics"
+            )
+            with run_report.stage("resumed_stats"):
+                _log_band_stats(
+                    full[full.patch_id.isin(unlogged)],
+                    image,
+                    f"{prefix}resumed",
+                    write_options["done_dir"],
+                    max_read_bytes,
+                    write_options["stats_batch"],
+                )
+        stack.enter_context(_profiling(profile))
+        with run_report.stage("write_shrubs"):
+            if stream_tile_size:
+                _write_tiles(
+                    todo[todo.positive.astype(bool)],
+                    polygons_path,
+                    image,
+                    pool,
+                    n_chunks,
+                    "Shrub images and labels",
+                    write_options,
+                    f"{prefix}shrubs",
+                    stream_tile_size,
+                )
+            else:
+                _write_plan(
+                    todo[todo.positive.astype(bool)],
+                    shrubs,
+                    image,
+                    pool,
+                    n_chunks,
+                    "Shrub images and labels",
+                    write_options,
+                    f"{prefix}shrubs",
+                    mosaic,
+                )
+        with run_report.stage("write_background"):
+            _write_plan(
+                todo[~todo.positive.astype(bool)],
+                None,
                 image,
-                idx,
-                label=label,
-                directory=labels_dir,
+                pool,
+                n_chunks,
+                "Background images and labels",
+                write_options,
+                f"{prefix}background",
+                mosaic,
+            )
+        if band_stats:
+            # Sum the batches logged by this and earlier runs, by their patches' split
+            stats = PatchStats.from_logs(
+                full,
+                read_stats_lines(write_options["done_dir"]),
+                image.count,
+                image.dtypes[0],
+                image.nodata,
             )
+            stats.save(
+                os.path.join(str(output_dir), "stats.json"),
+                planned_patches=len(full),
+                written_patches=len(todo),
+            )
+
+    if output_format != "geotiff":
+        with run_report.stage("merge_manifests"):
+            merge_manifests(output_dir, with_variants(full.patch_id, augmentations))
+    if any_remote(raster_path):
+        log_remote_stats(get_range_cache(remote_cache_dir))
+    if input_cache is not None:
+        # Range blocks fetched during the run count against the cap too
+        input_cache.evict()
 
-    # Finally break this into a dedicated test set the model will never see,
-    # And leave the rest for training/validation
-    test_train_split(output_dir)
+    if report is not None:
+        run_report.save(
+            report,
+            raster=raster_path if isinstance(raster_path, list) else str(raster_path),
+            output_dir=str(output_dir),
+            workers=workers,
+            generation=generation,
+            profile=profile,
+        )
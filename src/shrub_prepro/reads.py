@@ -0,0 +1,345 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from shrub_prepro.report import count, timed
+
+# Default upper bound on the size of one grouped read buffer, in bytes
+DEFAULT_MAX_READ_BYTES = 256 * 1024 * 1024
+
+
+class ReadGroup(NamedTuple):
+    """
+    A set of patch windows served from one read.
+
+    Attributes:
+        window (Window): The block-aligned super-window to read, or None to read each member directly.
+        members (list): Positions of the member windows in the planned list.
+    """
+
+    window: Optional[Window]
+    members: list
+
+
+def _clip(window: Window, image: rasterio.DatasetReader) -> Optional[tuple]:
+    """Integer (row0, row1, col0, col1) of a window cropped to the raster, as image.read does"""
+    if (
+        window.col_off % 1
+        or window.row_off % 1
+        or window.width % 1
+        or window.height % 1
+    ):
+        return None
+    col0 = max(int(window.col_off), 0)
+    row0 = max(int(window.row_off), 0)
+    col1 = min(int(window.col_off + window.width), image.width)
+    row1 = min(int(window.row_off + window.height), image.height)
+    if col1 <= col0 or row1 <= row0:
+        return None
+    return row0, row1, col0, col1
+
+
+def plan_read_groups(
+    image: rasterio.DatasetReader,
+    windows: list,
+    max_bytes: int = DEFAULT_MAX_READ_BYTES,
+) -> list:
+    """
+    Group patch windows into block-aligned super-windows that are read once each.
+
+    The raster is divided into tiles made of whole internal blocks, sized so that a tile
+    plus the largest window fits in `max_bytes`. Windows are assigned to the tile holding
+    their top-left pixel and ordered by block row and column. Each group reads the
+    block-aligned union of its windows. Groups that would still exceed `max_bytes`, and
+    windows that can't be served by slicing (fractional or fully outside the raster), are
+    read directly.
+
+    Args:
+        image (rasterio.DatasetReader): The raster the windows index into.
+        windows (list): The planned rasterio.windows.Window objects.
+        max_bytes (int, optional): Upper bound for one read buffer. Defaults to 256 MiB.
+
+    Returns:
+        list: ReadGroup objects, in read order.
+    """
+    block_h, block_w = image.block_shapes[0]
+    pixel_bytes = image.count * np.dtype(image.dtypes[0]).itemsize
+    clipped = [_clip(w, image) for w in windows]
+
+    largest = max(
+        [max(c[1] - c[0], c[3] - c[2]) for c in clipped if c is not None], default=0
+    )
+    side = max(int(math.sqrt(max_bytes / pixel_bytes)) - largest, 1)
+    tile_h = max(side // block_h, 1) * block_h
+    tile_w = (
+        image.width if block_w >= image.width else max(side // block_w, 1) * block_w
+    )
+
+    tiles = {}
+    direct = []
+    for i, c in enumerate(clipped):
+        if c is None:
+            direct.append(i)
+            continue
+        row0, _, col0, _ = c
+        key = (row0 // tile_h, col0 // tile_w)
+        tiles.setdefault(key, []).append((row0 // block_h, col0 // block_w, i))
+
+    groups = []
+    for key in sorted(tiles):
+        members = [i for _, _, i in sorted(tiles[key])]
+        row0 = min(clipped[i][0] for i in members) // block_h * block_h
+        col0 = min(clipped[i][2] for i in members) // block_w * block_w
+        row1 = min(
+            -(-max(clipped[i][1] for i in members) // block_h) * block_h, image.height
+        )
+        col1 = min(
+            -(-max(clipped[i][3] for i in members) // block_w) * block_w, image.width
+        )
+        if (row1 - row0) * (col1 - col0) * pixel_bytes > max_bytes:
+            groups.append(ReadGroup(None, members))
+        else:
+            groups.append(
+                ReadGroup(Window(col0, row0, col1 - col0, row1 - row0), members)
+            )
+    if direct:
+        groups.append(ReadGroup(None, direct))
+    return groups
+
+
+def _read(image: rasterio.DatasetReader, window: Window) -> np.ndarray:
+    """image.read of a window, timed and counted in the run report"""
+    with timed("read"):
+        data = image.read(window=window)
+    count("bytes_read", data.nbytes)
+    return data
+
+
+def read_group(
+    image: rasterio.DatasetReader, windows: list, group: ReadGroup
+) -> Iterator[tuple]:
+    """
+    Read the windows of one group, decoding its super-window once.
+
+    Args:
+        image (rasterio.DatasetReader): The raster to read from.
+        windows (list): The planned rasterio.windows.Window objects.
+        group (ReadGroup): A group from plan_read_groups.
+
+    Yields:
+        tuple: (position in `windows`, np.ndarray of shape (bands, rows, cols)).
+    """
+    if group.window is None:
+        for i in group.members:
+            yield i, _read(image, windows[i])
+        return
+    buffer = _read(image, group.window)
+    row_base, col_base = int(group.window.row_off), int(group.window.col_off)
+    for i in group.members:
+        row0, row1, col0, col1 = _clip(windows[i], image)
+        yield i, buffer[
+            :, row0 - row_base : row1 - row_base, col0 - col_base : col1 - col_base
+        ]
+
+
+def grouped_reads(
+    image: rasterio.DatasetReader,
+    windows: list,
+    max_bytes: int = DEFAULT_MAX_READ_BYTES,
+) -> Iterator[tuple]:
+    """
+    Read many patch windows, decoding each super-window once.
+
+    Yields the same arrays as image.read(window=w) for each window, as slices of the group
+    buffer. Only one group buffer is held at a time.
+
+    Args:
+        image (rasterio.DatasetReader): The raster to read from.
+        windows (list): The planned rasterio.windows.Window objects.
+        max_bytes (int, optional): Upper bound for one read buffer. Defaults to 256 MiB.
+
+    Yields:
+        tuple: (position in `windows`, np.ndarray of shape (bands, rows, cols)), in read order.
+    """
+    for group in plan_read_groups(image, windows, max_bytes):
+        yield from read_group(image, windows, group)
+
+
+class ThreadLocalDatasets:
+    """
+    One open rasterio dataset per thread for the same raster.
+
+    rasterio dataset handles must not be shared between threads, so reader and writer
+    threads each get their own, opened with open_fn(path). Handles opened through a
+    Python opener must also be closed on the thread that opened them, so call
+    close_in(executor, n_threads) for each pool before it shuts down, then close().
+    """
+
+    def __init__(self, path: str, open_fn: Callable = rasterio.open):
+        self.path = path
+        self.open_fn = open_fn
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def get(self) -> rasterio.DatasetReader:
+        """Return this thread's dataset handle, opening it on first use"""
+        image = getattr(self.local, "image", None)
+        if image is None:
+            image = self.local.image = self.open_fn(self.path)
+            with self.lock:
+                self.opened.append(image)
+        return image
+
+    def _close_local(self, barrier: threading.Barrier) -> None:
+        barrier.wait()
+        image = getattr(self.local, "image", None)
+        if image is not None:
+            image.close()
+            self.local.image = None
+            with self.lock:
+                self.opened.remove(image)
+
+    def close_in(self, executor, n_threads: int) -> None:
+        """
+        Close the handles opened by the threads of a pool, each on its own thread.
+
+        Args:
+            executor (ThreadPoolExecutor): The pool whose threads used get().
+            n_threads (int): The pool's max_workers.
+        """
+        # The barrier holds every task until all have started, so each thread runs one
+        barrier = threading.Barrier(n_threads)
+        tasks = [executor.submit(self._close_local, barrier) for _ in range(n_threads)]
+        for task in tasks:
+            task.result()
+
+    def close(self) -> None:
+        """Close any remaining handles from the calling thread"""
+        with self.lock:
+            for image in self.opened:
+                image.close()
+            self.opened = []
+
+
+class BlockCache:
+    """
+    LRU cache of decoded raster tiles, for serving many windows without a write plan.
+
+    The raster is divided into tiles of whole internal blocks, at least `min_tile` pixels
+    on a side. read() fetches the tiles missing for a batch of windows with one read per
+    row of tiles, keeps the most recently used tiles up to `max_bytes`, and assembles each
+    window from them. Windows are padded past the raster edges with nodata, so every array
+    has the full window shape.
+    """
+
+    def __init__(
+        self,
+        image: rasterio.DatasetReader,
+        max_bytes: int = DEFAULT_MAX_READ_BYTES,
+        min_tile: int = 256,
+    ):
+        self.image = image
+        self.max_bytes = max_bytes
+        block_h, block_w = image.block_shapes[0]
+        self.tile_h = -(-min_tile // block_h) * block_h
+        self.tile_w = min(-(-min_tile // block_w) * block_w, image.width)
+        self.fill = image.nodata or 0
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _fetch(self, keys: set) -> dict:
+        """Return the tiles for `keys`, reading the missing ones one row of tiles at a time"""
+        found = {}
+        missing = {}
+        for key in keys:
+            tile = self.tiles.get(key)
+            if tile is None:
+                missing.setdefault(key[0], []).append(key[1])
+            else:
+                self.tiles.move_to_end(key)
+                found[key] = tile
+        self.hits += len(found)
+        for tile_row, tile_cols in missing.items():
+            self.misses += len(tile_cols)
+            row0 = tile_row * self.tile_h
+            row1 = min(row0 + self.tile_h, self.image.height)
+            col0 = min(tile_cols) * self.tile_w
+            col1 = min((max(tile_cols) + 1) * self.tile_w, self.image.width)
+            buffer = self.image.read(
+                window=Window(col0, row0, col1 - col0, row1 - row0)
+            )
+            for tile_col in tile_cols:
+                start = tile_col * self.tile_w - col0
+                # Copy, so a cached tile doesn't keep the whole row buffer alive
+                tile = buffer[:, :, start : start + self.tile_w].copy()
+                found[(tile_row, tile_col)] = tile
+                self.tiles[(tile_row, tile_col)] = tile
+                self.nbytes += tile.nbytes
+        while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+            self.nbytes -= self.tiles.popitem(last=False)[1].nbytes
+        return found
+
+    def read(self, windows: list) -> list:
+        """
+        Read a batch of windows.
+
+        Args:
+            windows (list): rasterio.windows.Window objects; fractional ones are read directly.
+
+        Returns:
+            list: np.ndarray of shape (bands, height, width) for each window.
+        """
+        spans = {}
+        keys = set()
+        for i, window in enumerate(windows):
+            c = _clip(window, self.image)
+            if c is None:
+                continue
+            spans[i] = c
+            row0, row1, col0, col1 = c
+            keys.update(
+                (r, k)
+                for r in range(row0 // self.tile_h, (row1 - 1) // self.tile_h + 1)
+                for k in range(col0 // self.tile_w, (col1 - 1) // self.tile_w + 1)
+            )
+        tiles = self._fetch(keys)
+
+        arrays = []
+        for i, window in enumerate(windows):
+            if i not in spans:
+                arrays.append(
+                    self.image.read(window=window, boundless=True, fill_value=self.fill)
+                )
+                continue
+            out = np.full(
+                (self.image.count, int(window.height), int(window.width)),
+                self.fill,
+                dtype=self.image.dtypes[0],
+            )
+            row0, row1, col0, col1 = spans[i]
+            for r in range(row0 // self.tile_h, (row1 - 1) // self.tile_h + 1):
+                for k in range(col0 // self.tile_w, (col1 - 1) // self.tile_w + 1):
+                    # Overlap of the window and the tile, in raster pixels
+                    top = max(row0, r * self.tile_h)
+                    bottom = min(row1, (r + 1) * self.tile_h)
+                    left = max(col0, k * self.tile_w)
+                    right = min(col1, (k + 1) * self.tile_w)
+                    out[
+                        :,
+                        top - int(window.row_off) : bottom - int(window.row_off),
+                        left - int(window.col_off) : right - int(window.col_off),
+                    ] = tiles[(r, k)][
+                        :,
+                        top - r * self.tile_h : bottom - r * self.tile_h,
+                        left - k * self.tile_w : right - k * self.tile_w,
+                    ]
+            arrays.append(out)
+        return arrays
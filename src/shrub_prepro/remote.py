@@ -0,0 +1,325 @@
+import io
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Optional
+
+import rasterio
+import s3fs
+
+# GDAL settings for windowed reads of remote COGs over /vsis3
+GDAL_REMOTE_OPTIONS = {
+    # Don't list the bucket "directory" or probe for sidecar files on open
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.vrt",
+    # Merge neighbouring tile requests and reuse connections
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(64 * 1024 * 1024),
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 * 1024 * 1024),
+}
+
+
+def is_remote(path) -> bool:
+    """Return True for S3 paths"""
+    return str(path).startswith("s3://")
+
+
+def configure_remote_access() -> None:
+    """
+    Set the GDAL remote-access options as environment defaults for this process.
+
+    GDAL reads its config options from the environment, so the settings also apply in
+    threads and in worker processes started afterwards. Values already set win.
+    """
+    for key, value in GDAL_REMOTE_OPTIONS.items():
+        os.environ.setdefault(key, value)
+
+
+@lru_cache(maxsize=None)
+def get_s3_filesystem() -> s3fs.S3FileSystem:
+    """
+    Return the S3 filesystem shared by this process, and with it one connection pool.
+
+    The endpoint comes from AWS_ENDPOINT_URL and anonymous access from AWS_NO_SIGN_REQUEST,
+    the same variables GDAL's /vsis3 uses (see .env).
+    """
+    anon = os.environ.get("AWS_NO_SIGN_REQUEST", "").strip("\"'").upper()
+    return s3fs.S3FileSystem(
+        anon=anon in ("TRUE", "YES", "1"),
+        endpoint_url=os.environ.get("AWS_ENDPOINT_URL") or None,
+    )
+
+
+class RangeCache:
+    """
+    Block cache for byte ranges of remote files, in memory and optionally on disk.
+
+    Files are split into fixed-size blocks keyed by path and ETag, so a changed object is
+    never served from stale blocks. Both tiers evict the least recently used blocks once
+    they go over their size cap. Disk blocks survive between runs and are shared between
+    processes. Counters are in `stats`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        block_size: int = 256 * 1024,
+        memory_bytes: int = 256 * 1024 * 1024,
+        disk_bytes: int = 4 * 1024 * 1024 * 1024,
+    ):
+        """
+        Args:
+            cache_dir (str, optional): Directory for the disk tier. Memory only when None.
+            block_size (int, optional): Size of one cached block. Defaults to 256 KiB.
+            memory_bytes (int, optional): Size cap of the memory tier. Defaults to 256 MiB.
+            disk_bytes (int, optional): Size cap of the disk tier. Defaults to 4 GiB.
+        """
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "bytes_fetched": 0,
+            "bytes_from_memory": 0,
+            "bytes_from_disk": 0,
+        }
+        self.disk_size = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Leftovers of interrupted writes are never evicted, so they don't count
+            self.disk_size = sum(
+                entry.stat().st_size
+                for entry in os.scandir(cache_dir)
+                if not entry.name.endswith(".tmp")
+            )
+
+    def _count(self, key: str, n: int) -> None:
+        with self.lock:
+            self.stats[key] += n
+
+    def _remember(self, block_key: str, data: bytes) -> None:
+        with self.lock:
+            if block_key in self.memory:
+                return
+            self.memory[block_key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_bytes and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def _disk_path(self, block_key: str) -> str:
+        return os.path.join(
+            self.cache_dir, hashlib.sha256(block_key.encode()).hexdigest()
+        )
+
+    def _store(self, block_key: str, data: bytes) -> None:
+        path = self._disk_path(block_key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        # A block another thread or process stored meanwhile is replaced, not added
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        with self.lock:
+            self.disk_size += len(data) - replaced
+            over = self.disk_size > self.disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Remove the least recently used disk blocks until the tier is at 90% of its cap"""
+        entries = sorted(
+            (e for e in os.scandir(self.cache_dir) if not e.name.endswith(".tmp")),
+            key=lambda e: e.stat().st_mtime,
+        )
+        size = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if size <= self.disk_bytes * 0.9:
+                break
+            try:
+                size -= entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Evicted by another process
+        with self.lock:
+            self.disk_size = size
+
+    def get_blocks(
+        self, key: str, first: int, last: int, fetch: Callable[[int, int], bytes]
+    ) -> bytes:
+        """
+        Return blocks first..last (inclusive) of a file, fetching missing runs in one request each.
+
+        Args:
+            key (str): Identity of the file version, e.g. path and ETag.
+            first (int): Index of the first block.
+            last (int): Index of the last block.
+            fetch (Callable): fetch(start, end) returns the bytes [start, end) of the file.
+
+        Returns:
+            bytes: The concatenated blocks, the last one possibly short at the end of the file.
+        """
+        blocks = {}
+        for index in range(first, last + 1):
+            block_key = f"{key}#{index}"
+            with self.lock:
+                data = self.memory.get(block_key)
+                if data is not None:
+                    self.memory.move_to_end(block_key)
+            if data is not None:
+                self._count("bytes_from_memory", len(data))
+            elif self.cache_dir:
+                path = self._disk_path(block_key)
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    os.utime(path)  # Mark as recently used
+                    self._count("bytes_from_disk", len(data))
+                    self._remember(block_key, data)
+                except FileNotFoundError:
+                    data = None
+            blocks[index] = data
+
+        missing = [i for i in range(first, last + 1) if blocks[i] is None]
+        while missing:
+            # One ranged request per run of consecutive missing blocks
+            run_end = 0
+            while (
+                run_end + 1 < len(missing)
+                and missing[run_end + 1] == missing[run_end] + 1
+            ):
+                run_end += 1
+            start, stop = missing[0], missing[run_end]
+            data = fetch(start * self.block_size, (stop + 1) * self.block_size)
+            self._count("requests", 1)
+            self._count("bytes_fetched", len(data))
+            for index in range(start, stop + 1):
+                offset = (index - start) * self.block_size
+                block = data[offset : offset + self.block_size]
+                blocks[index] = block
+                self._remember(f"{key}#{index}", block)
+                if self.cache_dir:
+                    self._store(f"{key}#{index}", block)
+            missing = missing[run_end + 1 :]
+
+        return b"".join(blocks[i] for i in range(first, last + 1))
+
+
+class CachedRemoteFile(io.RawIOBase):
+    """Read-only, seekable file over an S3 object, served through a RangeCache"""
+
+    def __init__(self, fs: s3fs.S3FileSystem, path: str, cache: RangeCache):
+        info = fs.info(path)
+        self.fs = fs
+        self.path = path
+        self.cache = cache
+        self.size = info["size"]
+        self.key = f"{path}@{info.get('ETag', '')}:{self.size}"
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        return self.fs.cat_file(self.path, start=start, end=min(end, self.size))
+
+    def read(self, size: int = -1) -> bytes:
+        end = (
+            self.size
+            if size is None or size < 0
+            else min(self.position + size, self.size)
+        )
+        if end <= self.position:
+            return b""
+        block_size = self.cache.block_size
+        first, last = self.position // block_size, (end - 1) // block_size
+        data = self.cache.get_blocks(self.key, first, last, self._fetch)
+        offset = self.position - first * block_size
+        out = data[offset : offset + end - self.position]
+        self.position += len(out)
+        return out
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class RemoteOpener:
+    """rasterio opener serving S3 objects as CachedRemoteFile through a shared RangeCache"""
+
+    def __init__(self, cache: RangeCache):
+        self.cache = cache
+
+    def __call__(self, path: str, mode: str = "rb") -> CachedRemoteFile:
+        fs = get_s3_filesystem()
+        if not is_remote(path) or not fs.isfile(path):
+            raise FileNotFoundError(path)
+        return CachedRemoteFile(fs, path, self.cache)
+
+
+@lru_cache(maxsize=None)
+def get_range_cache(cache_dir: Optional[str] = None) -> RangeCache:
+    """Return the RangeCache of this process for a cache directory (memory only for None)"""
+    return RangeCache(cache_dir)
+
+
+def open_raster(path, cache: Optional[RangeCache] = None) -> rasterio.DatasetReader:
+    """
+    Open a local or S3 raster.
+
+    S3 rasters are read through `cache` when one is given, so overlapping windows and
+    repeated runs don't fetch the same byte ranges twice. Without a cache they go through
+    GDAL's /vsis3 driver; call configure_remote_access first for its settings.
+
+    Args:
+        path (str): Local path or s3:// URL.
+        cache (RangeCache, optional): Block cache for remote reads. Defaults to None.
+
+    Returns:
+        rasterio.DatasetReader: The opened raster.
+    """
+    if is_remote(path) and cache is not None:
+        return rasterio.open(str(path), opener=RemoteOpener(cache))
+    return rasterio.open(path)
+
+
+def open_cached(path, cache_dir: Optional[str] = None) -> rasterio.DatasetReader:
+    """Open a raster, reading S3 rasters through this process's RangeCache for cache_dir"""
+    return open_raster(path, get_range_cache(cache_dir) if is_remote(path) else None)
+
+
+def log_remote_stats(cache: RangeCache) -> None:
+    """Log the counters of a RangeCache"""
+    stats = cache.stats
+    logging.info(
+        f"Remote reads: {stats['requests']} requests, {stats['bytes_fetched']} bytes fetched, "
+        f"{stats['bytes_from_memory']} bytes from memory, {stats['bytes_from_disk']} bytes from disk"
+    )
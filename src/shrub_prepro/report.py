@@ -0,0 +1,146 @@
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# The report that timed() and count() add to in this process, set by recording()
+_active = None
+
+
+class RunReport:
+    """
+    Wall time per stage, time spent in the hot operations, and counters of one run.
+
+    Stages are the top-level steps of a run, timed once each on the main process.
+    Operations such as "read", "rasterize" and "write" are timed every time they run and
+    summed, over threads and over worker processes, so with pipelining or workers their
+    total can exceed the wall time. Counters hold window and patch counts and the bytes
+    read and written. Reports of worker chunks merge into the run's report.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a top-level stage of the run and log its duration"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            logging.info(f"Stage {name} took {seconds:.2f} s")
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Add one timed call of an operation"""
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add n to a counter"""
+        with self.lock:
+            self.counters[name] += int(n)
+
+    def merge(self, other: "RunReport") -> None:
+        """Add the operation times and counters of another report, e.g. a worker chunk's"""
+        with self.lock:
+            for name, seconds in other.seconds.items():
+                self.seconds[name] += seconds
+                self.calls[name] += other.calls[name]
+            for name, n in other.counters.items():
+                self.counters[name] += n
+
+    def to_dict(self) -> dict:
+        """
+        The report as plain data: stage wall times, operation times and call counts,
+        counters, and the throughput and background acceptance rates derived from them.
+        """
+        counters = dict(self.counters)
+        rates = {}
+        if self.seconds.get("read"):
+            rates["read_mb_per_s"] = (
+                counters.get("bytes_read", 0) / 2**20 / self.seconds["read"]
+            )
+        if self.seconds.get("write"):
+            rates["write_mb_per_s"] = (
+                counters.get("bytes_written", 0) / 2**20 / self.seconds["write"]
+            )
+        if counters.get("background_candidates"):
+            rates["background_acceptance"] = (
+                counters.get("background_accepted", 0)
+                / counters["background_candidates"]
+            )
+        write_seconds = sum(
+            s for name, s in self.stages.items() if name.startswith("write")
+        )
+        if write_seconds:
+            rates["patches_per_s"] = counters.get("patches_written", 0) / write_seconds
+        return {
+            "stages": {name: round(s, 6) for name, s in self.stages.items()},
+            "operations": {
+                name: {"seconds": round(s, 6), "calls": self.calls[name]}
+                for name, s in sorted(self.seconds.items())
+            },
+            "counters": dict(sorted(counters.items())),
+            "rates": rates,
+        }
+
+    def save(self, path: str, **extra) -> None:
+        """Write the report, with any `extra` top-level fields, to a JSON file"""
+        with open(path, "w") as f:
+            json.dump(dict(self.to_dict(), **extra), f, indent=2)
+        logging.info(f"Wrote run report to {path}")
+
+
+@contextmanager
+def recording(report: Optional[RunReport]) -> Iterator[Optional[RunReport]]:
+    """Make `report` the one timed() and count() add to in this process, for the block"""
+    global _active
+    previous, _active = _active, report
+    try:
+        yield report
+    finally:
+        _active = previous
+
+
+def active() -> Optional[RunReport]:
+    """The report being recorded in this process, if any"""
+    return _active
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Time a call of an operation into the active report; free when none is recorded"""
+    report = _active
+    if report is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_time(name, time.perf_counter() - start)
+
+
+def count(name: str, n: int = 1) -> None:
+    """Add n to a counter of the active report, if any"""
+    if _active is not None:
+        _active.count(name, n)
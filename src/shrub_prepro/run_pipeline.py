@@ -1,30 +1,204 @@
 import argparse
+import logging
 from pathlib import Path
+from shrub_prepro.augment import AUGMENTATIONS
+from shrub_prepro.coverage import COVERAGE_METHODS
+from shrub_prepro.io import OUTPUT_FORMATS
+from shrub_prepro.merge import merge_shards
 from shrub_prepro.processing import process_data
+from shrub_prepro.tiling import tile_raster
+
+
+def parse_shard(value: str) -> tuple:
+    """Parse "i/N" into (i, N), for shard i of N counting from 0"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected i/N, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard {index} is out of range for {count}")
+    return index, count
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser(description="Process shrub data from RGB imagery")
     parser.add_argument(
-        "--input-raster", required=True, help="S3 path or local path to input raster"
+        "--input-raster",
+        required=True,
+        nargs="+",
+        help="S3 path or local path to input raster. Several rasters (e.g. RGB and a DSM) "
+        "are stacked into every patch, on the grid of the first. A directory, quoted glob "
+        "pattern or VRT of raster tiles is read as one mosaic (patches mode)",
     )
     parser.add_argument(
         "--input-polygons",
-        required=True,
-        help="S3 path or local path to input polygons",
+        default=None,
+        help="S3 path or local path to input polygons (optional with --mode tile)",
+    )
+    parser.add_argument(
+        "--mode",
+        default="patches",
+        choices=["patches", "tile"],
+        help="patches: shrub and background patches split into train and test (default). "
+        "tile: the whole raster in --output-size tiles, labelled when polygons are given",
+    )
+    parser.add_argument(
+        "--tile-overlap",
+        default=0,
+        type=int,
+        help="Pixels shared by neighbouring tiles with --mode tile (default 0)",
     )
     parser.add_argument("--output-dir", required=True, help="Output directory (local)")
     parser.add_argument(
         "--output-size", default=512, type=int, help="Patch size (default 512)"
     )
     parser.add_argument("--label", default="rgb", help="Label for output files")
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="Random seed for background sampling (default: unseeded)",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of worker processes writing patches (default 1)",
+    )
+    parser.add_argument(
+        "--max-read-mb",
+        default=256,
+        type=int,
+        help="Upper bound on one grouped raster read, in MiB per process (default 256)",
+    )
+    parser.add_argument(
+        "--no-label-mosaic",
+        action="store_true",
+        help="Rasterize labels separately for every patch",
+    )
+    parser.add_argument(
+        "--output-format",
+        default="geotiff",
+        choices=sorted(OUTPUT_FORMATS),
+        help="geotiff: one GeoTIFF per patch (default). npy: NPY shards and a Parquet manifest",
+    )
+    parser.add_argument(
+        "--split",
+        default="random",
+        choices=["random", "block"],
+        help="Train/test split: random patches (default) or whole spatial grid cells",
+    )
+    parser.add_argument(
+        "--split-block-size",
+        default=None,
+        type=int,
+        help="Grid cell size in pixels for --split block (default 8x the output size)",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        default=0,
+        type=int,
+        help="Pipeline reads, labelling and writes with this many items queued (default 0, off)",
+    )
+    parser.add_argument(
+        "--io-threads",
+        default=2,
+        type=int,
+        help="Reader and writer threads per process when pipelining (default 2)",
+    )
+    parser.add_argument(
+        "--remote-cache-dir",
+        default=None,
+        help="Directory for the on-disk byte-range cache of S3 rasters (default: memory only)",
+    )
+    parser.add_argument(
+        "--input-cache-dir",
+        default=None,
+        help="Directory for a persistent cache of unchanged inputs and derived artifacts (default: off)",
+    )
+    parser.add_argument(
+        "--input-cache-gb",
+        default=20,
+        type=float,
+        help="Size cap of the input cache in GiB (default 20)",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Rewrite every patch instead of resuming an earlier run in the output directory",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        type=parse_shard,
+        help="Write only shard i/N (i counts from 0) of the patches, without a train/test "
+        "split; needs --seed. Combine the shards with shrub-prepro-merge",
+    )
+    parser.add_argument(
+        "--stream-tile-size",
+        default=None,
+        type=int,
+        help="Read polygons in tiles of this many pixels, for layers larger than memory "
+        "(default: read the whole layer)",
+    )
+    parser.add_argument(
+        "--background-buffer",
+        default=5,
+        type=float,
+        help="Minimum distance between background patches and any polygon, in CRS units "
+        "(default 5)",
+    )
+    parser.add_argument(
+        "--coverage",
+        default=None,
+        choices=COVERAGE_METHODS,
+        help="Write a reduced set of shrub patches that still holds every shrub whole, "
+        "chosen by greedy set cover or by snapping to a grid (default: one patch per shrub)",
+    )
+
+    parser.add_argument(
+        "--augment",
+        nargs="+",
+        default=None,
+        choices=list(AUGMENTATIONS),
+        help="Also write these rotated or flipped variants of every patch, derived in memory",
+    )
+    parser.add_argument(
+        "--no-band-stats",
+        action="store_true",
+        help="Don't accumulate per-band statistics of the patches into stats.json",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="Write a JSON report of stage times, bytes read and written, window counts "
+        "and background acceptance to this path",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Save cProfile statistics of the patch writing to this path, and those of "
+        "every worker to PATH.<pid>",
+    )
 
     args = parser.parse_args()
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Pipeline steps
-    print("Preparing training data...")
+    if args.mode == "tile":
+        tile_raster(
+            args.input_raster,
+            output_dir,
+            label=args.label,
+            tile_size=args.output_size,
+            overlap=args.tile_overlap,
+            polygons_path=args.input_polygons,
+            remote_cache_dir=args.remote_cache_dir,
+        )
+        return
+    if args.input_polygons is None:
+        parser.error("--input-polygons is required with --mode patches")
 
     process_data(
         args.input_raster,
@@ -32,6 +206,63 @@ def main():
         output_dir,
         window_size=args.output_size,
         label=args.label,
+        seed=args.seed,
+        workers=args.workers,
+        max_read_bytes=args.max_read_mb * 1024 * 1024,
+        label_mosaic=not args.no_label_mosaic,
+        output_format=args.output_format,
+        split_mode=args.split,
+        split_block_size=args.split_block_size,
+        queue_depth=args.queue_depth,
+        io_threads=args.io_threads,
+        remote_cache_dir=args.remote_cache_dir,
+        input_cache_dir=args.input_cache_dir,
+        input_cache_bytes=int(args.input_cache_gb * 1024**3),
+        resume=not args.no_resume,
+        shard=args.shard,
+        stream_tile_size=args.stream_tile_size,
+        background_buffer=args.background_buffer,
+        coverage=args.coverage,
+        band_stats=not args.no_band_stats,
+        augmentations=args.augment,
+        report=args.report,
+        profile=args.profile,
+    )
+
+
+def merge_main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs of a sharded run and split them into train and test"
+    )
+    parser.add_argument(
+        "--shard-dirs",
+        required=True,
+        nargs="+",
+        help="Output directories of every shard, written with --shard",
+    )
+    parser.add_argument("--output-dir", required=True, help="Output directory (local)")
+    parser.add_argument(
+        "--split",
+        default=None,
+        choices=["random", "block"],
+        help="Train/test split: random patches or whole spatial grid cells (default: the "
+        "split the shards were run with, which it must match)",
+    )
+    parser.add_argument(
+        "--split-block-size",
+        default=None,
+        type=int,
+        help="Grid cell size in pixels for --split block (default: the block size the "
+        "shards were run with, which it must match)",
+    )
+
+    args = parser.parse_args()
+    merge_shards(
+        args.shard_dirs,
+        args.output_dir,
+        split_mode=args.split,
+        split_block_size=args.split_block_size,
     )
 
 
@@ -0,0 +1,303 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Iterable, NamedTuple, Optional
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from shrub_prepro.augment import variant_id
+from shrub_prepro.cache import fingerprint
+from shrub_prepro.images import window_bounds_array
+from shrub_prepro.stats import write_stats_lines
+
+# Folder of the run manifest inside the output directory
+RUN_DIR = "_run"
+
+PLAN_COLUMNS = [
+    "patch_id",
+    "shrub_id",
+    "sub_index",
+    "col_off",
+    "row_off",
+    "size",
+    "positive",
+    "split",
+]
+
+
+class RunState(NamedTuple):
+    """
+    The run manifest of an output directory.
+
+    Attributes:
+        key (dict): Fingerprint of the raster and the parameters that shape the outputs.
+        generation (int): Number of the run that wrote the manifest, counting from 0.
+        plan (pd.DataFrame): Every planned patch with its window and split, see PLAN_COLUMNS.
+        polygons (pd.DataFrame): A content hash and the bounds of every polygon, by shrub id.
+        completed (set): Patch ids whose outputs are fully written.
+    """
+
+    key: dict
+    generation: int
+    plan: pd.DataFrame
+    polygons: pd.DataFrame
+    completed: set
+
+
+class CompletionLog:
+    """
+    Append-only log of the patches a writer has finished, one patch id per line.
+
+    Lines are flushed as they are written, so after a crash every complete line names a
+    patch whose outputs are on disk. Safe to share between threads.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def record(self, patch_ids: list) -> None:
+        """Mark patches as written"""
+        with self.lock:
+            self.file.write("".join(f"{p}\n" for p in patch_ids))
+            self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def run_key(raster_path, params: dict) -> dict:
+    """Identify a run by the current version of its raster(s) and its output parameters"""
+    if isinstance(raster_path, (list, tuple)):
+        return {"raster": [fingerprint(p) for p in raster_path], "params": params}
+    return {"raster": fingerprint(raster_path), "params": params}
+
+
+def polygon_table(shrubs: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    Hash and bound every polygon, so a later run can tell which ones changed.
+
+    Args:
+        shrubs (gpd.GeoDataFrame): The polygons, indexed by shrub id.
+
+    Returns:
+        pd.DataFrame: Columns key, minx, miny, maxx and maxy, indexed like `shrubs`.
+    """
+    wkb = shapely.to_wkb(shrubs.geometry.to_numpy())
+    bounds = shrubs.geometry.bounds
+    return pd.DataFrame(
+        {
+            "key": [hashlib.sha1(w).hexdigest() for w in wkb],
+            "minx": bounds.minx,
+            "miny": bounds.miny,
+            "maxx": bounds.maxx,
+            "maxy": bounds.maxy,
+        },
+        index=shrubs.index,
+    )
+
+
+def _occurrences(table: pd.DataFrame) -> pd.MultiIndex:
+    """(key, n) of every polygon, n counting earlier polygons with the same content"""
+    keys = table.key.reset_index(drop=True)
+    return pd.MultiIndex.from_arrays([keys, keys.groupby(keys).cumcount()])
+
+
+def stable_ids(previous: pd.DataFrame, current: pd.DataFrame) -> pd.Series:
+    """
+    Give the polygons of this run the shrub ids they had in the previous run.
+
+    Polygons are matched on their content hash, so inserting or deleting polygons
+    anywhere in the layer doesn't renumber the others. Polygons that are new, or whose
+    geometry changed, get ids after the largest earlier one.
+
+    Args:
+        previous (pd.DataFrame): polygon_table of the previous run.
+        current (pd.DataFrame): polygon_table of this run.
+
+    Returns:
+        pd.Series: The stable shrub id of every polygon, indexed like `current`.
+    """
+    old_ids = pd.Series(previous.index.to_numpy(), index=_occurrences(previous))
+    ids = old_ids.reindex(_occurrences(current)).to_numpy(dtype=np.float64, copy=True)
+    new = np.isnan(ids)
+    start = int(previous.index.max()) + 1 if len(previous) else 0
+    ids[new] = np.arange(start, start + new.sum())
+    return pd.Series(ids.astype(np.int64), index=current.index)
+
+
+def renumber_shrubs(plan: pd.DataFrame, ids: pd.Series) -> pd.DataFrame:
+    """
+    Rename the shrub patches of a plan after the stable ids of their shrubs.
+
+    Args:
+        plan (pd.DataFrame): Shrub windows, see images.plan_windows.
+        ids (pd.Series): New shrub id by current shrub id, see stable_ids.
+
+    Returns:
+        pd.DataFrame: The plan with new shrub_id and patch_id columns.
+    """
+    shrub_id = ids.loc[plan.shrub_id].to_numpy()
+    return plan.assign(
+        shrub_id=shrub_id,
+        patch_id=[f"{s}.{i}" for s, i in zip(shrub_id, plan.sub_index)],
+    )
+
+
+def changed_areas(previous: pd.DataFrame, current: pd.DataFrame) -> np.ndarray:
+    """
+    Return the areas where polygons were added, removed or changed since the previous run.
+
+    Polygons are compared by content, whatever their shrub ids.
+
+    Args:
+        previous (pd.DataFrame): polygon_table of the previous run.
+        current (pd.DataFrame): polygon_table of this run.
+
+    Returns:
+        np.ndarray: The bounding boxes of the old and new versions of the changed polygons.
+    """
+    old, new = _occurrences(previous), _occurrences(current)
+    bounds = pd.concat(
+        [previous[~old.isin(new)], current[~new.isin(old)]],
+    )
+    return shapely.box(bounds.minx, bounds.miny, bounds.maxx, bounds.maxy)
+
+
+def windows_touching(
+    plan: pd.DataFrame, areas: np.ndarray, transform, buffer: float = 0
+) -> np.ndarray:
+    """Return a boolean mask of the planned windows within `buffer` of any of `areas`"""
+    touching = np.zeros(len(plan), dtype=bool)
+    if not len(plan) or not len(areas):
+        return touching
+    left, bottom, right, top = window_bounds_array(
+        plan.col_off.to_numpy(),
+        plan.row_off.to_numpy(),
+        plan["size"].to_numpy(),
+        transform,
+    )
+    tree = shapely.STRtree(shapely.box(left, bottom, right, top))
+    if buffer:
+        hits = tree.query(areas, predicate="dwithin", distance=buffer)
+    else:
+        hits = tree.query(areas, predicate="intersects")
+    touching[np.unique(hits[1])] = True
+    return touching
+
+
+def _generation_dir(output_dir: str, generation: int) -> str:
+    return os.path.join(output_dir, RUN_DIR, str(generation))
+
+
+def done_dir(output_dir: str, generation: int) -> str:
+    """Folder of the completion logs written by one run"""
+    return os.path.join(_generation_dir(output_dir, generation), "done")
+
+
+def read_completed(directory: str) -> set:
+    """Return the patch ids in the completion logs of a folder, ignoring cut-off lines"""
+    completed = set()
+    for path in glob.glob(os.path.join(directory, "*.txt")):
+        with open(path) as f:
+            lines = f.read().split("\n")
+        # The last entry is empty, or a line cut off by a crash
+        completed.update(lines[:-1])
+    return completed
+
+
+def load_run(output_dir: str) -> Optional[RunState]:
+    """
+    Read the run manifest of an output directory.
+
+    Args:
+        output_dir (str): Output directory of a previous run.
+
+    Returns:
+        RunState: The manifest, or None if there is none or it can't be read.
+    """
+    path = os.path.join(output_dir, RUN_DIR, "run.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            meta = json.load(f)
+        directory = _generation_dir(output_dir, meta["generation"])
+        plan = pd.read_csv(
+            os.path.join(directory, "plan.csv"),
+            dtype={"patch_id": str, "split": str},
+            float_precision="round_trip",
+        )
+        polygons = pd.read_csv(os.path.join(directory, "polygons.csv"), index_col=0)
+    except (OSError, KeyError, ValueError) as e:
+        logging.info(f"Ignoring unreadable run manifest in {output_dir}: {e}")
+        return None
+    completed = read_completed(done_dir(output_dir, meta["generation"]))
+    return RunState(meta["key"], meta["generation"], plan, polygons, completed)
+
+
+def save_run(
+    output_dir: str, state: RunState, stats_lines: Optional[Iterable[dict]] = None
+) -> None:
+    """
+    Write the run manifest of an output directory.
+
+    Everything of a run lives in its own generation folder, and run.json is switched over
+    last, so a crash while saving leaves the previous manifest intact.
+
+    Args:
+        output_dir (str): The output directory.
+        state (RunState): The manifest, with the patches already written in `completed`.
+        stats_lines (Iterable[dict], optional): Logged band statistics of completed
+            patches, carried over to the new generation; see stats.read_stats_lines.
+            Defaults to None.
+    """
+    directory = _generation_dir(output_dir, state.generation)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    state.plan[PLAN_COLUMNS].to_csv(os.path.join(directory, "plan.csv"), index=False)
+    state.polygons.to_csv(os.path.join(directory, "polygons.csv"))
+    completion = CompletionLog(
+        os.path.join(done_dir(output_dir, state.generation), "base.txt")
+    )
+    completion.record(sorted(state.completed))
+    completion.close()
+    if stats_lines is not None:
+        write_stats_lines(
+            os.path.join(done_dir(output_dir, state.generation), "base.stats.jsonl"),
+            stats_lines,
+        )
+
+    path = os.path.join(output_dir, RUN_DIR, "run.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"key": state.key, "generation": state.generation}, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+    for other in os.listdir(os.path.join(output_dir, RUN_DIR)):
+        if other.isdigit() and int(other) != state.generation:
+            shutil.rmtree(os.path.join(output_dir, RUN_DIR, other), ignore_errors=True)
+
+
+def remove_outputs(output_dir: str, plan: pd.DataFrame, params: dict) -> None:
+    """
+    Delete the GeoTIFFs of planned patches and their augmented variants; NPY patches are
+    dropped from the manifest instead.
+    """
+    if params.get("output_format", "geotiff") != "geotiff":
+        return
+    augmentations = params.get("augmentations") or []
+    for patch_id, split in zip(plan.patch_id, plan.split):
+        base = os.path.join(output_dir, split) if isinstance(split, str) else output_dir
+        for name in [patch_id] + [variant_id(patch_id, a) for a in augmentations]:
+            for folder in ("images", "labels"):
+                path = os.path.join(base, folder, f"{params['label']}_{name}.tif")
+                if os.path.exists(path):
+                    os.remove(path)
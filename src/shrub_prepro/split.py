@@ -2,8 +2,13 @@ from sklearn.model_selection import train_test_split
 import shutil
 import os
 import logging
+from typing import Optional
 
-logging.basicConfig(level=logging.INFO)
+import numpy as np
+import pandas as pd
+import shapely
+
+from shrub_prepro.report import count, timed
 
 
 def test_train_split(output_dir: str, label: str = "shrubs"):
@@ -66,14 +71,18 @@ def test_train_split(output_dir: str, label: str = "shrubs"):
             dest_label_path = os.path.join(dest_dir, "labels", label_filename)
 
             if os.path.exists(source_image_path):
-                shutil.move(source_image_path, dest_image_path)
+                with timed("move"):
+                    shutil.move(source_image_path, dest_image_path)
+                count("files_moved")
             else:
                 logging.info(
                     f"Warning: Image file not found for index {index}: {source_image_path}"
                 )
 
             if os.path.exists(source_label_path):
-                shutil.move(source_label_path, dest_label_path)
+                with timed("move"):
+                    shutil.move(source_label_path, dest_label_path)
+                count("files_moved")
             else:
                 logging.info(
                     f"Warning: Label file not found for index {index}: {source_label_path}"
@@ -84,6 +93,106 @@ def test_train_split(output_dir: str, label: str = "shrubs"):
     move_files(test_indices, output_dir, test_dir)
 
     logging.info(
-        f"Data split into train ({len(train_indices)} samples) and test ({len(test_indices)} samples)."
+        f"Data split into train ({len(train_indices)} samples, {train_dir}) "
+        f"and test ({len(test_indices)} samples, {test_dir})"
+    )
+
+
+def _overlapping(plan: pd.DataFrame, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the positions in `a` whose windows share pixels with any window in `b`"""
+    col0 = plan.col_off.to_numpy()
+    row0 = plan.row_off.to_numpy()
+    col1 = col0 + plan["size"].to_numpy()
+    row1 = row0 + plan["size"].to_numpy()
+    tree = shapely.STRtree(shapely.box(col0[b], row0[b], col1[b], row1[b]))
+    hits_a, hits_b = tree.query(
+        shapely.box(col0[a], row0[a], col1[a], row1[a]), predicate="intersects"
+    )
+    i, j = a[hits_a], b[hits_b]
+    # Windows sharing only an edge don't share pixels
+    shared = (np.minimum(col1[i], col1[j]) > np.maximum(col0[i], col0[j])) & (
+        np.minimum(row1[i], row1[j]) > np.maximum(row0[i], row0[j])
+    )
+    return np.unique(i[shared])
+
+
+def assign_split(
+    plan: pd.DataFrame,
+    mode: str = "random",
+    test_size: float = 0.2,
+    block_size: Optional[int] = None,
+    random_state: int = 42,
+) -> pd.Series:
+    """
+    Decide the train/test split of a window plan before anything is written.
+
+    "random" splits the sorted patch ids exactly as test_train_split splits existing files.
+    "block" assigns whole grid cells of `block_size` pixels (by window centre) to a set, so
+    nearby patches stay together. Test patches that would still share pixels with a train
+    patch across a cell edge are marked "gap" and should not be written, so overlapping
+    patches never straddle the two sets.
+
+    Args:
+        plan (pd.DataFrame): Window plan with patch_id, col_off, row_off and size columns.
+        mode (str, optional): "random" or "block". Defaults to "random".
+        test_size (float, optional): Fraction of patches (or cells) for the test set. Defaults to 0.2.
+        block_size (int, optional): Grid cell size in pixels for "block". Defaults to 8 window sizes.
+        random_state (int, optional): Seed for train_test_split. Defaults to 42.
+
+    Returns:
+        pd.Series: "train", "test" or "gap" for each row, aligned with the plan index.
+    """
+    if len(plan) < 2:
+        return pd.Series("train", index=plan.index)
+
+    if mode == "random":
+        _, test_ids = train_test_split(
+            sorted(plan.patch_id), test_size=test_size, random_state=random_state
+        )
+        test = plan.patch_id.isin(test_ids).to_numpy()
+    elif mode == "block":
+        size = plan["size"].to_numpy()
+        block_size = block_size or int(size.max()) * 8
+        cell_col = np.floor((plan.col_off.to_numpy() + size / 2) / block_size)
+        cell_row = np.floor((plan.row_off.to_numpy() + size / 2) / block_size)
+        cells = [f"{int(r)}_{int(c)}" for r, c in zip(cell_row, cell_col)]
+        unique = sorted(set(cells))
+        if len(unique) < 2:
+            return pd.Series("train", index=plan.index)
+        _, test_cells = train_test_split(
+            unique, test_size=test_size, random_state=random_state
+        )
+        test = np.isin(cells, test_cells)
+        gap = _overlapping(plan, np.flatnonzero(test), np.flatnonzero(~test))
+        split = np.where(test, "test", "train")
+        split[gap] = "gap"
+        return pd.Series(split, index=plan.index)
+    else:
+        raise ValueError(f"Unknown split mode {mode!r}, expected 'random' or 'block'")
+
+    return pd.Series(np.where(test, "test", "train"), index=plan.index)
+
+
+def log_gap(plan: pd.DataFrame) -> None:
+    """
+    Log the patches of a plan that a block split put in the gap, and the shrubs they
+    came from. Shrubs left without any patch outside the gap are logged as a warning.
+
+    Args:
+        plan (pd.DataFrame): Window plan with shrub_id and split columns.
+    """
+    gap = (plan.split == "gap").to_numpy()
+    if not gap.any():
+        return
+    shrubs = plan.shrub_id.to_numpy()
+    affected = set(shrubs[gap & (shrubs >= 0)])
+    lost = sorted(int(s) for s in affected - set(shrubs[~gap]))
+    logging.info(
+        f"Dropping {gap.sum()} patches in the gap of the block split, "
+        f"from {len(affected)} shrubs"
     )
-    logging.info(f"Files moved to {train_dir} and {test_dir}.")
+    if lost:
+        logging.warning(
+            f"{len(lost)} shrubs lost every patch to the gap of the block split, "
+            f"e.g. shrub ids {lost[:10]}; a larger split block size keeps more"
+        )
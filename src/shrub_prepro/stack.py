@@ -0,0 +1,239 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from shrub_prepro.remote import is_remote, open_cached
+
+
+def input_paths(raster_path) -> list:
+    """Return the raster paths of an input, given as one path or a list of paths"""
+    if isinstance(raster_path, (list, tuple)):
+        return [str(p) for p in raster_path]
+    return [str(raster_path)]
+
+
+def any_remote(raster_path) -> bool:
+    """Return True if any raster of an input is on S3"""
+    return any(is_remote(p) for p in input_paths(raster_path))
+
+
+def open_input(raster_path, cache_dir: Optional[str] = None):
+    """
+    Open the raster input of a run: one raster, or a StackedRaster for a list of several.
+
+    Args:
+        raster_path: A local path or s3:// URL, or a list of them.
+        cache_dir (str, optional): On-disk block cache for S3 rasters, see remote.open_cached.
+
+    Returns:
+        rasterio.DatasetReader or StackedRaster: The opened input.
+    """
+    paths = input_paths(raster_path)
+    if len(paths) == 1:
+        return open_cached(paths[0], cache_dir)
+    return StackedRaster(paths, cache_dir)
+
+
+# Attributes of a StackedRaster that are those of its first raster
+PRIMARY_ATTRIBUTES = (
+    "transform",
+    "crs",
+    "width",
+    "height",
+    "bounds",
+    "res",
+    "block_shapes",
+    "index",
+    "xy",
+)
+
+
+def _fits(value: float, dtype: str) -> bool:
+    """Return True if a nodata value can be stored in a dtype"""
+    if np.isnan(value):
+        return np.dtype(dtype).kind == "f"
+    return rasterio.dtypes.in_dtype_range(value, dtype)
+
+
+def _on_grid(source: rasterio.DatasetReader, primary: rasterio.DatasetReader) -> bool:
+    """Return True if a raster shares the pixel grid of the primary raster"""
+    return (
+        source.crs == primary.crs
+        and source.transform.almost_equals(primary.transform)
+        and (source.width, source.height) == (primary.width, primary.height)
+    )
+
+
+class StackedRaster:
+    """
+    Several rasters read as one, their bands stacked on the pixel grid of the first.
+
+    Rasters on another grid or CRS are read through a WarpedVRT onto the first raster's
+    grid, built once when the stack is opened and reused for every window. Each raster
+    has its own thread, which opens, reads and closes it, so the rasters of a window are
+    read concurrently. Bands are cast to the common dtype of all rasters.
+
+    The stack's nodata is that of the first raster that has one. Nodata pixels of every
+    raster, and the fill of warped rasters outside their footprint, read as the stack's
+    nodata, so every band of a patch flags missing data with the same value.
+
+    Offers the parts of the rasterio.DatasetReader interface the pipeline uses: the grid
+    and CRS of the first raster, its block shapes for grouped reads, read() and
+    dataset_mask() of windows, with the mask valid where every raster is valid.
+
+    Args:
+        paths (list): Local paths or s3:// URLs, the first one defining the grid.
+        cache_dir (str, optional): On-disk block cache for S3 rasters. Defaults to None.
+        resampling (Resampling, optional): Resampling of warped rasters. Defaults to bilinear.
+    """
+
+    def __init__(
+        self,
+        paths: list,
+        cache_dir: Optional[str] = None,
+        resampling: Resampling = Resampling.bilinear,
+    ):
+        self.name = list(paths)
+        self.threads = [ThreadPoolExecutor(1) for _ in paths]
+        opened = [
+            thread.submit(open_cached, path, cache_dir)
+            for thread, path in zip(self.threads, paths)
+        ]
+        sources = [task.result() for task in opened]
+        primary = self.primary = sources[0]
+
+        self.count = sum(src.count for src in sources)
+        dtype = np.result_type(*(src.dtypes[0] for src in sources))
+        self.dtype = np.dtype(dtype).name
+        self.dtypes = (self.dtype,) * self.count
+        self.nodata = next((s.nodata for s in sources if s.nodata is not None), None)
+        if self.nodata is not None:
+            self.nodata = np.dtype(self.dtype).type(self.nodata).item()
+        self.meta = dict(
+            primary.meta, count=self.count, dtype=self.dtype, nodata=self.nodata
+        )
+        warped = [
+            thread.submit(self._warp, src, primary, resampling, self.nodata)
+            for thread, src in zip(self.threads[1:], sources[1:])
+        ]
+        self.sources = [(primary, None)] + [
+            (src, task.result()) for src, task in zip(sources[1:], warped)
+        ]
+        self.mask_flag_enums = tuple(
+            flags for src, vrt in self.sources for flags in (vrt or src).mask_flag_enums
+        )
+
+    @staticmethod
+    def _warp(source, primary, resampling, nodata) -> Optional[WarpedVRT]:
+        """A WarpedVRT of a raster onto the primary grid, None for a raster already on it"""
+        if _on_grid(source, primary):
+            return None
+        logging.info(f"Warping {source.name} onto the grid of {primary.name}")
+        # The fill outside the raster's footprint is its nodata, remapped on read
+        fill = source.nodata
+        if fill is None and nodata is not None:
+            if _fits(nodata, source.dtypes[0]):
+                fill = nodata
+            else:
+                logging.warning(
+                    f"{source.name} has no nodata and can't hold {nodata}, the area "
+                    "outside its footprint reads as 0"
+                )
+        return WarpedVRT(
+            source,
+            crs=primary.crs,
+            transform=primary.transform,
+            width=primary.width,
+            height=primary.height,
+            resampling=resampling,
+            nodata=fill,
+        )
+
+    def __getattr__(self, name):
+        # Grid, georeferencing and block layout come from the first raster
+        if name in PRIMARY_ATTRIBUTES:
+            return getattr(self.primary, name)
+        raise AttributeError(name)
+
+    def _each(self, method: str, **kwargs) -> list:
+        """Call a method of every (warped) raster on its own thread, return the results"""
+        tasks = [
+            thread.submit(lambda s: getattr(s, method)(**kwargs), vrt or src)
+            for thread, (src, vrt) in zip(self.threads, self.sources)
+        ]
+        return [task.result() for task in tasks]
+
+    def _boundless(self, method: str, window: Window, fill, bands: int, **kwargs):
+        """Read a window reaching past the raster edge, padding it with `fill`"""
+        window = Window(
+            int(window.col_off),
+            int(window.row_off),
+            int(window.width),
+            int(window.height),
+        )
+        out = np.full(
+            (bands, window.height, window.width), fill, dtype=kwargs.pop("dtype")
+        )
+        col0, row0 = max(window.col_off, 0), max(window.row_off, 0)
+        col1 = min(window.col_off + window.width, self.width)
+        row1 = min(window.row_off + window.height, self.height)
+        if col1 > col0 and row1 > row0:
+            inner = Window(col0, row0, col1 - col0, row1 - row0)
+            out[
+                :,
+                row0 - window.row_off : row1 - window.row_off,
+                col0 - window.col_off : col1 - window.col_off,
+            ] = getattr(self, method)(window=inner, **kwargs)
+        return out
+
+    def read(
+        self,
+        window: Optional[Window] = None,
+        boundless: bool = False,
+        fill_value: Optional[Union[int, float]] = None,
+    ) -> np.ndarray:
+        """Read the stacked bands of a window, like rasterio.DatasetReader.read"""
+        if boundless:
+            fill = fill_value if fill_value is not None else self.nodata or 0
+            return self._boundless("read", window, fill, self.count, dtype=self.dtype)
+        if self.nodata is None:
+            arrays = self._each("read", window=window)
+            return np.concatenate([a.astype(self.dtype, copy=False) for a in arrays])
+        # Masked reads flag each raster's own nodata, which becomes the stack's
+        arrays = self._each("read", window=window, masked=True)
+        return np.concatenate(
+            [a.astype(self.dtype, copy=False).filled(self.nodata) for a in arrays]
+        )
+
+    def dataset_mask(
+        self,
+        window: Optional[Window] = None,
+        boundless: bool = False,
+        out_shape: Optional[tuple] = None,
+    ) -> np.ndarray:
+        """Mask of a window, 255 where every raster is valid and 0 elsewhere"""
+        if boundless:
+            mask = self._boundless("dataset_mask", window, 0, 1, dtype=np.uint8)
+            return mask[0]
+        masks = self._each("dataset_mask", window=window, out_shape=out_shape)
+        return np.minimum.reduce(masks)
+
+    def close(self) -> None:
+        """Close every raster on the thread that opened it"""
+        for thread, (src, vrt) in zip(self.threads, self.sources):
+            if vrt is not None:
+                thread.submit(vrt.close).result()
+            thread.submit(src.close).result()
+            thread.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
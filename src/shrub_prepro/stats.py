@@ -0,0 +1,365 @@
+import os
+import glob
+import json
+import logging
+import threading
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+# Histogram bins per band, spread over the value range of integer rasters
+HISTOGRAM_BINS = 256
+
+# Integer rasters with at most this many distinct values are counted value by value
+MAX_EXACT_LEVELS = 2**16
+
+# Patches per line of a PatchStatsLog
+STATS_BATCH = 256
+
+
+class BandStats:
+    """
+    Per-band count, mean, variance, range and histogram of pixels, updated one patch at a time.
+
+    Means and variances are accumulated with Chan et al.'s pairwise form of Welford's
+    algorithm: each patch contributes its own mean and sum of squared deviations, so the
+    result is numerically stable and two accumulators merge exactly. Histograms have
+    HISTOGRAM_BINS bins over the full value range of integer dtypes, and are left out for
+    floating point rasters, whose range isn't known up front.
+
+    8 and 16 bit patches are counted per value with np.bincount on their native dtype,
+    and their mean, deviations and range follow from those counts, so the pixels are
+    never copied to float64. Other dtypes take the float64 path.
+
+    Args:
+        bands (int): Number of bands.
+        dtype (str): Data type of the pixels.
+    """
+
+    def __init__(self, bands: int, dtype: str):
+        self.dtype = np.dtype(dtype)
+        self.patches = 0
+        self.count = 0
+        self.mean = np.zeros(bands)
+        self.m2 = np.zeros(bands)
+        self.min = np.full(bands, np.inf)
+        self.max = np.full(bands, -np.inf)
+        self.histogram = None
+        self.levels = None
+        if self.dtype.kind in "ui":
+            info = np.iinfo(self.dtype)
+            self.range = (int(info.min), int(info.max) + 1)
+            self.histogram = np.zeros((bands, HISTOGRAM_BINS), dtype=np.int64)
+            if self.range[1] - self.range[0] <= MAX_EXACT_LEVELS:
+                self.levels = np.arange(*self.range, dtype=np.float64)
+
+    def update(self, data: np.ndarray, nodata: Optional[float] = None) -> None:
+        """
+        Add the pixels of one patch, skipping pixels that are nodata in every band.
+
+        Args:
+            data (np.ndarray): Pixels of shape (bands, rows, cols).
+            nodata (float, optional): The raster's nodata value, NaN included. Defaults to None.
+        """
+        values = data.reshape(data.shape[0], -1)
+        missing = None
+        if nodata is not None:
+            missing = np.isnan(values) if np.isnan(nodata) else values == nodata
+            missing = missing.all(axis=0)
+        self.patches += 1
+        if self.levels is not None:
+            skipped = 0 if missing is None else int(missing.sum())
+            self._add_counts(values, nodata, skipped)
+            return
+        if missing is not None and missing.any():
+            values = values[:, ~missing]
+        if values.shape[1]:
+            self._add_pixels(values)
+
+    def _add_counts(
+        self, values: np.ndarray, nodata: Optional[float] = None, skipped: int = 0
+    ) -> None:
+        """
+        Add integer pixels of shape (bands, n) from their exact per-value counts.
+        The `skipped` pixels that are nodata in every band are taken off the counts.
+        """
+        n = values.shape[1] - skipped
+        if not n:
+            return
+        lo, hi = self.range
+        counts = np.stack(
+            [
+                np.bincount(
+                    band if lo == 0 else band.astype(np.int64) - lo, minlength=hi - lo
+                )
+                for band in values
+            ]
+        )
+        if skipped:
+            counts[:, int(nodata) - lo] -= skipped
+        mean = counts @ self.levels / n
+        m2 = (counts * (self.levels - mean[:, None]) ** 2).sum(axis=1)
+        self._combine(n, mean, m2)
+        present = counts > 0
+        first = present.argmax(axis=1)
+        last = present.shape[1] - 1 - present[:, ::-1].argmax(axis=1)
+        self.min = np.minimum(self.min, self.levels[first])
+        self.max = np.maximum(self.max, self.levels[last])
+        self.histogram += counts.reshape(len(counts), HISTOGRAM_BINS, -1).sum(axis=2)
+
+    def _add_pixels(self, values: np.ndarray) -> None:
+        """Add pixels of shape (bands, n) through a float64 copy"""
+        n = values.shape[1]
+        values = values.astype(np.float64)
+        mean = values.mean(axis=1)
+        m2 = ((values - mean[:, None]) ** 2).sum(axis=1)
+        self._combine(n, mean, m2)
+        self.min = np.minimum(self.min, values.min(axis=1))
+        self.max = np.maximum(self.max, values.max(axis=1))
+        if self.histogram is not None:
+            lo, hi = self.range
+            bins = ((values - lo) * HISTOGRAM_BINS // (hi - lo)).astype(np.int64)
+            for band, band_bins in enumerate(bins):
+                self.histogram[band] += np.bincount(band_bins, minlength=HISTOGRAM_BINS)
+
+    def _combine(self, n: int, mean: np.ndarray, m2: np.ndarray) -> None:
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * n / total
+        self.count = total
+
+    def merge(self, other: "BandStats") -> None:
+        """Add the pixels counted by another accumulator, e.g. from a worker process"""
+        self.patches += other.patches
+        if other.count:
+            self._combine(other.count, other.mean, other.m2)
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+        if self.histogram is not None:
+            self.histogram += other.histogram
+
+    def to_row(self) -> dict:
+        """The exact state of the accumulator as plain data, see from_row"""
+        return {
+            "patches": self.patches,
+            "count": self.count,
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "histogram": None if self.histogram is None else self.histogram.tolist(),
+        }
+
+    @classmethod
+    def from_row(cls, row: dict, dtype: str) -> "BandStats":
+        """Restore an accumulator saved with to_row"""
+        stats = cls(len(row["mean"]), dtype)
+        stats.patches = row["patches"]
+        stats.count = row["count"]
+        for name in ("mean", "m2", "min", "max"):
+            setattr(stats, name, np.array(row[name], dtype=np.float64))
+        if stats.histogram is not None:
+            stats.histogram = np.array(row["histogram"], dtype=np.int64)
+        return stats
+
+    def to_dict(self) -> dict:
+        """Summary for the JSON sidecar, with the population standard deviation"""
+        empty = not self.count
+        summary = {
+            "patches": self.patches,
+            "pixels": self.count,
+            "mean": None if empty else self.mean.tolist(),
+            "std": None if empty else np.sqrt(self.m2 / self.count).tolist(),
+            "min": None if empty else self.min.tolist(),
+            "max": None if empty else self.max.tolist(),
+        }
+        if self.histogram is not None:
+            summary["histogram"] = {
+                "range": list(self.range),
+                "counts": self.histogram.tolist(),
+            }
+        return summary
+
+
+class PatchStatsLog:
+    """
+    Append-only log of the band statistics of written patches, one JSON line per batch.
+
+    Patches are added to one BandStats per (split, shrubs or background) group, and a
+    group is logged with the ids of its patches once it holds `batch` patches, and when
+    the log closes. A line is only valid while all of its patches are completed; see
+    read_stats_lines. Runs that leave the split to a later merge log every patch on its
+    own line (`batch` 1), so the merge can regroup them. Safe to share between threads.
+
+    Args:
+        path (str): Path of the log, {part}.stats.jsonl next to the part's completion log.
+        bands (int): Number of bands.
+        dtype (str): Data type of the pixels.
+        nodata (float, optional): The raster's nodata value. Defaults to None.
+        batch (int): Patches per logged line. Defaults to STATS_BATCH.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        bands: int,
+        dtype: str,
+        nodata: Optional[float] = None,
+        batch: int = STATS_BATCH,
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.bands = bands
+        self.dtype = str(dtype)
+        self.nodata = nodata
+        self.batch = batch
+        self.pending = {}
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def record(
+        self, patch_id: str, split: Optional[str], positive: bool, data: np.ndarray
+    ) -> None:
+        """Add the pixels of one patch to its group, and log the group once it is full"""
+        stats = BandStats(self.bands, self.dtype)
+        stats.update(data, self.nodata)
+        key = (split if isinstance(split, str) else None, bool(positive))
+        with self.lock:
+            if key not in self.pending:
+                self.pending[key] = (BandStats(self.bands, self.dtype), [])
+            group, patch_ids = self.pending[key]
+            group.merge(stats)
+            patch_ids.append(patch_id)
+            if len(patch_ids) >= self.batch:
+                self._write(key)
+
+    def _write(self, key: tuple) -> None:
+        group, patch_ids = self.pending.pop(key)
+        split, positive = key
+        line = dict(group.to_row(), split=split, positive=positive, patch_ids=patch_ids)
+        self.file.write(json.dumps(line) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        """Log the groups that aren't full yet and close the file"""
+        with self.lock:
+            for key in list(self.pending):
+                self._write(key)
+        self.file.close()
+
+
+def read_stats_lines(directory: str) -> Iterator[dict]:
+    """
+    Yield the lines of the PatchStatsLog files in a folder, skipping lines cut off by a
+    crash. Lines are read one at a time, so the logs are never all in memory.
+
+    Args:
+        directory (str): Folder of PatchStatsLog files, see runs.done_dir.
+
+    Yields:
+        dict: BandStats.to_row() of a batch of patches, with its split, positive and
+            patch_ids.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, "*.stats.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+
+
+def write_stats_lines(path: str, lines: Iterable[dict]) -> None:
+    """Write lines of read_stats_lines to a log that it reads back"""
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(json.dumps(line) + "\n")
+
+
+class PatchStats:
+    """
+    BandStats of the written patches, grouped by split and by shrub or background patch.
+
+    Args:
+        bands (int): Number of bands.
+        dtype (str): Data type of the pixels.
+        nodata (float, optional): The raster's nodata value. Defaults to None.
+    """
+
+    def __init__(self, bands: int, dtype: str, nodata: Optional[float] = None):
+        self.bands = bands
+        self.dtype = str(dtype)
+        self.nodata = nodata
+        self.groups = {}
+
+    def add(self, row: dict, split: Optional[str], positive: bool) -> None:
+        """Add logged statistics to their (split, shrubs or background) group"""
+        key = (split if isinstance(split, str) else None, bool(positive))
+        if key not in self.groups:
+            self.groups[key] = BandStats(self.bands, self.dtype)
+        self.groups[key].merge(BandStats.from_row(row, self.dtype))
+
+    @classmethod
+    def from_logs(
+        cls,
+        plan,
+        lines: Iterable[dict],
+        bands: int,
+        dtype: str,
+        nodata: Optional[float] = None,
+    ) -> "PatchStats":
+        """
+        Group logged band statistics by the split of their patches in a plan.
+
+        Args:
+            plan (pd.DataFrame): Window plan with patch_id, split and positive columns.
+            lines (Iterable[dict]): Lines of PatchStatsLog files, see read_stats_lines.
+                Lines with patches that aren't in the plan are left out. The patches of
+                a line share their split, so the line goes to the group of its first.
+            bands (int): Number of bands.
+            dtype (str): Data type of the pixels.
+            nodata (float, optional): The raster's nodata value. Defaults to None.
+
+        Returns:
+            PatchStats: The grouped statistics.
+        """
+        groups = dict(zip(plan.patch_id, zip(plan.split, plan.positive)))
+        stats = cls(bands, dtype, nodata)
+        for line in lines:
+            patch_ids = line["patch_ids"]
+            if all(p in groups for p in patch_ids):
+                stats.add(line, *groups[patch_ids[0]])
+        return stats
+
+    def _total(self, keys: list) -> BandStats:
+        total = BandStats(self.bands, self.dtype)
+        for key in keys:
+            total.merge(self.groups[key])
+        return total
+
+    def to_dict(self) -> dict:
+        """
+        Summaries of every group ("train/shrubs", "test/background", or "shrubs" and
+        "background" without a split), of every split, and of all patches ("all").
+        """
+        groups = {}
+        for split, positive in sorted(self.groups, key=str):
+            kind = "shrubs" if positive else "background"
+            name = kind if split is None else f"{split}/{kind}"
+            groups[name] = self.groups[(split, positive)].to_dict()
+        for split in sorted({s for s, _ in self.groups if s is not None}):
+            groups[split] = self._total(
+                [k for k in self.groups if k[0] == split]
+            ).to_dict()
+        groups["all"] = self._total(list(self.groups)).to_dict()
+        return {
+            "bands": self.bands,
+            "dtype": self.dtype,
+            "nodata": self.nodata,
+            "groups": groups,
+        }
+
+    def save(self, path: str, **extra) -> None:
+        """Write the summaries, with any `extra` top-level fields, to a JSON file"""
+        with open(path, "w") as f:
+            json.dump(dict(self.to_dict(), **extra), f, indent=2)
+        patches = sum(s.patches for s in self.groups.values())
+        logging.info(f"Wrote band statistics of {patches} patches to {path}")
@@ -0,0 +1,224 @@
+import logging
+import importlib.util
+from typing import Iterator, Optional
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import rasterio
+from rasterio.transform import rowcol
+
+from shrub_prepro.coverage import plan_coverage
+from shrub_prepro.images import (
+    DEFAULT_BACKGROUND_BUFFER,
+    background_samples,
+    plan_background,
+    plan_windows,
+    window_bounds_array,
+)
+from shrub_prepro.mask import ValidMask
+from shrub_prepro.runs import polygon_table
+
+
+def read_polygons_bbox(path: str, bbox: tuple) -> gpd.GeoDataFrame:
+    """
+    Read the polygons whose envelope intersects a bounding box, indexed by feature id.
+
+    Reads through Arrow when pyarrow is installed.
+
+    Args:
+        path (str): A polygon file pyogrio can read.
+        bbox (tuple): (minx, miny, maxx, maxy) in the layer CRS.
+
+    Returns:
+        gpd.GeoDataFrame: The polygons, indexed by their feature id.
+    """
+    return gpd.read_file(
+        path,
+        bbox=tuple(bbox),
+        engine="pyogrio",
+        fid_as_index=True,
+        use_arrow=importlib.util.find_spec("pyarrow") is not None,
+    )
+
+
+def layer_info(path: str) -> tuple:
+    """Return the feature count and (minx, miny, maxx, maxy) of a polygon layer"""
+    info = pyogrio.read_info(path, force_total_bounds=True)
+    return info["features"], tuple(info["total_bounds"])
+
+
+def polygon_tiles(image: rasterio.DatasetReader, bounds: tuple, tile_size: int) -> list:
+    """
+    Cover the pixel extent of `bounds` with a grid of square tiles of `tile_size` pixels.
+
+    Tiles are aligned to multiples of tile_size from the raster origin, so the grid is the
+    same for every run over the raster, and listed row by row.
+
+    Returns:
+        list: (tile_row, tile_col) of every tile, in read order.
+    """
+    rows, cols = rowcol(
+        image.transform,
+        [bounds[0], bounds[2], bounds[2], bounds[0]],
+        [bounds[3], bounds[3], bounds[1], bounds[1]],
+    )
+    return [
+        (r, c)
+        for r in range(min(rows) // tile_size, max(rows) // tile_size + 1)
+        for c in range(min(cols) // tile_size, max(cols) // tile_size + 1)
+    ]
+
+
+def tile_bounds(
+    image: rasterio.DatasetReader, tile: tuple, tile_size: int, halo: float = 0
+) -> tuple:
+    """Return the (minx, miny, maxx, maxy) of a tile, grown by `halo` pixels on each side"""
+    left, bottom, right, top = window_bounds_array(
+        np.array([tile[1] * tile_size - halo]),
+        np.array([tile[0] * tile_size - halo]),
+        tile_size + 2 * halo,
+        image.transform,
+    )
+    return left[0], bottom[0], right[0], top[0]
+
+
+def plan_streaming(
+    polygons_path: str,
+    image: rasterio.DatasetReader,
+    window_size: int,
+    tile_size: int,
+    seed: Optional[int] = None,
+    valid_mask: Optional[ValidMask] = None,
+    sample_background: bool = True,
+    background_buffer: float = DEFAULT_BACKGROUND_BUFFER,
+    coverage: Optional[str] = None,
+) -> tuple:
+    """
+    Plan shrub and background windows tile by tile, holding one tile of polygons at a time.
+
+    Each polygon belongs to the tile holding its centroid pixel and is planned there, as
+    plan_windows would plan it. Background windows are drawn with centres in the tile, twice
+    as many as the tile has polygons, and rejected against the polygons of the tile and a
+    halo of half a window and the background buffer around it. Tile i samples
+    with the seed sequence (seed, i), so the plan only depends on the seed and the tiling.
+
+    Args:
+        polygons_path (str): Local path of the polygon layer.
+        image (rasterio.DatasetReader): The raster the windows index into.
+        window_size (int): Size of the patches in pixels.
+        tile_size (int): Size of the tiles in pixels.
+        seed (int, optional): Seed for background sampling. Defaults to None.
+        valid_mask (ValidMask, optional): Valid-data mask for background sampling. Defaults to None.
+        sample_background (bool, optional): Draw background windows. Defaults to True.
+        background_buffer (float, optional): Minimum distance between background windows and
+            any polygon, see background_samples. Defaults to 5.
+        coverage (str, optional): Coverage method to thin the shrub windows of each tile
+            with, see coverage.plan_coverage. Defaults to None, one window per shrub.
+
+    Returns:
+        tuple: Shrub plan, background plan (see plan_windows and plan_background), and the
+            polygon_table of every polygon.
+    """
+    features, bounds = layer_info(polygons_path)
+    pixel = max(abs(image.transform.a), abs(image.transform.e))
+    plans, backgrounds, tables = [], [], []
+    n_background = 0
+    for i, tile in enumerate(polygon_tiles(image, bounds, tile_size)):
+        core = tile_bounds(image, tile, tile_size)
+        # A pixel of margin keeps centroids on the tile edge from falling between reads
+        shrubs = read_polygons_bbox(
+            polygons_path, tile_bounds(image, tile, tile_size, 1)
+        )
+        if not len(shrubs):
+            continue
+        centroids = shrubs.geometry.centroid
+        rows, cols = rowcol(
+            image.transform, centroids.x.to_numpy(), centroids.y.to_numpy()
+        )
+        owned = (np.asarray(rows) // tile_size == tile[0]) & (
+            np.asarray(cols) // tile_size == tile[1]
+        )
+        shrubs = shrubs[owned]
+        if not len(shrubs):
+            continue
+        tile_plan = plan_windows(shrubs, image, window_size)
+        if coverage:
+            tile_plan = plan_coverage(tile_plan, shrubs, image, method=coverage)
+        plans.append(tile_plan)
+        tables.append(polygon_table(shrubs))
+
+        if not sample_background:
+            continue
+        halo = read_polygons_bbox(
+            polygons_path,
+            tile_bounds(
+                image, tile, tile_size, window_size / 2 + background_buffer / pixel + 1
+            ),
+        )
+        windows = background_samples(
+            image,
+            halo,
+            window_size=window_size,
+            seed=None if seed is None else np.random.SeedSequence([seed, i]),
+            valid_mask=valid_mask,
+            bounds=(
+                max(core[0], bounds[0]),
+                max(core[1], bounds[1]),
+                min(core[2], bounds[2]),
+                min(core[3], bounds[3]),
+            ),
+            num_samples=2 * len(shrubs),
+            buffer=background_buffer,
+        )
+        # Ids continue after the feature count, like the total_shrubs offset of a full read
+        backgrounds.append(plan_background(windows, start=features + n_background))
+        n_background += len(windows)
+
+    logging.info(
+        f"Planned {sum(map(len, plans))} shrub and {n_background} background windows "
+        f"from {len(plans)} tiles"
+    )
+    plan = pd.concat([plan_background([])] + plans, ignore_index=True)
+    background = pd.concat([plan_background([])] + backgrounds, ignore_index=True)
+    table = pd.concat([polygon_table(gpd.GeoDataFrame(geometry=[]))] + tables)
+    return plan, background, table
+
+
+def tiled_plan(
+    plan: pd.DataFrame,
+    polygons_path: str,
+    image: rasterio.DatasetReader,
+    tile_size: int,
+) -> Iterator[tuple]:
+    """
+    Split a plan of shrub windows into tiles and read the polygons each tile needs.
+
+    Windows are grouped by the tile holding their centre. Every polygon that intersects
+    the envelope of a group's windows is read with it, so patches straddling tile edges
+    get complete labels.
+
+    Yields:
+        tuple: (tile number, plan rows of the tile, polygons for labelling them).
+    """
+    if not len(plan):
+        return
+    centre_row = (plan.row_off.to_numpy() + plan["size"].to_numpy() / 2) // tile_size
+    centre_col = (plan.col_off.to_numpy() + plan["size"].to_numpy() / 2) // tile_size
+    _, tile = np.unique(
+        np.stack([centre_row, centre_col], axis=1), axis=0, return_inverse=True
+    )
+    tile = tile.ravel()
+    order = np.argsort(tile, kind="stable")
+    groups = np.split(order, np.flatnonzero(np.diff(tile[order])) + 1)
+    for i, positions in enumerate(groups):
+        rows = plan.iloc[positions]
+        left, bottom, right, top = window_bounds_array(
+            rows.col_off.to_numpy(),
+            rows.row_off.to_numpy(),
+            rows["size"].to_numpy(),
+            image.transform,
+        )
+        bbox = (left.min(), bottom.min(), right.max(), top.max())
+        yield i, rows, read_polygons_bbox(polygons_path, bbox)
@@ -0,0 +1,129 @@
+import os
+import logging
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+from shrub_prepro.images import (
+    background_label,
+    label_patch_with_window,
+    shrub_labels_in_window,
+)
+from shrub_prepro.io import save_image_patch, save_label_patch
+from shrub_prepro.remote import configure_remote_access
+from shrub_prepro.stack import any_remote, open_input
+from shrub_prepro.streaming import read_polygons_bbox
+
+
+def tile_offsets(length: int, tile_size: int, overlap: int = 0) -> list:
+    """
+    Offsets of tiles covering `length` pixels, `tile_size - overlap` apart.
+
+    The last tile is moved back to end on the raster edge instead of running past it, so
+    it overlaps its neighbour more. A raster smaller than one tile gets a single tile.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(
+            f"Tile overlap must be at least 0 and less than the tile size, got {overlap}"
+        )
+    last = max(length - tile_size, 0)
+    offsets = list(range(0, last + 1, tile_size - overlap))
+    if offsets[-1] != last:
+        offsets.append(last)
+    return offsets
+
+
+def tile_raster(
+    raster_path,
+    output_dir,
+    label: str = "tile",
+    tile_size: int = 512,
+    overlap: int = 0,
+    polygons_path: Optional[str] = None,
+    remote_cache_dir: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Cut a whole raster into fixed-size tiles, e.g. for inference.
+
+    The raster is streamed one row of tiles at a time: each row is one read of a strip
+    `tile_size` pixels high, together with its dataset mask, so memory is bounded by the
+    raster width. Tiles without any valid pixel in the mask are skipped. With polygons,
+    the ones intersecting a strip are read for it and rasterized into a label per tile.
+
+    Tiles are written as {label}_{row}.{col}.tif into the images/ (and labels/) folders of
+    output_dir, numbering tiles in grid order, and listed in output_dir/tiles.csv.
+
+    Args:
+        raster_path (str): Local or S3 path of the raster, or a list of rasters to stack, see
+            stack.open_input.
+        output_dir (str): Directory for the tiles.
+        label (str, optional): Prefix of the tile file names. Defaults to "tile".
+        tile_size (int, optional): Height and width of the tiles in pixels. Defaults to 512.
+        overlap (int, optional): Pixels shared by neighbouring tiles. Defaults to 0.
+        polygons_path (str, optional): Polygon layer to rasterize labels from. Defaults to None.
+        remote_cache_dir (str, optional): On-disk block cache for an S3 raster, see
+            remote.open_cached. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The written tiles with columns tile_id, col_off, row_off and size.
+    """
+    images_dir = os.path.join(str(output_dir), "images")
+    labels_dir = os.path.join(str(output_dir), "labels")
+    os.makedirs(images_dir, exist_ok=True)
+    if polygons_path is not None:
+        os.makedirs(labels_dir, exist_ok=True)
+    if any_remote(raster_path):
+        configure_remote_access()
+
+    written = []
+    skipped = 0
+    with open_input(raster_path, remote_cache_dir) as image:
+        cols = tile_offsets(image.width, tile_size, overlap)
+        rows = tile_offsets(image.height, tile_size, overlap)
+        # Rasters smaller than a tile are padded past their edges
+        boundless = image.width < tile_size or image.height < tile_size
+        for i, row_off in enumerate(rows):
+            strip = Window(0, row_off, max(image.width, tile_size), tile_size)
+            data = image.read(
+                window=strip, boundless=boundless, fill_value=image.nodata or 0
+            )
+            mask = image.dataset_mask(window=strip, boundless=boundless)
+            polygons = None
+            if polygons_path is not None:
+                bounds = rasterio.windows.bounds(strip, image.transform)
+                polygons = read_polygons_bbox(polygons_path, bounds).geometry
+
+            for j, col_off in enumerate(cols):
+                if not mask[:, col_off : col_off + tile_size].any():
+                    skipped += 1
+                    continue
+                tile_id = f"{i}.{j}"
+                window = Window(col_off, row_off, tile_size, tile_size)
+                save_image_patch(
+                    window,
+                    image,
+                    tile_id,
+                    label,
+                    images_dir,
+                    data=data[:, :, col_off : col_off + tile_size],
+                )
+                if polygons is not None:
+                    labels = shrub_labels_in_window(polygons, window, image)
+                    if len(labels):
+                        arr = label_patch_with_window(labels, window, image)
+                    else:
+                        arr = background_label(tile_size)
+                    save_label_patch(arr, window, image, tile_id, label, labels_dir)
+                written.append((tile_id, col_off, row_off))
+
+    tiles = pd.DataFrame(written, columns=["tile_id", "col_off", "row_off"])
+    tiles["size"] = np.full(len(tiles), tile_size, dtype=np.int64)
+    tiles.to_csv(os.path.join(str(output_dir), "tiles.csv"), index=False)
+    logging.info(
+        f"Wrote {len(tiles)} tiles of {tile_size} pixels with {overlap} pixels of overlap, "
+        f"skipped {skipped} without valid data"
+    )
+    return tiles
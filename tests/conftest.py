@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import pytest
 import numpy as np
 import rasterio
@@ -43,3 +45,90 @@ def sample_polygons(tmp_path):
     poly_path = tmp_path / "sample_polygons.gpkg"
     gdf.to_file(poly_path, driver="GPKG")
     return poly_path
+
+
+@pytest.fixture
+def survey_inputs(tmp_path):
+    """A 64x64 raster in metres with a handful of small shrubs."""
+    raster_path = tmp_path / "input" / "survey.tif"
+    raster_path.parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(
+        raster_path,
+        "w",
+        driver="GTiff",
+        height=64,
+        width=64,
+        count=3,
+        dtype=rasterio.uint8,
+        crs="EPSG:32633",
+        transform=rasterio.transform.from_bounds(0, 0, 64, 64, 64, 64),
+    ) as dst:
+        rng = np.random.default_rng(0)
+        dst.write(rng.integers(1, 255, size=(3, 64, 64), dtype=np.uint8))
+
+    polygons = [
+        Polygon([(x, y), (x + 3, y), (x + 3, y + 3), (x, y + 3)])
+        for x, y in [(10, 10), (14, 12), (40, 45), (50, 20), (20, 50)]
+    ]
+    polygon_path = tmp_path / "input" / "survey.gpkg"
+    gpd.GeoDataFrame({"geometry": polygons}, crs="EPSG:32633").to_file(polygon_path)
+    return raster_path, polygon_path
+
+
+@pytest.fixture
+def collar_raster(tmp_path):
+    """A 64x64 raster whose left half is nodata."""
+    path = tmp_path / "collar.tif"
+    data = np.random.randint(1, 255, size=(3, 64, 64), dtype=np.uint8)
+    data[:, :, :32] = 0
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=64,
+        width=64,
+        count=3,
+        dtype=np.uint8,
+        crs="EPSG:32633",
+        transform=from_bounds(500000, 0, 500640, 640, 64, 64),
+        nodata=0,
+    ) as dst:
+        dst.write(data)
+    return path
+
+
+@pytest.fixture
+def moto_s3(monkeypatch):
+    """The shared S3 filesystem, pointed at a local moto server with a "shrubs" bucket."""
+    moto_server = pytest.importorskip("moto.server")
+    from shrub_prepro import remote
+
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    monkeypatch.setenv("AWS_ENDPOINT_URL", f"http://{host}:{port}")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_NO_SIGN_REQUEST", "NO")
+    remote.get_s3_filesystem.cache_clear()
+
+    fs = remote.get_s3_filesystem()
+    fs.makedirs("shrubs", exist_ok=True)
+    yield fs
+
+    remote.get_s3_filesystem.cache_clear()
+    server.stop()
+
+
+@pytest.fixture
+def read_outputs():
+    """Map relative path to (pixels, transform) for every GeoTIFF under an output dir."""
+
+    def read(output_dir):
+        outputs = {}
+        for path in sorted(Path(output_dir).rglob("*.tif")):
+            with rasterio.open(path) as src:
+                outputs[str(path.relative_to(output_dir))] = (src.read(), src.transform)
+        return outputs
+
+    return read
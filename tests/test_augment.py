@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from shrub_prepro.augment import AUGMENTATIONS, augment_patch
+from shrub_prepro.processing import process_data
+from shrub_prepro.runs import load_run
+
+
+def pixel_centres(transform, height, width):
+    """Ground coordinates of every pixel centre of an array."""
+    rows, cols = np.mgrid[0:height, 0:width] + 0.5
+    return transform * (cols, rows)
+
+
+def test_augment_patch_keeps_pixels_in_place():
+    """Every variant pixel sits at the same ground position as its source pixel."""
+    transform = rasterio.Affine(0.5, 0, 1000, 0, -0.5, 2000)
+    data = np.arange(2 * 4 * 4).reshape(2, 4, 4)
+    label = data[0] * 2
+    x, y = pixel_centres(transform, 4, 4)
+    for name, variant, variant_label, variant_transform in augment_patch(
+        data, label, transform, list(AUGMENTATIONS)
+    ):
+        assert np.shares_memory(variant, data)
+        vx, vy = pixel_centres(variant_transform, 4, 4)
+        cols, rows = ~transform * (vx, vy)
+        rows, cols = np.floor(rows).astype(int), np.floor(cols).astype(int)
+        assert np.array_equal(variant, data[:, rows, cols]), name
+        assert np.array_equal(variant_label, label[rows, cols]), name
+        assert not np.array_equal(variant, data), name
+
+
+def test_process_data_writes_variants(survey_inputs, tmp_path, monkeypatch):
+    """Variants are written next to their patch, in its split, without new raster reads."""
+    raster_path, polygon_path = survey_inputs
+    reads = []
+    read = rasterio.io.DatasetReader.read
+
+    def counting_read(self, *args, **kwargs):
+        reads.append(1)
+        return read(self, *args, **kwargs)
+
+    monkeypatch.setattr(rasterio.io.DatasetReader, "read", counting_read)
+    process_data(str(raster_path), polygon_path, tmp_path / "plain", "rgb", 8, seed=1)
+    plain_reads = len(reads)
+    reads.clear()
+    output_dir = tmp_path / "out"
+    process_data(
+        str(raster_path),
+        polygon_path,
+        output_dir,
+        "rgb",
+        8,
+        seed=1,
+        augmentations=["rot90", "flipud"],
+    )
+    assert len(reads) == plain_reads
+    monkeypatch.undo()
+
+    plan = load_run(str(output_dir)).plan
+    with rasterio.open(raster_path) as image:
+        for patch_id, split in zip(plan.patch_id, plan.split):
+            for name in ("rot90", "flipud"):
+                path = output_dir / split / "images" / f"rgb_{patch_id}-{name}.tif"
+                with rasterio.open(path) as variant:
+                    data = variant.read()
+                    x, y = pixel_centres(variant.transform, 8, 8)
+                    rows, cols = rasterio.transform.rowcol(image.transform, x, y)
+                    rows = np.reshape(rows, (8, 8))
+                    cols = np.reshape(cols, (8, 8))
+                    expected = image.read()[:, rows, cols]
+                    assert np.array_equal(data, expected)
+                assert (output_dir / split / "labels" / path.name).exists()
+
+
+def test_variants_in_npy_manifest(survey_inputs, tmp_path):
+    """NPY variants get manifest rows with the split of their patch."""
+    pytest.importorskip("pyarrow")
+    raster_path, polygon_path = survey_inputs
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "out",
+        "rgb",
+        8,
+        seed=1,
+        output_format="npy",
+        augmentations=["rot180"],
+    )
+    manifest = pd.read_parquet(tmp_path / "out" / "manifest.parquet")
+    assert len(manifest) == 30
+    by_id = manifest.set_index("patch_id")
+    for patch_id in manifest.patch_id[~manifest.patch_id.str.endswith("-rot180")]:
+        assert by_id.split[f"{patch_id}-rot180"] == by_id.split[patch_id]
@@ -0,0 +1,113 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+
+from shrub_prepro.cache import InputCache, fingerprint
+from shrub_prepro.processing import process_data
+from shrub_prepro.remote import RangeCache
+
+
+def test_derived_artifact_rebuilt_when_input_changes(tmp_path):
+    """Derived artifacts are reused while the input is unchanged, and rebuilt after."""
+    source = tmp_path / "input.txt"
+    source.write_text("first")
+    cache = InputCache(tmp_path / "cache")
+
+    def build(out):
+        with open(out, "w") as f:
+            f.write(source.read_text().upper())
+
+    path = cache.derived(source, "upper.txt", build)
+    assert open(path).read() == "FIRST"
+    assert cache.derived(source, "upper.txt", build) == path
+    assert cache.stats == {"hits": 1, "downloads": 0, "builds": 1}
+
+    before = fingerprint(source)
+    source.write_text("second!")
+    assert fingerprint(source) != before
+    assert open(cache.derived(source, "upper.txt", build)).read() == "SECOND!"
+    assert cache.stats["builds"] == 2
+
+
+def test_remote_polygons_fetched_once(tmp_path, moto_s3):
+    """A remote shapefile is downloaded with its sidecars once, then served as GeoParquet."""
+    polygons = gpd.GeoDataFrame(
+        {"geometry": [box(0, 0, 1, 1), box(2, 2, 3, 3)]}, crs="EPSG:32633"
+    )
+    polygons.to_file(tmp_path / "shrubs.shp")
+    for name in os.listdir(tmp_path):
+        if name.startswith("shrubs."):
+            moto_s3.put_file(str(tmp_path / name), f"s3://shrubs/cache/{name}")
+
+    cache = InputCache(tmp_path / "cache")
+    first = cache.read_polygons("s3://shrubs/cache/shrubs.shp")
+    assert first.crs == polygons.crs
+    assert first.geometry.geom_equals(polygons.geometry).all()
+    assert cache.stats == {"hits": 0, "downloads": 1, "builds": 1}
+
+    # A new run over the same directory downloads nothing
+    second = InputCache(tmp_path / "cache")
+    second_polygons = second.read_polygons("s3://shrubs/cache/shrubs.shp")
+    assert second_polygons.geometry.geom_equals(polygons.geometry).all()
+    assert second.stats == {"hits": 1, "downloads": 0, "builds": 0}
+
+
+def test_eviction_keeps_cache_within_cap(tmp_path):
+    """The least recently used entries are removed once the cap is exceeded."""
+    cache = InputCache(tmp_path / "cache", max_bytes=2500)
+    sources = []
+    for i in range(3):
+        source = tmp_path / f"input{i}.bin"
+        source.write_bytes(b"x")
+        sources.append(source)
+        cache.derived(source, "a.bin", lambda out: open(out, "wb").write(bytes(1000)))
+        os.utime(cache.derived(source, "a.bin", None).rsplit(os.sep, 1)[0], (i, i))
+
+    entries = [e for e in os.listdir(tmp_path / "cache") if len(e) == 64]
+    assert len(entries) == 2
+    # The oldest entry was evicted and is rebuilt on the next use
+    builds = cache.stats["builds"]
+    cache.derived(sources[0], "a.bin", lambda out: open(out, "wb").write(bytes(1000)))
+    assert cache.stats["builds"] == builds + 1
+
+
+def test_eviction_counts_range_blocks(tmp_path):
+    """S3 range blocks kept in the input cache count against its cap with the entries."""
+    cache = InputCache(tmp_path / "cache", max_bytes=6000)
+    payload = bytes(8 * 1024)
+    ranges = RangeCache(cache.ranges_dir, block_size=1024)
+    assert ranges.get_blocks("f", 0, 7, lambda start, end: payload[start:end])
+    source = tmp_path / "input.bin"
+    source.write_bytes(b"x")
+    cache.derived(source, "a.bin", lambda out: open(out, "wb").write(bytes(1000)))
+
+    size = sum(p.stat().st_size for p in (tmp_path / "cache").rglob("*") if p.is_file())
+    assert size <= 6000
+    # The entry just built is kept, the oldest range blocks made room for it
+    assert cache.derived(source, "a.bin", None)
+    assert len(os.listdir(cache.ranges_dir)) == 4
+
+
+def test_process_data_with_input_cache(survey_inputs, tmp_path):
+    """A run through the input cache writes the same patches as one without."""
+    raster, polygons = survey_inputs
+    for out, cache_dir in [("plain", None), ("cached", tmp_path / "cache")]:
+        process_data(
+            raster,
+            polygons,
+            tmp_path / out,
+            "rgb",
+            16,
+            seed=0,
+            input_cache_dir=cache_dir,
+        )
+    plain = sorted(
+        p.relative_to(tmp_path / "plain") for p in (tmp_path / "plain").rglob("*.tif")
+    )
+    cached = sorted(
+        p.relative_to(tmp_path / "cached") for p in (tmp_path / "cached").rglob("*.tif")
+    )
+    assert plain == cached
+    assert np.any([len(e) == 64 for e in os.listdir(tmp_path / "cache")])
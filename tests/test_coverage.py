@@ -0,0 +1,69 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from shapely.geometry import box
+
+from shrub_prepro.coverage import plan_coverage
+from shrub_prepro.images import plan_windows, window_bounds_array
+from shrub_prepro.processing import process_data
+from shrub_prepro.runs import load_run
+
+
+@pytest.fixture
+def clustered_shrubs():
+    """Two dense clusters of small shrubs, one lone shrub and one bigger than a patch."""
+    rng = np.random.default_rng(1)
+    corners = np.concatenate(
+        [rng.uniform(8, 14, size=(12, 2)), rng.uniform(40, 46, size=(8, 2))]
+    )
+    shrubs = [box(x, y, x + 1, y + 1) for x, y in corners]
+    shrubs += [box(30, 5, 31, 6), box(20, 30, 40, 50)]
+    return gpd.GeoDataFrame(geometry=shrubs, crs="EPSG:32633")
+
+
+@pytest.mark.parametrize("method", ["greedy", "grid"])
+def test_coverage_holds_every_shrub(survey_inputs, clustered_shrubs, method):
+    """Fewer windows are planned, and every small shrub lies whole inside one of them."""
+    raster_path, _ = survey_inputs
+    with rasterio.open(raster_path) as image:
+        plan = plan_windows(clustered_shrubs, image, 8)
+        reduced = plan_coverage(plan, clustered_shrubs, image, method=method)
+        windows = gpd.GeoSeries(
+            [
+                box(*b)
+                for b in zip(
+                    *window_bounds_array(
+                        reduced.col_off.to_numpy(),
+                        reduced.row_off.to_numpy(),
+                        8,
+                        image.transform,
+                    )
+                )
+            ]
+        )
+    assert len(reduced) < len(plan) - 10
+    assert reduced.patch_id.is_unique
+    assert set(reduced.patch_id) <= set(plan.patch_id)
+    # The huge shrub keeps its four windows
+    assert (reduced.shrub_id == 21).sum() == 4
+    for shrub in clustered_shrubs.geometry[:21]:
+        assert windows.covers(shrub).any()
+
+
+def test_coverage_run_writes_fewer_patches(survey_inputs, tmp_path):
+    """Two neighbouring shrubs share one patch, and the choice is part of the run key."""
+    raster_path, polygon_path = survey_inputs
+    process_data(
+        str(raster_path), polygon_path, tmp_path, "rgb", 16, seed=2, coverage="greedy"
+    )
+    state = load_run(str(tmp_path))
+    assert state.key["params"]["coverage"] == "greedy"
+    assert state.plan.positive.sum() == 4
+    assert len(list((tmp_path / "train" / "images").glob("*.tif"))) + len(
+        list((tmp_path / "test" / "images").glob("*.tif"))
+    ) == len(state.plan)
+
+    with pytest.raises(ValueError, match="Unknown coverage method"):
+        with rasterio.open(raster_path) as image:
+            plan_coverage(state.plan, gpd.read_file(polygon_path), image, "hex")
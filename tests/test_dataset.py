@@ -0,0 +1,48 @@
+import sys
+import types
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from shrub_prepro.dataset import ShrubPatchDataset
+from shrub_prepro.images import label_patch_with_window
+
+
+def test_dataset_yields_planned_patches(survey_inputs):
+    """Every planned window is yielded once, with its pixels, label and transform."""
+    raster_path, polygon_path = survey_inputs
+    dataset = ShrubPatchDataset(raster_path, polygon_path, 8, seed=3, batch_size=4)
+    shrubs = gpd.read_file(polygon_path)
+    assert len(dataset) == 15
+    patches = list(dataset)
+    assert len(patches) == 15
+    with rasterio.open(raster_path) as image:
+        seen = set()
+        for data, label, transform in patches:
+            col, row = ~image.transform * (transform.c, transform.f)
+            window = Window(round(col), round(row), 8, 8)
+            seen.add((window.col_off, window.row_off))
+            assert data.shape == (3, 8, 8)
+            assert np.array_equal(data, image.read(window=window, boundless=True))
+            assert np.array_equal(
+                label, label_patch_with_window(shrubs.geometry, window, image)
+            )
+    assert len(seen) == 15
+
+
+def test_dataset_splits_between_workers(survey_inputs, monkeypatch):
+    """Data loader workers get disjoint shares that together cover the dataset."""
+    raster_path, polygon_path = survey_inputs
+    dataset = ShrubPatchDataset(raster_path, polygon_path, 8, seed=3)
+    worker = types.SimpleNamespace(id=0, num_workers=3)
+    data = types.ModuleType("torch.utils.data")
+    data.get_worker_info = lambda: worker
+    monkeypatch.setitem(sys.modules, "torch.utils.data", data)
+
+    transforms = []
+    for worker.id in range(3):
+        transforms.append({tuple(t) for _, _, t in dataset})
+    assert all(transforms)
+    assert sum(map(len, transforms)) == len(set.union(*transforms)) == 15
@@ -1,6 +1,7 @@
 import numpy as np
 import rasterio
 import geopandas as gpd
+from shapely.geometry import box
 from shrub_prepro.images import (
     patch_window,
     shrub_window,
@@ -8,6 +9,11 @@ from shrub_prepro.images import (
     label_patch_with_window,
     background_label,
     background_samples,
+    LabelMosaic,
+    is_shrub_huge,
+    shrub_overlaps,
+    plan_windows,
+    plan_to_windows,
 )
 
 
@@ -84,3 +90,84 @@ def test_shrub_window(sample_polygons, sample_raster):
         assert isinstance(w, rasterio.windows.Window)
         assert w.height
         print(w.height)
+
+
+def test_shrub_labels_in_window_matches_full_intersection(
+    sample_polygons, sample_raster
+):
+    """The indexed lookup returns the same series as clipping every geometry."""
+    gdf = gpd.read_file(sample_polygons)
+    with rasterio.open(sample_raster) as img:
+        for geom in gdf.geometry:
+            window = patch_window(geom, img, patch_size=6)
+            expected = gdf.geometry.intersection(
+                box(*rasterio.windows.bounds(window, img.transform))
+            )
+            expected = expected[~expected.is_empty]
+            result = shrub_labels_in_window(gdf.geometry, window, img)
+            assert list(result.index) == list(expected.index)
+            assert result.geom_equals(expected).all()
+
+
+def test_background_samples_seeded(sample_polygons, sample_raster):
+    """The same seed gives the same windows, and none of them touch a shrub."""
+    gdf = gpd.read_file(sample_polygons)
+    with rasterio.open(sample_raster) as img:
+        first = background_samples(img, gdf, window_size=4, seed=7)
+        second = background_samples(img, gdf, window_size=4, seed=7)
+        assert first == second
+        buffered = gdf.geometry.buffer(5)
+        for w in first:
+            bbox = box(*rasterio.windows.bounds(w, img.transform))
+            assert not buffered.intersects(bbox).any()
+
+
+def test_background_samples_buffer(sample_polygons, sample_raster):
+    """Windows keep the configured distance from every shrub."""
+    gdf = gpd.read_file(sample_polygons)
+    with rasterio.open(sample_raster) as img:
+        windows = background_samples(img, gdf, window_size=4, seed=3, buffer=150)
+        assert windows
+        for w in windows:
+            bbox = box(*rasterio.windows.bounds(w, img.transform))
+            assert gdf.distance(bbox).min() > 150
+
+
+def test_label_mosaic_matches_per_window_labels(sample_polygons, sample_raster):
+    """Slices of the label mosaic equal rasterizing each window on its own."""
+    gdf = gpd.read_file(sample_polygons)
+    with rasterio.open(sample_raster) as img:
+        windows = [
+            rasterio.windows.Window(c, r, 6, 6)
+            for c in range(-3, 18, 2)
+            for r in range(-2, 18, 3)
+        ]
+        windows.append(rasterio.windows.Window(2.5, 14, 6, 6))
+        mosaic = LabelMosaic(gdf.geometry, windows, img)
+        for window in windows:
+            labels = shrub_labels_in_window(gdf.geometry, window, img)
+            expected = label_patch_with_window(labels, window, img)
+            result = mosaic.label(labels, window)
+            assert result.dtype == expected.dtype
+            assert np.array_equal(result, expected)
+
+
+def test_plan_windows_matches_per_shrub_windows(sample_polygons, sample_raster):
+    """The bulk planner gives the same windows as the per-shrub helpers."""
+    gdf = gpd.read_file(sample_polygons)
+    with rasterio.open(sample_raster) as img:
+        for size in (1, 4):
+            expected = []
+            for index, shrub in gdf.iterrows():
+                if is_shrub_huge(shrub_window(shrub, img), size):
+                    windows = shrub_overlaps(shrub, img, size)
+                else:
+                    windows = [patch_window(shrub.geometry, img, patch_size=size)]
+                expected += [(f"{index}.{i}", w) for i, w in enumerate(windows)]
+
+            plan = plan_windows(gdf, img, size)
+            assert list(plan.patch_id) == [p for p, _ in expected]
+            assert plan_to_windows(plan) == [w for _, w in expected]
+            assert plan.positive.all()
+        # The tall third shrub is split into four windows at size 1
+        assert (plan_windows(gdf, img, 1).shrub_id == 2).sum() == 4
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from shrub_prepro.processing import process_data
+
+pytest.importorskip("pyarrow")
+
+
+def test_npy_shards_match_geotiffs(survey_inputs, tmp_path):
+    """The shard backend stores the same pixels and georeferencing as the GeoTIFFs."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "tif", "rgb", 8, seed=1)
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "npy",
+        "rgb",
+        8,
+        seed=1,
+        output_format="npy",
+    )
+
+    manifest = pd.read_parquet(tmp_path / "npy" / "manifest.parquet")
+    assert len(manifest) == 5 + 10
+    assert not (tmp_path / "npy" / "images").exists()
+    assert set(manifest[manifest.shrub_id >= 0].patch_id) == {
+        f"{i}.0" for i in range(5)
+    }
+
+    for row in manifest.itertuples():
+        shard = tmp_path / "npy" / "shards" / row.shard
+        image = np.load(f"{shard}_images.npy")[row.offset]
+        label = np.load(f"{shard}_labels.npy")[row.offset]
+        tif = next((tmp_path / "tif").rglob(f"images/rgb_{row.patch_id}.tif"))
+        with rasterio.open(tif) as src:
+            assert np.array_equal(image, src.read())
+            assert tuple(row.transform) == tuple(src.transform)[:6]
+            assert src.crs == rasterio.crs.CRS.from_wkt(row.crs)
+            assert (row.minx, row.miny, row.maxx, row.maxy) == tuple(src.bounds)
+        tif = next((tmp_path / "tif").rglob(f"labels/rgb_{row.patch_id}.tif"))
+        with rasterio.open(tif) as src:
+            assert np.array_equal(label, src.read(1))
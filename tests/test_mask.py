@@ -0,0 +1,54 @@
+import numpy as np
+import rasterio
+import geopandas as gpd
+from shapely.geometry import Polygon, box
+
+from shrub_prepro.images import background_samples
+from shrub_prepro.mask import (
+    build_valid_mask,
+    has_nodata_mask,
+    load_or_build_valid_mask,
+    valid_mask_path,
+)
+
+
+def test_build_valid_mask(collar_raster):
+    """Cells over the nodata collar are invalid, the rest are valid."""
+    with rasterio.open(collar_raster) as img:
+        assert has_nodata_mask(img)
+        exact = build_valid_mask(img, cell_size=8)
+        assert exact.cells.shape == (8, 8)
+        assert not exact.cells[:, :4].any()
+        assert exact.cells[:, 4:].all()
+        # The overview-based mask is conservative
+        approx = build_valid_mask(img, cell_size=8, use_overviews=True)
+        assert not (approx.cells & ~exact.cells).any()
+
+
+def test_valid_mask_cache(collar_raster, tmp_path):
+    """The mask is cached next to the raster and reused."""
+    with rasterio.open(collar_raster) as img:
+        first = load_or_build_valid_mask(img, collar_raster, cell_size=8)
+        assert (tmp_path / "collar.tif.validmask.npz").exists()
+        assert valid_mask_path(str(collar_raster)).endswith(".validmask.npz")
+        second = load_or_build_valid_mask(img, collar_raster, cell_size=8)
+        assert np.array_equal(first.cells, second.cells)
+
+
+def test_background_samples_valid_mask(collar_raster):
+    """Background windows drawn with a mask never touch the nodata collar."""
+    gdf = gpd.GeoDataFrame(
+        {"geometry": [Polygon([(500400, 300), (500420, 300), (500420, 320)])] * 2},
+        crs="EPSG:32633",
+    )
+    with rasterio.open(collar_raster) as img:
+        valid_mask = build_valid_mask(img, cell_size=8)
+        negatives = background_samples(
+            img, gdf, window_size=8, seed=1, valid_mask=valid_mask
+        )
+        assert len(negatives) == 4
+        for w in negatives:
+            assert img.dataset_mask(window=w).all()
+            assert not gdf.intersects(
+                box(*rasterio.windows.bounds(w, img.transform))
+            ).any()
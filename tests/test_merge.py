@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from shrub_prepro.merge import merge_shards
+from shrub_prepro.processing import process_data
+from shrub_prepro.runs import load_run
+
+
+def run_shards(raster_path, polygon_path, tmp_path, count, **kwargs):
+    """Write every shard of a run into its own directory."""
+    dirs = [tmp_path / f"shard{i}" for i in range(count)]
+    for i, directory in enumerate(dirs):
+        process_data(
+            str(raster_path),
+            polygon_path,
+            directory,
+            "rgb",
+            8,
+            seed=4,
+            shard=(i, count),
+            **kwargs,
+        )
+    return dirs
+
+
+@pytest.mark.parametrize("split_mode", ["random", "block"])
+def test_merged_shards_match_unsharded_run(
+    survey_inputs, tmp_path, split_mode, read_outputs
+):
+    """Merging the shards gives exactly the outputs of one unsharded run."""
+    raster_path, polygon_path = survey_inputs
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "whole",
+        "rgb",
+        8,
+        seed=4,
+        split_mode=split_mode,
+        split_block_size=24,
+    )
+    dirs = run_shards(
+        raster_path,
+        polygon_path,
+        tmp_path,
+        3,
+        split_mode=split_mode,
+        split_block_size=24,
+    )
+    plans = [load_run(str(d)).plan for d in dirs]
+    assert all(len(p) for p in plans)
+    assert sum(len(p) for p in plans) == 15
+
+    # The split the shards were run with is the default
+    merge_shards(dirs, tmp_path / "merged")
+    whole = read_outputs(tmp_path / "whole")
+    merged = read_outputs(tmp_path / "merged")
+    assert whole.keys() == merged.keys()
+    for name, (data, transform) in whole.items():
+        assert np.array_equal(data, merged[name][0])
+        assert transform == merged[name][1]
+
+    # Band statistics are regrouped by the merged split
+    with open(tmp_path / "whole" / "stats.json") as f:
+        whole_stats = json.load(f)
+    with open(tmp_path / "merged" / "stats.json") as f:
+        merged_stats = json.load(f)
+    assert merged_stats["planned_patches"] == whole_stats["planned_patches"]
+    assert merged_stats["groups"].keys() == whole_stats["groups"].keys()
+    for name, group in whole_stats["groups"].items():
+        assert merged_stats["groups"][name]["patches"] == group["patches"]
+        assert np.allclose(merged_stats["groups"][name]["mean"], group["mean"])
+        assert np.allclose(merged_stats["groups"][name]["std"], group["std"])
+
+
+def test_merge_rejects_incomplete_shards(survey_inputs, tmp_path):
+    """Every shard must be present, and the split must match the shards', before merging."""
+    raster_path, polygon_path = survey_inputs
+    dirs = run_shards(raster_path, polygon_path, tmp_path, 3)
+    with pytest.raises(ValueError, match="Expected shards"):
+        merge_shards(dirs[:2], tmp_path / "merged")
+    with pytest.raises(ValueError, match="split_mode='random'"):
+        merge_shards(dirs, tmp_path / "merged", split_mode="block")
+    with pytest.raises(ValueError, match="need a seed"):
+        process_data(
+            str(raster_path), polygon_path, tmp_path / "x", "rgb", 8, shard=(0, 2)
+        )
+
+
+def test_merge_npy_shards(survey_inputs, tmp_path):
+    """NPY shards from every node end up in one manifest with the split assigned."""
+    pytest.importorskip("pyarrow")
+    raster_path, polygon_path = survey_inputs
+    dirs = run_shards(raster_path, polygon_path, tmp_path, 2, output_format="npy")
+    plan = merge_shards(dirs, tmp_path / "merged")
+    manifest = pd.read_parquet(tmp_path / "merged" / "manifest.parquet")
+    assert sorted(manifest.patch_id) == sorted(plan.patch_id)
+    assert set(manifest.split) == {"train", "test"}
+    for shard in manifest.shard.unique():
+        assert (tmp_path / "merged" / "shards" / f"{shard}_images.npy").exists()
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from shrub_prepro.mosaic import assign_tiles, index_tiles, mosaic_tiles, mosaic_vrt
+from shrub_prepro.processing import process_data, spatial_chunks
+from shrub_prepro.runs import load_run
+
+
+def cut_tiles(raster_path, tiles_dir, size=32, skip=()):
+    """Cut a raster into size x size GeoTIFF tiles, leaving out the (row, col) in skip."""
+    tiles_dir.mkdir()
+    with rasterio.open(raster_path) as src:
+        for row in range(0, src.height, size):
+            for col in range(0, src.width, size):
+                if (row, col) in skip:
+                    continue
+                window = Window(col, row, size, size)
+                profile = dict(
+                    src.profile,
+                    width=size,
+                    height=size,
+                    transform=rasterio.windows.transform(window, src.transform),
+                )
+                with rasterio.open(
+                    tiles_dir / f"tile_{row}_{col}.tif", "w", **profile
+                ) as dst:
+                    dst.write(src.read(window=window))
+    return tiles_dir
+
+
+def test_mosaic_tiles_and_index(survey_inputs, tmp_path):
+    """Directories and globs list the tiles, whose footprints cover the raster."""
+    raster_path, _ = survey_inputs
+    tiles_dir = cut_tiles(raster_path, tmp_path / "tiles")
+    tiles = mosaic_tiles(tiles_dir)
+    assert len(tiles) == 4
+    assert mosaic_tiles(str(tiles_dir / "tile_0_*.tif")) == tiles[:2]
+
+    index = index_tiles(tiles)
+    assert tuple(index.total_bounds) == (0, 0, 64, 64)
+    plan = pd.DataFrame(
+        {"col_off": [0, 26, 40, 8], "row_off": [0, 26, 40, 40], "size": [16] * 4}
+    )
+    with rasterio.open(raster_path) as src:
+        tile_of = assign_tiles(plan, index, src.transform)
+    # Tiles are sorted by name: rows 0 and 32 (top to bottom), then columns
+    assert [index.path[t].rsplit("/", 1)[1] for t in tile_of] == [
+        "tile_0_0.tif",
+        "tile_32_32.tif",
+        "tile_32_32.tif",
+        "tile_32_0.tif",
+    ]
+    chunks = spatial_chunks(plan, 2, 16, tile_of)
+    assert sorted(len(chunk) for chunk in chunks) == [1, 1, 2]
+
+    index["res"] = [(2.0, 2.0)] + list(index.res[1:])
+    with pytest.raises(ValueError, match="resolution"):
+        mosaic_vrt(index)
+
+
+def test_process_data_on_mosaic(survey_inputs, tmp_path, read_outputs):
+    """A directory of tiles gives the shrub patches of the whole raster, seams included."""
+    raster_path, polygon_path = survey_inputs
+    tiles_dir = cut_tiles(raster_path, tmp_path / "tiles")
+    output_dir = tmp_path / "out"
+    process_data(str(raster_path), polygon_path, tmp_path / "whole", "rgb", 24, seed=1)
+    process_data(str(tiles_dir), polygon_path, output_dir, "rgb", 24, seed=1, workers=2)
+
+    whole = read_outputs(tmp_path / "whole")
+    outputs = read_outputs(output_dir)
+    shrubs = [name for name in whole if "." in name.rsplit("_", 1)[1][: -len(".tif")]]
+    assert len(shrubs) == 2 * 5
+    crossing = 0
+    for name in shrubs:
+        data, transform = outputs[name]
+        assert np.array_equal(data, whole[name][0])
+        assert transform == whole[name][1]
+        # Map units are pixels, with tile seams at 32
+        crossing += transform.c % 32 + 24 > 32 or transform.f % 32 - 24 < 0
+    assert crossing
+
+    state = load_run(str(output_dir))
+    assert len(state.key["raster"]) == 4
+    process_data(str(tiles_dir), polygon_path, output_dir, "rgb", 24, seed=1)
+    assert load_run(str(output_dir)).generation == 1
+    assert read_outputs(output_dir).keys() == outputs.keys()
+
+
+def test_mosaic_background_avoids_gaps(survey_inputs, tmp_path, read_outputs):
+    """Background windows are never drawn where no tile covers the mosaic."""
+    raster_path, polygon_path = survey_inputs
+    tiles_dir = cut_tiles(raster_path, tmp_path / "tiles", skip=[(0, 32)])
+    output_dir = tmp_path / "out"
+    process_data(str(tiles_dir), polygon_path, output_dir, "rgb", 8, seed=2)
+
+    background = [
+        transform
+        for name, (_, transform) in read_outputs(output_dir).items()
+        if "/images/" in name and "." not in name.rsplit("_", 1)[1][: -len(".tif")]
+    ]
+    assert background
+    for transform in background:
+        # The missing tile spans x 32..64 and y 32..64 in map units
+        assert transform.c + 8 <= 32 or transform.f <= 32
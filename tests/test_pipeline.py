@@ -7,6 +7,7 @@ import rasterio
 from shapely.geometry import Polygon
 
 from shrub_prepro import images
+from shrub_prepro.processing import process_data
 
 
 @pytest.fixture
@@ -97,3 +98,60 @@ def test_label_patch_with_window(sample_polygons, sample_raster):
         assert arr.shape == (10, 10)
         # Should contain the default value (255) and possibly 0
         assert np.any(arr == 255)
+
+
+def test_process_data_workers_match_serial(survey_inputs, tmp_path, read_outputs):
+    """A worker pool writes exactly the same patches as the serial loop."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "serial", "rgb", 8, seed=3)
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "pool",
+        "rgb",
+        8,
+        seed=3,
+        workers=2,
+    )
+    serial = read_outputs(tmp_path / "serial")
+    pool = read_outputs(tmp_path / "pool")
+    assert serial.keys() == pool.keys()
+    assert len(serial) == 2 * (5 + 10)
+    for name, (data, transform) in serial.items():
+        assert np.array_equal(data, pool[name][0])
+        assert transform == pool[name][1]
+
+
+def test_process_data_writes_split_directly(survey_inputs, tmp_path):
+    """Patches are written straight into train/ and test/, nothing is left to move."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=3)
+    assert not (tmp_path / "out" / "images").exists()
+    train = sorted(p.name for p in (tmp_path / "out" / "train" / "images").iterdir())
+    test = sorted(p.name for p in (tmp_path / "out" / "test" / "images").iterdir())
+    assert len(train) == 12 and len(test) == 3
+    for name in train:
+        assert (tmp_path / "out" / "train" / "labels" / name).exists()
+
+
+def test_process_data_pipelined_matches_serial(survey_inputs, tmp_path, read_outputs):
+    """Overlapping reads and writes on threads gives the same outputs."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "serial", "rgb", 8, seed=5)
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "threads",
+        "rgb",
+        8,
+        seed=5,
+        queue_depth=2,
+        io_threads=3,
+        max_read_bytes=3 * 24 * 24,
+    )
+    serial = read_outputs(tmp_path / "serial")
+    threads = read_outputs(tmp_path / "threads")
+    assert serial.keys() == threads.keys()
+    for name, (data, transform) in serial.items():
+        assert np.array_equal(data, threads[name][0])
+        assert transform == threads[name][1]
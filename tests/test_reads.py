@@ -0,0 +1,74 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+
+from shrub_prepro.reads import BlockCache, grouped_reads, plan_read_groups
+
+
+def tiled_raster(path):
+    """A 3-band 100x100 tiled raster with 16x16 blocks."""
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=100,
+        width=100,
+        count=3,
+        dtype=np.uint8,
+        crs="EPSG:32633",
+        transform=from_bounds(0, 0, 100, 100, 100, 100),
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+    ) as dst:
+        dst.write(np.random.randint(0, 255, size=(3, 100, 100), dtype=np.uint8))
+    return path
+
+
+WINDOWS = [
+    Window(10, 10, 20, 20),
+    Window(20, 15, 20, 20),
+    Window(-5, 90, 20, 20),  # cropped at the raster edge
+    Window(60.5, 30, 20, 20),  # fractional, read directly
+    Window(200, 200, 20, 20),  # outside the raster
+    Window(80, 0, 20, 20),
+]
+
+
+def test_grouped_reads_match_direct_reads(tmp_path):
+    """Every window gets the same pixels as a direct image.read."""
+    with rasterio.open(tiled_raster(tmp_path / "tiled.tif")) as img:
+        seen = set()
+        for i, data in grouped_reads(img, WINDOWS, max_bytes=3 * 64 * 64):
+            assert np.array_equal(data, img.read(window=WINDOWS[i]))
+            seen.add(i)
+        assert seen == set(range(len(WINDOWS)))
+
+
+def test_plan_read_groups_bounds_memory(tmp_path):
+    """Grouped reads are block aligned and never exceed the byte bound."""
+    max_bytes = 3 * 80 * 80
+    with rasterio.open(tiled_raster(tmp_path / "tiled.tif")) as img:
+        groups = plan_read_groups(img, WINDOWS, max_bytes=max_bytes)
+        assert sorted(i for g in groups for i in g.members) == list(range(6))
+        for group in groups:
+            if group.window is None:
+                continue
+            assert group.window.col_off % 16 == 0 and group.window.row_off % 16 == 0
+            assert group.window.width * group.window.height * 3 <= max_bytes
+        # The two overlapping windows at the top left share one read
+        assert any({0, 1} <= set(g.members) for g in groups if g.window is not None)
+
+
+def test_block_cache_matches_boundless_reads(tmp_path):
+    """Cached windows match padded direct reads, and repeated tiles are served from memory."""
+    with rasterio.open(tiled_raster(tmp_path / "tiled.tif")) as img:
+        # Room for two 32x32 tiles only, so tiles are evicted between batches
+        cache = BlockCache(img, max_bytes=2 * 3 * 32 * 32, min_tile=32)
+        for batch in (WINDOWS[:3], WINDOWS[3:], WINDOWS):
+            for window, data in zip(batch, cache.read(batch)):
+                expected = img.read(window=window, boundless=True, fill_value=0)
+                assert np.array_equal(data, expected)
+        assert cache.hits and cache.misses
+        assert cache.nbytes <= 2 * 3 * 32 * 32
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+
+from shrub_prepro.remote import RangeCache, open_raster
+
+
+@pytest.fixture
+def s3_raster(tmp_path, moto_s3):
+    """A tiled raster uploaded to a local moto S3 server."""
+    local = tmp_path / "tiled.tif"
+    data = np.random.randint(0, 255, size=(3, 256, 256), dtype=np.uint8)
+    with rasterio.open(
+        local,
+        "w",
+        driver="GTiff",
+        height=256,
+        width=256,
+        count=3,
+        dtype=np.uint8,
+        crs="EPSG:32633",
+        transform=from_bounds(0, 0, 256, 256, 256, 256),
+        tiled=True,
+        blockxsize=64,
+        blockysize=64,
+    ) as dst:
+        dst.write(data)
+
+    moto_s3.put_file(str(local), "s3://shrubs/tiled.tif")
+    return "s3://shrubs/tiled.tif", data
+
+
+def test_cached_remote_reads(s3_raster, tmp_path):
+    """Repeated windows are served from the cache, and the disk tier survives a new run."""
+    path, data = s3_raster
+    window = Window(10, 20, 100, 80)
+
+    cache = RangeCache(str(tmp_path / "cache"), block_size=16 * 1024)
+    with open_raster(path, cache) as image:
+        assert np.array_equal(image.read(window=window), data[:, 20:100, 10:110])
+        fetched = cache.stats["bytes_fetched"]
+        assert fetched > 0
+        image.read(window=Window(20, 30, 60, 60))
+    assert cache.stats["bytes_fetched"] == fetched
+    assert cache.stats["bytes_from_memory"] > 0
+
+    # A new process-level cache over the same directory fetches nothing
+    second = RangeCache(str(tmp_path / "cache"), block_size=16 * 1024)
+    with open_raster(path, second) as image:
+        assert np.array_equal(image.read(window=window), data[:, 20:100, 10:110])
+    assert second.stats["bytes_fetched"] == 0
+    assert second.stats["bytes_from_disk"] > 0
+
+
+def test_range_cache_eviction(tmp_path):
+    """Both tiers stay within their caps, evicting the least recently used blocks."""
+    payload = bytes(range(256)) * 64
+    fetches = []
+
+    def fetch(start, end):
+        fetches.append((start, end))
+        return payload[start:end]
+
+    cache = RangeCache(
+        str(tmp_path / "cache"), block_size=1024, memory_bytes=4096, disk_bytes=8192
+    )
+    assert cache.get_blocks("f", 0, 15, fetch) == payload
+    assert fetches == [(0, 16 * 1024)]
+    assert cache.memory_size <= 4096
+    assert sum(p.stat().st_size for p in (tmp_path / "cache").iterdir()) <= 8192
+    # The most recent blocks are still in memory
+    assert cache.get_blocks("f", 14, 15, fetch) == payload[14 * 1024 :]
+    assert len(fetches) == 1
+
+
+def test_range_cache_overwrite_counts_once(tmp_path):
+    """Storing a block that is already on disk doesn't grow the disk tier's size."""
+    cache = RangeCache(str(tmp_path / "cache"), block_size=1024)
+    for _ in range(3):
+        cache._store("f#0", bytes(1024))
+    assert cache.disk_size == 1024
+
+
+def test_range_cache_ignores_interrupted_writes(tmp_path):
+    """Temporary files left by a crash don't count against the disk tier."""
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "block.123.456.tmp").write_bytes(bytes(4096))
+    cache = RangeCache(str(tmp_path / "cache"), block_size=1024)
+    assert cache.disk_size == 0
+    cache._store("f#0", bytes(1024))
+    assert cache.disk_size == 1024
+
+
+def test_process_data_remote_raster(s3_raster, tmp_path):
+    """process_data reads an S3 raster through the range cache."""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    from shrub_prepro.processing import process_data
+
+    path, _ = s3_raster
+    polygons = tmp_path / "shrubs.gpkg"
+    gpd.GeoDataFrame(
+        {"geometry": [box(40, 40, 50, 50), box(150, 160, 158, 170)]},
+        crs="EPSG:32633",
+    ).to_file(polygons)
+    process_data(
+        path,
+        polygons,
+        tmp_path / "out",
+        "rgb",
+        32,
+        seed=0,
+        queue_depth=2,
+        remote_cache_dir=str(tmp_path / "cache"),
+    )
+    assert len(list((tmp_path / "out").rglob("images/*.tif"))) == 2 + 4
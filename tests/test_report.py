@@ -0,0 +1,65 @@
+import json
+import os
+import pstats
+
+import pytest
+
+from shrub_prepro.processing import process_data
+from shrub_prepro.report import RunReport, count, recording, timed
+
+
+def test_report_records_only_while_active():
+    """timed() and count() add to the recording report and are no-ops outside it."""
+    report = RunReport()
+    count("ignored")
+    with recording(report):
+        with timed("read"):
+            count("bytes_read", 2**20)
+        worker = RunReport()
+        with recording(worker):
+            count("patches_written", 3)
+        report.merge(worker)
+    assert report.calls["read"] == 1
+    assert dict(report.counters) == {"bytes_read": 2**20, "patches_written": 3}
+    assert "read_mb_per_s" in report.to_dict()["rates"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_report(survey_inputs, tmp_path, workers, read_outputs):
+    """The run report counts every written patch and byte, also across workers."""
+    raster_path, polygon_path = survey_inputs
+    output_dir = tmp_path / "out"
+    report_path = tmp_path / "run.json"
+    profile_path = tmp_path / "run.prof"
+    process_data(
+        raster_path,
+        polygon_path,
+        output_dir,
+        "rgb",
+        8,
+        seed=1,
+        workers=workers,
+        report=report_path,
+        profile=str(profile_path),
+    )
+    with open(report_path) as f:
+        report = json.load(f)
+
+    assert {"plan", "background_samples", "write_shrubs", "write_background"} <= set(
+        report["stages"]
+    )
+    counters = report["counters"]
+    written = len(read_outputs(output_dir)) // 2
+    assert counters["patches_planned"] == counters["patches_written"] == written
+    assert counters["bytes_read"] > 0 and counters["bytes_written"] > 0
+    assert report["operations"]["write"]["calls"] == written
+    assert 0 < report["rates"]["background_acceptance"] <= 1
+    assert counters["background_accepted"] == counters["background_windows_planned"]
+
+    worker_profiles = [
+        str(tmp_path / name)
+        for name in os.listdir(tmp_path)
+        if name.startswith("run.prof.")
+    ]
+    assert bool(worker_profiles) == (workers > 1)
+    pstats.Stats(str(profile_path), *worker_profiles)
@@ -0,0 +1,217 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from shrub_prepro.io import GeoTiffWriter, ShardWriter
+from shrub_prepro.processing import process_data
+from shrub_prepro.runs import load_run
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Record the patch ids passed to GeoTiffWriter.write."""
+    patch_ids = []
+    write = GeoTiffWriter.write
+
+    def spy(self, patch_id, *args, **kwargs):
+        patch_ids.append(patch_id)
+        return write(self, patch_id, *args, **kwargs)
+
+    monkeypatch.setattr(GeoTiffWriter, "write", spy)
+    return patch_ids
+
+
+def crash_after(monkeypatch, writer, n):
+    """Make writer.write raise after n successful writes."""
+    write = writer.write
+    calls = []
+
+    def failing(self, *args, **kwargs):
+        if len(calls) == n:
+            raise RuntimeError("crash")
+        calls.append(1)
+        return write(self, *args, **kwargs)
+
+    monkeypatch.setattr(writer, "write", failing)
+
+
+def test_resume_after_crash(
+    survey_inputs, tmp_path, monkeypatch, written, read_outputs
+):
+    """A rerun after a crash writes only the missing patches, with the same result."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "clean", "rgb", 8, seed=2)
+
+    with monkeypatch.context() as m:
+        crash_after(m, GeoTiffWriter, 6)
+        with pytest.raises(RuntimeError):
+            process_data(
+                str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2
+            )
+    assert len(load_run(str(tmp_path / "out")).completed) == 6
+
+    written.clear()
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    assert len(written) == 15 - 6
+    clean = read_outputs(tmp_path / "clean")
+    out = read_outputs(tmp_path / "out")
+    assert clean.keys() == out.keys()
+    for name, (data, transform) in clean.items():
+        assert np.array_equal(data, out[name][0])
+    # The band statistics cover the patches of both runs
+    with open(tmp_path / "clean" / "stats.json") as f:
+        clean_stats = json.load(f)["groups"]
+    with open(tmp_path / "out" / "stats.json") as f:
+        out_stats = json.load(f)["groups"]
+    assert out_stats.keys() == clean_stats.keys()
+    for name, group in clean_stats.items():
+        assert out_stats[name]["patches"] == group["patches"]
+        assert np.allclose(out_stats[name]["mean"], group["mean"])
+        assert np.allclose(out_stats[name]["std"], group["std"])
+
+    # Nothing is left to do for an unchanged rerun
+    written.clear()
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    assert written == []
+
+
+def test_resume_reads_missing_band_stats(survey_inputs, tmp_path, written):
+    """Patches written without band statistics get them from the raster, not rewritten."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "clean", "rgb", 8, seed=2)
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "out",
+        "rgb",
+        8,
+        seed=2,
+        band_stats=False,
+    )
+    assert not (tmp_path / "out" / "stats.json").exists()
+
+    written.clear()
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    assert written == []
+    with open(tmp_path / "clean" / "stats.json") as f:
+        clean_stats = json.load(f)["groups"]
+    with open(tmp_path / "out" / "stats.json") as f:
+        out_stats = json.load(f)["groups"]
+    assert out_stats.keys() == clean_stats.keys()
+    for name, group in clean_stats.items():
+        assert out_stats[name]["patches"] == group["patches"]
+        assert np.allclose(out_stats[name]["mean"], group["mean"])
+        assert out_stats[name]["histogram"] == group["histogram"]
+
+
+def test_added_polygon_rewrites_affected_patches(
+    survey_inputs, tmp_path, written, read_outputs
+):
+    """Only patches near an added polygon are regenerated, and their labels include it."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    before = load_run(str(tmp_path / "out"))
+
+    shrubs = gpd.read_file(polygon_path)
+    added = gpd.GeoDataFrame({"geometry": [box(12, 9, 13, 10)]}, crs=shrubs.crs)
+    pd.concat([shrubs, added], ignore_index=True).to_file(polygon_path)
+
+    written.clear()
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    after = load_run(str(tmp_path / "out"))
+    # The new shrub, and the patch of its neighbour that now contains it
+    assert sorted(written) == ["0.0", "1.0", "5.0"]
+    assert len(after.completed) == len(after.plan)
+    # Background windows near the new polygon are dropped, the rest is kept
+    kept = set(after.plan.patch_id[~after.plan.positive])
+    assert kept <= set(before.plan.patch_id[~before.plan.positive])
+
+    # The regenerated outputs match a fresh run over the new polygons
+    process_data(str(raster_path), polygon_path, tmp_path / "fresh", "rgb", 8, seed=2)
+    # Earlier patches keep their split, so compare by file name
+    fresh = {k.split("/", 1)[1]: v for k, v in read_outputs(tmp_path / "fresh").items()}
+    out = {k.split("/", 1)[1]: v for k, v in read_outputs(tmp_path / "out").items()}
+    for name in fresh:
+        if "." in name.split("_")[-1][: -len(".tif")]:
+            assert np.array_equal(fresh[name][0], out[name][0])
+
+
+def test_inserted_polygon_keeps_other_ids(
+    survey_inputs, tmp_path, written, read_outputs
+):
+    """Inserting and deleting polygons mid-layer doesn't renumber the other shrubs."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+
+    shrubs = gpd.read_file(polygon_path)
+    added = gpd.GeoDataFrame({"geometry": [box(12, 9, 13, 10)]}, crs=shrubs.crs)
+    pd.concat([added, shrubs.drop(index=3)], ignore_index=True).to_file(polygon_path)
+
+    written.clear()
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    after = load_run(str(tmp_path / "out"))
+    # The new shrub gets the next free id, its neighbours are rewritten to contain it
+    assert sorted(written) == ["0.0", "1.0", "5.0"]
+    shrub_patches = set(after.plan.patch_id[after.plan.positive])
+    assert shrub_patches == {"0.0", "1.0", "2.0", "4.0", "5.0"}
+    assert not any("rgb_3.0" in name for name in read_outputs(tmp_path / "out"))
+
+
+def test_changed_parameters_start_over(survey_inputs, tmp_path, written, read_outputs):
+    """A different window size, or resume=False, rewrites every patch."""
+    raster_path, polygon_path = survey_inputs
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    written.clear()
+    process_data(str(raster_path), polygon_path, tmp_path / "out", "rgb", 10, seed=2)
+    assert len(written) == 15
+    assert {data.shape[1:] for data, _ in read_outputs(tmp_path / "out").values()} == {
+        (10, 10)
+    }
+    written.clear()
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "out",
+        "rgb",
+        10,
+        seed=2,
+        resume=False,
+    )
+    assert len(written) == 15
+
+
+def test_resume_npy_shards(survey_inputs, tmp_path, monkeypatch):
+    """Flushed shards survive a crash and the merged manifest covers every patch once."""
+    pytest.importorskip("pyarrow")
+    raster_path, polygon_path = survey_inputs
+    with monkeypatch.context() as m:
+        crash_after(m, ShardWriter, 3)
+        with pytest.raises(RuntimeError):
+            process_data(
+                str(raster_path),
+                polygon_path,
+                tmp_path / "out",
+                "rgb",
+                8,
+                seed=2,
+                output_format="npy",
+            )
+    # The partial shard is flushed when the writer closes
+    assert len(load_run(str(tmp_path / "out")).completed) == 3
+
+    process_data(
+        str(raster_path),
+        polygon_path,
+        tmp_path / "out",
+        "rgb",
+        8,
+        seed=2,
+        output_format="npy",
+    )
+    manifest = pd.read_parquet(tmp_path / "out" / "manifest.parquet")
+    assert len(manifest) == 15
+    assert manifest.patch_id.is_unique
@@ -0,0 +1,72 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.model_selection import train_test_split
+
+from shrub_prepro.split import assign_split, log_gap
+
+
+def grid_plan(step=6, size=8, n=12):
+    """A plan of overlapping windows on a regular grid."""
+    offsets = [(c * step, r * step) for r in range(n) for c in range(n)]
+    return pd.DataFrame(
+        {
+            "patch_id": [str(i) for i in range(len(offsets))],
+            "col_off": [float(c) for c, _ in offsets],
+            "row_off": [float(r) for _, r in offsets],
+            "size": size,
+        }
+    )
+
+
+def test_random_split_matches_file_split():
+    """The random split picks the same test ids as splitting the written files."""
+    plan = grid_plan()
+    split = assign_split(plan)
+    _, expected = train_test_split(
+        sorted(plan.patch_id), test_size=0.2, random_state=42
+    )
+    assert set(plan.patch_id[split == "test"]) == set(expected)
+    assert split.equals(assign_split(plan))
+
+
+def test_block_split_has_no_overlap_across_sets():
+    """Block split windows in test never share pixels with a train window."""
+    plan = grid_plan()
+    split = assign_split(plan, mode="block", block_size=24)
+    assert (split == "test").any() and (split == "train").any()
+    assert (split == "gap").any()
+    col0, row0 = plan.col_off.to_numpy(), plan.row_off.to_numpy()
+    test, train = np.flatnonzero(split == "test"), np.flatnonzero(split == "train")
+    for i in test:
+        shared_cols = np.minimum(col0[i], col0[train]) + 8 > np.maximum(
+            col0[i], col0[train]
+        )
+        shared_rows = np.minimum(row0[i], row0[train]) + 8 > np.maximum(
+            row0[i], row0[train]
+        )
+        assert not (shared_cols & shared_rows).any()
+
+
+def test_gap_patches_are_logged(caplog):
+    """Dropped gap patches are logged, with a warning for shrubs left without patches."""
+    plan = grid_plan()
+    plan["split"] = assign_split(plan, mode="block", block_size=24).to_numpy()
+    gap = np.flatnonzero(plan.split == "gap")
+    # One shrub only has a gap patch, another has a gap patch and a kept one
+    plan["shrub_id"] = -1
+    plan.loc[gap[0], "shrub_id"] = 7
+    plan.loc[[gap[1], int(np.flatnonzero(plan.split == "train")[0])], "shrub_id"] = 8
+    with caplog.at_level(logging.INFO):
+        log_gap(plan)
+    assert f"Dropping {len(gap)} patches" in caplog.text
+    assert "from 2 shrubs" in caplog.text
+    warnings = [r for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 1 and "[7]" in warnings[0].getMessage()
+
+
+def test_unknown_split_mode():
+    with pytest.raises(ValueError):
+        assign_split(grid_plan(), mode="checkerboard")
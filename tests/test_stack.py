@@ -0,0 +1,114 @@
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from shrub_prepro.processing import process_data
+from shrub_prepro.runs import load_run
+from shrub_prepro.stack import StackedRaster
+
+
+def write_dsm(path, size, crs="EPSG:32633", bounds=(0, 0, 64, 64), nodata=None):
+    """
+    A float32 surface model over the survey area, `size` pixels on a side, whose top left
+    quarter is `nodata` if given.
+    """
+    data = np.linspace(100, 200, size * size, dtype=np.float32).reshape(1, size, size)
+    if nodata is not None:
+        data[:, : size // 2, : size // 2] = nodata
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=size,
+        width=size,
+        count=1,
+        dtype=np.float32,
+        crs=crs,
+        transform=rasterio.transform.from_bounds(*bounds, size, size),
+        nodata=nodata,
+    ) as dst:
+        dst.write(data)
+    return path
+
+
+def test_stacked_raster_reads(survey_inputs, tmp_path):
+    """Aligned rasters are stacked as they are, others through one WarpedVRT."""
+    raster_path, _ = survey_inputs
+    aligned = write_dsm(tmp_path / "dsm.tif", 64)
+    coarse = write_dsm(tmp_path / "coarse.tif", 32)
+    window = Window(5, 7, 16, 16)
+    with StackedRaster([str(raster_path), str(aligned), str(coarse)]) as stack:
+        assert stack.count == 5
+        assert stack.dtypes[0] == "float32"
+        assert stack.sources[1][1] is None and stack.sources[2][1] is not None
+        data = stack.read(window=window)
+        padded = stack.read(window=Window(-4, 60, 8, 8), boundless=True)
+        assert stack.dataset_mask(window=window).shape == (16, 16)
+        with rasterio.open(raster_path) as rgb, rasterio.open(aligned) as dsm:
+            assert np.array_equal(data[:3], rgb.read(window=window))
+            assert np.array_equal(data[3:4], dsm.read(window=window))
+            with (
+                rasterio.open(coarse) as src,
+                WarpedVRT(
+                    src,
+                    crs=rgb.crs,
+                    transform=rgb.transform,
+                    width=rgb.width,
+                    height=rgb.height,
+                    resampling=rasterio.enums.Resampling.bilinear,
+                ) as vrt,
+            ):
+                assert np.array_equal(data[4:], vrt.read(window=window))
+            expected = rgb.read(window=Window(0, 60, 4, 4))
+            assert np.array_equal(padded[:3, :4, 4:], expected)
+            assert (padded[:, :, :4] == 0).all()
+
+
+def test_process_data_stacks_inputs(survey_inputs, tmp_path, read_outputs):
+    """Patches of a stacked run hold the RGB bands and the DSM band, and resume works."""
+    raster_path, polygon_path = survey_inputs
+    dsm = write_dsm(tmp_path / "dsm.tif", 64)
+    output_dir = tmp_path / "out"
+    inputs = [str(raster_path), str(dsm)]
+    process_data(inputs, polygon_path, output_dir, "rgb", 8, seed=2)
+    outputs = read_outputs(output_dir)
+    with rasterio.open(raster_path) as rgb, rasterio.open(dsm) as surface:
+        for name, (data, transform) in outputs.items():
+            if "/images/" not in name:
+                continue
+            assert data.shape == (4, 8, 8) and data.dtype == np.float32
+            window = rasterio.windows.from_bounds(
+                *rasterio.transform.array_bounds(8, 8, transform), rgb.transform
+            ).round_offsets()
+            window = Window(window.col_off, window.row_off, 8, 8)
+            assert np.array_equal(data[:3], rgb.read(window=window))
+            assert np.array_equal(data[3], surface.read(1, window=window))
+
+    state = load_run(str(output_dir))
+    assert isinstance(state.key["raster"], list)
+    assert len(state.completed) == len(state.plan)
+
+
+def test_stacked_raster_nodata(survey_inputs, tmp_path):
+    """Each raster's nodata and the fill of warped rasters read as the stack's nodata."""
+    raster_path, polygon_path = survey_inputs
+    dsm = write_dsm(tmp_path / "dsm.tif", 64, nodata=-9999)
+    # Covers the right half of the survey only, on a coarser grid
+    partial = write_dsm(tmp_path / "partial.tif", 16, bounds=(32, 0, 64, 64))
+    inputs = [str(raster_path), str(dsm), str(partial)]
+    with StackedRaster(inputs) as stack:
+        assert stack.nodata == -9999 and stack.meta["nodata"] == -9999
+        data = stack.read(window=Window(0, 0, 64, 64))
+    assert (data[3, :32, :32] == -9999).all()
+    assert (data[3, 32:, 32:] > 0).all()
+    assert (data[4, :, :32] == -9999).all()
+    assert (data[4, :, 40:] > 0).all()
+    assert (data[:3] > 0).all()
+
+    process_data(inputs, polygon_path, tmp_path / "out", "rgb", 8, seed=2)
+    patches = list((tmp_path / "out").rglob("images/*.tif"))
+    assert patches
+    for path in patches:
+        with rasterio.open(path) as patch:
+            assert patch.nodata == -9999
@@ -0,0 +1,138 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from shrub_prepro.processing import process_data
+from shrub_prepro.stats import BandStats, PatchStats, PatchStatsLog, read_stats_lines
+
+
+def test_band_stats_merge_matches_numpy():
+    """Merged accumulators give the mean, std and histogram of all pixels together."""
+    rng = np.random.default_rng(0)
+    patches = [rng.integers(0, 256, size=(3, 8, 8), dtype=np.uint8) for _ in range(6)]
+    patches[2][:, :4] = 0
+    left, right = BandStats(3, "uint8"), BandStats(3, "uint8")
+    for patch in patches[:2]:
+        left.update(patch, nodata=0)
+    for patch in patches[2:]:
+        right.update(patch, nodata=0)
+    left.merge(right)
+
+    pixels = np.concatenate([p.reshape(3, -1) for p in patches], axis=1)
+    pixels = pixels[:, (pixels != 0).any(axis=0)].astype(np.float64)
+    summary = left.to_dict()
+    assert summary["patches"] == 6
+    assert summary["pixels"] == pixels.shape[1]
+    assert np.allclose(summary["mean"], pixels.mean(axis=1))
+    assert np.allclose(summary["std"], pixels.std(axis=1))
+    assert summary["min"] == pixels.min(axis=1).tolist()
+    assert summary["max"] == pixels.max(axis=1).tolist()
+    for band in range(3):
+        expected = np.bincount(pixels[band].astype(int), minlength=256)
+        assert summary["histogram"]["counts"][band] == expected.tolist()
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "int8", "uint16", "int16"])
+def test_band_stats_counts_match_float_path(dtype):
+    """Integer patches counted per value give the statistics of the float64 path."""
+    info = np.iinfo(dtype)
+    rng = np.random.default_rng(1)
+    patches = [
+        rng.integers(info.min, int(info.max) + 1, size=(3, 16, 16)).astype(dtype)
+        for _ in range(4)
+    ]
+    patches[1][:, :5] = 0
+    counted, floats = BandStats(3, dtype), BandStats(3, dtype)
+    for patch in patches:
+        counted.update(patch, nodata=0)
+        values = patch.reshape(3, -1)
+        floats._add_pixels(values[:, (values != 0).any(axis=0)])
+        floats.patches += 1
+
+    expected, summary = floats.to_dict(), counted.to_dict()
+    assert summary["patches"] == expected["patches"]
+    assert summary["pixels"] == expected["pixels"]
+    assert np.allclose(summary["mean"], expected["mean"])
+    assert np.allclose(summary["std"], expected["std"])
+    assert summary["min"] == expected["min"]
+    assert summary["max"] == expected["max"]
+    assert summary["histogram"] == expected["histogram"]
+
+
+def test_patch_stats_log_batches(tmp_path):
+    """The log keeps one line per batch of a group, and sums back to every patch."""
+    rng = np.random.default_rng(2)
+    patches = [rng.integers(0, 256, size=(3, 8, 8), dtype=np.uint8) for _ in range(5)]
+    log = PatchStatsLog(str(tmp_path / "part.stats.jsonl"), 3, "uint8", batch=2)
+    for i, patch in enumerate(patches):
+        log.record(str(i), "train", i % 2 == 0, patch)
+    log.close()
+    # One full and one partial batch of shrubs, and one full batch of background
+    lines = list(read_stats_lines(str(tmp_path)))
+    assert sorted(line["patch_ids"] for line in lines) == [
+        ["0", "2"],
+        ["1", "3"],
+        ["4"],
+    ]
+
+    plan = pd.DataFrame(
+        {
+            "patch_id": ["0", "1", "2", "3", "4"],
+            "split": "test",
+            "positive": [True, False, True, False, True],
+        }
+    )
+    groups = PatchStats.from_logs(plan, lines, 3, "uint8").to_dict()["groups"]
+    expected = BandStats(3, "uint8")
+    for patch in patches:
+        expected.update(patch)
+    assert groups["test/shrubs"]["patches"] == 3
+    assert np.allclose(groups["all"]["mean"], expected.to_dict()["mean"])
+    assert groups["all"]["histogram"] == expected.to_dict()["histogram"]
+    # Batches with patches outside the plan are left out
+    groups = PatchStats.from_logs(plan[:4], lines, 3, "uint8").to_dict()["groups"]
+    assert groups["all"]["patches"] == 4
+
+
+def test_band_stats_skip_nan_nodata():
+    """Pixels that are NaN in every band are skipped when nodata is NaN."""
+    patch = np.arange(2 * 4 * 4, dtype=np.float32).reshape(2, 4, 4)
+    patch[:, 0] = np.nan
+    stats = BandStats(2, "float32")
+    stats.update(patch, nodata=float("nan"))
+    summary = stats.to_dict()
+    assert summary["pixels"] == 12
+    assert np.allclose(summary["mean"], np.nanmean(patch, axis=(1, 2)))
+    assert np.allclose(summary["std"], np.nanstd(patch, axis=(1, 2)))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_stats_sidecar_matches_written_patches(
+    survey_inputs, tmp_path, workers, read_outputs
+):
+    """stats.json matches a second pass over the written patches, also across workers."""
+    raster_path, polygon_path = survey_inputs
+    output_dir = tmp_path / "out"
+    process_data(
+        str(raster_path), polygon_path, output_dir, "rgb", 8, seed=3, workers=workers
+    )
+    with open(output_dir / "stats.json") as f:
+        stats = json.load(f)
+    assert stats["written_patches"] == stats["planned_patches"] == 15
+    groups = stats["groups"]
+    assert groups["all"]["patches"] == 15
+
+    for name, (data, _) in read_outputs(output_dir).items():
+        split, folder, filename = name.split("/")
+        if folder == "images":
+            kind = "shrubs" if "." in filename[: -len(".tif")] else "background"
+            groups.setdefault(f"expected {split}/{kind}", []).append(data)
+    for key in ("train/shrubs", "train/background", "test/shrubs", "test/background"):
+        patches = groups.get(f"expected {key}", [])
+        assert groups.get(key, {"patches": 0})["patches"] == len(patches)
+        if patches:
+            pixels = np.concatenate([p.reshape(3, -1) for p in patches], axis=1)
+            assert np.allclose(groups[key]["mean"], pixels.mean(axis=1))
+            assert np.allclose(groups[key]["std"], pixels.std(axis=1))
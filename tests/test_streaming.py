@@ -0,0 +1,68 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+
+from shrub_prepro.images import plan_windows
+from shrub_prepro.processing import process_data
+from shrub_prepro.streaming import plan_streaming
+
+
+@pytest.fixture
+def survey_shapefile(survey_inputs):
+    """The survey polygons as a shapefile, whose feature ids count from 0 like a full read."""
+    raster_path, polygon_path = survey_inputs
+    shapefile = polygon_path.with_suffix(".shp")
+    gpd.read_file(polygon_path).to_file(shapefile)
+    return raster_path, shapefile
+
+
+def test_streaming_plan_matches_full_read(survey_shapefile):
+    """Tiles plan the same shrub windows, and backgrounds clear of every polygon."""
+    raster_path, shapefile = survey_shapefile
+    shrubs = gpd.read_file(shapefile)
+    with rasterio.open(raster_path) as image:
+        expected = plan_windows(shrubs, image, 8)
+        plan, background, polygons = plan_streaming(shapefile, image, 8, 16, seed=0)
+    assert sorted(plan.patch_id) == sorted(expected.patch_id)
+    merged = plan.merge(expected, on="patch_id")
+    assert np.array_equal(merged.col_off_x, merged.col_off_y)
+    assert np.array_equal(merged.row_off_x, merged.row_off_y)
+    assert sorted(polygons.index) == list(range(len(shrubs)))
+    assert len(background) and len(background) <= 2 * len(shrubs)
+    assert background.patch_id.is_unique
+
+    # Background windows keep the 5 m buffer from every polygon, also across tile edges
+    boxes = gpd.GeoSeries.from_xy(
+        background.col_off + 4, 64 - (background.row_off + 4)
+    ).buffer(4, cap_style="square")
+    assert not boxes.intersects(shrubs.buffer(5).union_all()).any()
+
+
+def test_streaming_outputs_match_full_read(survey_shapefile, tmp_path, read_outputs):
+    """Shrub patches straddling tile edges get the same labels as with a full read."""
+    raster_path, shapefile = survey_shapefile
+    process_data(str(raster_path), shapefile, tmp_path / "full", "rgb", 8, seed=1)
+    process_data(
+        str(raster_path),
+        shapefile,
+        tmp_path / "tiles",
+        "rgb",
+        8,
+        seed=1,
+        stream_tile_size=16,
+    )
+
+    # Background windows and so the splits differ, so compare shrub patches by name
+    def shrub_patches(directory):
+        return {
+            name.split("/", 1)[1]: data
+            for name, (data, _) in read_outputs(directory).items()
+            if "." in name.rsplit("_", 1)[-1][: -len(".tif")]
+        }
+
+    full = shrub_patches(tmp_path / "full")
+    tiles = shrub_patches(tmp_path / "tiles")
+    assert full.keys() == tiles.keys() and len(full) == 2 * 5
+    for name, data in full.items():
+        assert np.array_equal(data, tiles[name])
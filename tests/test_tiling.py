@@ -0,0 +1,48 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from shrub_prepro.images import label_patch_with_window
+from shrub_prepro.tiling import tile_offsets, tile_raster
+
+
+def test_tile_offsets():
+    """Tiles step by size minus overlap and the last one ends on the edge."""
+    assert tile_offsets(64, 16) == [0, 16, 32, 48]
+    assert tile_offsets(64, 16, overlap=4) == [0, 12, 24, 36, 48]
+    assert tile_offsets(10, 16) == [0]
+    with pytest.raises(ValueError, match="overlap"):
+        tile_offsets(64, 16, overlap=16)
+
+
+def test_tile_raster_with_labels(survey_inputs, tmp_path):
+    """Every tile matches a direct read, and labels match a per-window rasterize."""
+    raster_path, polygon_path = survey_inputs
+    tiles = tile_raster(
+        raster_path, tmp_path, tile_size=16, overlap=4, polygons_path=polygon_path
+    )
+    assert len(tiles) == 25
+    assert tiles.equals(pd.read_csv(tmp_path / "tiles.csv", dtype={"tile_id": str}))
+    shrubs = gpd.read_file(polygon_path)
+    with rasterio.open(raster_path) as image:
+        for tile in tiles.itertuples():
+            window = Window(tile.col_off, tile.row_off, 16, 16)
+            with rasterio.open(tmp_path / "images" / f"tile_{tile.tile_id}.tif") as f:
+                assert np.array_equal(f.read(), image.read(window=window))
+                assert f.transform == rasterio.windows.transform(
+                    window, image.transform
+                )
+            with rasterio.open(tmp_path / "labels" / f"tile_{tile.tile_id}.tif") as f:
+                expected = label_patch_with_window(shrubs.geometry, window, image)
+                assert np.array_equal(f.read(1), expected)
+
+
+def test_tile_raster_skips_nodata(collar_raster, tmp_path):
+    """Tiles over the nodata collar are not written, and no labels without polygons."""
+    tiles = tile_raster(collar_raster, tmp_path / "out", tile_size=16)
+    assert len(tiles) == 8
+    assert (tiles.col_off >= 32).all()
+    assert not (tmp_path / "out" / "labels").exists()